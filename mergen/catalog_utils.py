@@ -9,14 +9,40 @@ To Do List:
     Emma:
         -what is this is mergen and what of this is specific to your science stuff
 
+Local TIC store
+* read_ctl_header
+* build_tic_store
+* TICStore
+* load_tic_store
+
+Cross-matching
+* sexagesimal_to_deg
+* radec_to_unit
+* cross_match
+* cached_cross_match
+* cross_match_catalog
+
 """
 
-def get_tess_features(ticid):
-    '''Query catalog data https://arxiv.org/pdf/1905.10694.pdf'''
+import numpy as np
+import os
+import json
+
+from . import join_utils as ju
+from . import query_utils as qu
+
+def get_tess_features(ticid, tic_store=None):
+    '''Query catalog data https://arxiv.org/pdf/1905.10694.pdf
+    If a local TICStore is given, the values are read from it (MAST is only
+    queried for TICs missing from the store).'''
     
 
     target = 'TIC '+str(int(ticid))
-    catalog_data = Catalogs.query_object(target, radius=0.02, catalog='TIC')
+    catalog_data = None
+    if type(tic_store) != type(None):
+        catalog_data = [tic_store.row(ticid)]
+    if type(catalog_data) == type(None) or catalog_data[0] is None:
+        catalog_data = Catalogs.query_object(target, radius=0.02, catalog='TIC')
     Teff = catalog_data[0]["Teff"]
 
     rad = catalog_data[0]["rad"]
@@ -130,152 +156,66 @@ def query_associated_catalogs(ticid):
     for i in ['HIP', 'TYC', 'UCAC', 'TWOMASS', 'ALLWISE', 'GAIA', 'KIC', 'APASS']:
         print(i + ' ' + str(res[i]) + '\n')
 
-def query_simbad_classifications(ticid_list, output_dir='./', suffix=''):
+def query_simbad_classifications(ticid_list, output_dir='./', suffix='',
+                                 tic_store=None, concurrency=8, rate=5.,
+                                 batch_size=200, cache_dir=None,
+                                 simbad_url=qu.SIMBAD_TAP_URL,
+                                 mast_url=qu.MAST_API_URL):
     '''Call like this:
     query_simbad_classifications([453370125.0, 356473029])
+    Classifications are appended to
+    output_dir+'all_simbad_classifications'+suffix+'.txt' (ticid,otypes,
+    main_id); targets already in that file are skipped.
+    Queries are batched and run concurrently (see query_utils):
+        * concurrency : maximum number of requests in flight
+        * rate : maximum requests per second
+        * cache_dir : on-disk response cache (default:
+                      output_dir+'query_cache/'), so an interrupted run
+                      resumes without repeating requests
+        * simbad_url, mast_url : service endpoints (e.g. a local stub)
+    If a local TICStore is given, cross-match identifiers are read from it
+    instead of querying MAST.
     '''
-    import time
-    
-    customSimbad = Simbad()
-    customSimbad.add_votable_fields('otypes')
-    # customSimbad.add_votable_fields('biblio')
-    
-    ticid_simbad = []
-    otypes_simbad = []
-    main_id_simbad = []
-    bibcode_simbad = []
-    
-    with open(output_dir + 'all_simbad_classifications'+suffix+'.txt', 'a') as f:
-        f.write('')    
-    
-    with open(output_dir + 'all_simbad_classifications'+suffix+'.txt', 'r') as f:
-        lines = f.readlines()
-        ticid_already_classified = []
-        for line in lines:
-            ticid_already_classified.append(float(line.split(',')[0]))
-    
+    fname = output_dir + 'all_simbad_classifications'+suffix+'.txt'
+    ticid_already_classified = set()
+    if os.path.exists(fname):
+        with open(fname, 'r') as f:
+            for line in f:
+                if len(line.strip()) > 0:
+                    ticid_already_classified.add(int(float(line.split(',')[0])))
+    ticid_list = [int(tic) for tic in ticid_list \
+                  if int(tic) not in ticid_already_classified]
+    print('Skipping '+str(len(ticid_already_classified))+\
+          ' classified targets, querying '+str(len(ticid_list)))
 
-    for tic in ticid_list:
-        
-        res=None
-        
-        while res is None:
-            try:
-                if tic in ticid_already_classified:
-                    print('Skipping TIC')
-                    
-                else:
-                    print('get coords for TIC' + str(int(tic)))
-                    
-                    # >> get coordinates
-                    target = 'TIC ' + str(int(tic))
-                    catalog_data = Catalogs.query_object(target, radius=0.02,
-                                                         catalog='TIC')[0]
-                    # time.sleep(6)
-            
-                    
-                    # -- get object type from Simbad --------------------------------------
-                    
-                    # >> first just try querying the TICID
-                    res = customSimbad.query_object(target)
-                    # time.sleep(6)
-                    
-                    # >> if no luck with that, try checking other IDs
-                    if type(res) == type(None):
-                        if type(catalog_data['TYC']) != np.ma.core.MaskedConstant:
-                            target_new = 'TYC ' + str(catalog_data['TYC'])
-                            res = customSimbad.query_object(target_new)
-                            # time.sleep(6)
-                            
-                    if type(res) == type(None):
-                        if type(catalog_data['HIP']) != np.ma.core.MaskedConstant:
-                            target_new = 'HIP ' + str(catalog_data['HIP'])
-                            res = customSimbad.query_object(target_new)
-                            # time.sleep(6)
-            
-                    # # >> UCAC not added to Simbad yet
-                    # if type(res) == type(None):
-                    #     if type(catalog_data['UCAC']) != np.ma.core.MaskedConstant:
-                    #         target_new = 'UCAC ' + str(catalog_data['UCAC'])
-                    #         res = customSimbad.query_object(target_new)
-                            
-                    if type(res) == type(None):
-                        if type(catalog_data['TWOMASS']) != np.ma.core.MaskedConstant:
-                            target_new = '2MASS ' + str(catalog_data['TWOMASS'])
-                            res = customSimbad.query_object(target_new)     
-                            # time.sleep(6)
-            
-                    if type(res) == type(None):
-                        if type(catalog_data['SDSS']) != np.ma.core.MaskedConstant:
-                            target_new = 'SDSS ' + str(catalog_data['SDSS'])
-                            res = customSimbad.query_object(target_new) 
-                            # time.sleep(6)
-            
-                    if type(res) == type(None):
-                        if type(catalog_data['ALLWISE']) != np.ma.core.MaskedConstant:
-                            target_new = 'ALLWISE ' + str(catalog_data['ALLWISE'])
-                            res = customSimbad.query_object(target_new)
-                            # time.sleep(6)
-                            
-                    if type(res) == type(None):
-                        if type(catalog_data['GAIA']) != np.ma.core.MaskedConstant:
-                            target_new = 'Gaia ' + str(catalog_data['GAIA'])
-                            res = customSimbad.query_object(target_new)      
-                            # time.sleep(6)
-                            
-                    if type(res) == type(None):
-                        if type(catalog_data['APASS']) != np.ma.core.MaskedConstant:
-                            target_new = 'APASS ' + str(catalog_data['APASS'])
-                            res = customSimbad.query_object(target_new)        
-                            # time.sleep(6)
-                            
-                    if type(res) == type(None):
-                        if type(catalog_data['KIC']) != np.ma.core.MaskedConstant:
-                            target_new = 'KIC ' + str(catalog_data['KIC'])
-                            res = customSimbad.query_object(target_new)    
-                            # time.sleep(6)
-                    
-                    # # >> if still nothing, query with coordinates
-                    # if type(res) == type(None):
-                    #     ra = catalog_data['ra']
-                    #     dec = catalog_data['dec']            
-                    #     coords = coord.SkyCoord(ra, dec, unit=(u.deg, u.deg))
-                    #     res = customSimbad.query_region(coords, radius='0d0m2s')         
-                    #     time.sleep(6)
-                    
-                    if type(res) == type(None):
-                        print('failed :(')
-                        res=0
-                        with open(output_dir + 'all_simbad_classifications'+suffix+'.txt', 'a') as f:
-                            f.write('{},{},{}\n'.format(tic, '', ''))              
-                        ticid_simbad.append(tic)
-                        otypes_simbad.append('none')
-                        main_id_simbad.append('none')                
-                    else:
-                        otypes = res['OTYPES'][0].decode('utf-8')
-                        main_id = res['MAIN_ID'].data[0].decode('utf-8')
-                        ticid_simbad.append(tic)
-                        otypes_simbad.append(otypes)
-                        main_id_simbad.append(main_id)
-                        
-                        with open(output_dir + 'all_simbad_classifications'+suffix+'.txt', 'a') as f:
-                            f.write('{},{},{}\n'.format(tic, otypes, main_id))
-                            
-                    # time.sleep(6)
-            except:
-                pass
-                print('connection failed! Trying again now')
-                    
-                    
-            
-    return ticid_simbad, otypes_simbad, main_id_simbad
+    if type(cache_dir) == type(None):
+        cache_dir = output_dir+'query_cache/'
+    client = qu.AsyncQueryClient(concurrency=concurrency, rate=rate,
+                                 cache_dir=cache_dir)
+    try:
+        res = qu.run_async(qu.classify_ticids(client, ticid_list,
+                                              tic_store=tic_store,
+                                              batch_size=batch_size,
+                                              out_fname=fname,
+                                              simbad_url=simbad_url,
+                                              mast_url=mast_url))
+    finally:
+        client.close()
+    client.report()
+    return res
         
 
 
 def query_vizier(ticid_list=None, out='./SectorX_GCVS.txt', catalog='gcvs',
                  dat_dir = '/Users/studentadmin/Dropbox/TESS_UROP/data/',
-                 sector=20):
-    '''http://www.sai.msu.su/gcvs/gcvs/vartype.htm'''
+                 sector=20, catalog_fname=None, tic_store=None, tol=10.8):
+    '''http://www.sai.msu.su/gcvs/gcvs/vartype.htm
+    If catalog_fname (a local csv dump of the catalog, with columns RAJ2000,
+    DEJ2000, VarType and VarName) is given, all targets are cross-matched
+    at once within tol arcsec (see cross_match_catalog) instead of one
+    Vizier query per target. Target coordinates are read from tic_store if
+    given, else queried from MAST in batches. The nearest neighbors are
+    cached next to out (<out>_xmatch.npz).'''
     
     # Vizier.ROW_LIMIT=-1
     # catalog_list=Vizier.find_catalogs('B/gcvs')
@@ -286,6 +226,31 @@ def query_vizier(ticid_list=None, out='./SectorX_GCVS.txt', catalog='gcvs',
         flux, x, ticid_list, target_info = \
             load_data_from_metafiles(dat_dir, sector, DEBUG=False,
                                      nan_mask_check=False)        
+
+    if type(catalog_fname) != type(None):
+        import pandas as pd
+        ticid_list = np.asarray(ticid_list).astype('int')
+        if type(tic_store) != type(None):
+            radec = tic_store.lookup(ticid_list, ['ra', 'dec'], as_array=True)
+        else:
+            client = qu.AsyncQueryClient()
+            try:
+                rows, failed = qu.run_async(qu.query_mast_tic(client,
+                                                              ticid_list))
+            finally:
+                client.close()
+            radec = np.array([[rows[t]['ra'], rows[t]['dec']] if t in rows \
+                              else [np.nan, np.nan] for t in ticid_list],
+                             dtype=np.float64)
+        data = pd.read_csv(catalog_fname)
+        sep, ind = cross_match_catalog(ticid_list, radec[:,0], radec[:,1],
+                                       data, out=out, tol=tol,
+                                       cache_fname=os.path.splitext(out)[0]+\
+                                       '_xmatch.npz')
+        match = np.nonzero(sep < tol)[0]
+        return list(ticid_list[match]), \
+            list(np.asarray(data['VarType']).astype('str')[ind[match]]), \
+            list(np.asarray(data['VarName']).astype('str')[ind[match]])
     
     ticid_viz = []
     otypes_viz = []
@@ -568,3 +533,308 @@ def get_true_classifications(ticid_list,
                     
     # >> check for any repeats
     return np.array(class_info)
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Local TIC store :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+# >> cross-match identifiers and flags, kept as strings (e.g. GAIA source ids
+# >> do not fit in a float64)
+TIC_STR_COLUMNS = ['HIP', 'TYC', 'UCAC', 'TWOMASS', 'SDSS', 'ALLWISE', 'GAIA',
+                   'APASS', 'KIC', 'objType', 'typeSrc', 'version', 'POSflag',
+                   'PMflag', 'TESSflag', 'SPFlag', 'lumclass', 'disposition',
+                   'duplicate_id', 'wdflag', 'splists']
+
+def read_ctl_header(fname):
+    '''Column names from a CTL/TIC header file (e.g.
+    exo_CTL_08.01xTIC_v8.1_header.csv, with entries like [ID]).'''
+    columns = np.loadtxt(fname, dtype='str', delimiter=',')
+    columns = np.char.replace(columns, '[', '')
+    columns = np.char.split(columns, ']')
+    return [x[0] for x in columns]
+
+def build_tic_store(path, csv_fnames, columns=None, header_fname=None,
+                    str_columns=TIC_STR_COLUMNS):
+    '''Builds a local TIC subset store from downloaded CTL/TIC csv files
+    (e.g. the SectorX tic_cat.csv files, or the CTL files with a separate
+    header file), so that catalog values can be looked up without per-target
+    MAST queries.
+    Parameters:
+        * path : output directory
+        * csv_fnames : list of csv files. Rows with the same ID are kept once
+        * columns : columns to keep (default: all)
+        * header_fname : header file, for csv files without a header row
+    Layout: ID.npy (sorted TICIDs), one <column>.npy per column (float64, or
+    unicode for str_columns and non-numeric columns), Tmag_order.npy (rows
+    sorted by Tmag) and Tmag_sorted.npy (the sorted magnitudes), for
+    magnitude scans, and meta.json.
+    Returns: TICStore'''
+    import pandas as pd
+    names = None
+    if type(header_fname) != type(None):
+        names = read_ctl_header(header_fname)
+    dtypes = {c: str for c in str_columns}
+    tables = []
+    for fname in csv_fnames:
+        print('Reading '+fname)
+        table = pd.read_csv(fname, names=names, header=None if names else 0,
+                            dtype=dtypes, index_col=False, low_memory=False)
+        if type(columns) != type(None):
+            table = table[[c for c in columns if c != 'ID'] + ['ID']]
+        tables.append(table)
+    table = pd.concat(tables, ignore_index=True)
+    table = table.drop_duplicates(subset='ID')
+    table = table.sort_values('ID')
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    np.save(path+'ID.npy', table['ID'].to_numpy().astype('int64'))
+    meta = {'columns': [], 'str_columns': []}
+    for col in table.columns:
+        if col == 'ID':
+            continue
+        values = table[col]
+        if col not in str_columns:
+            numeric = pd.to_numeric(values, errors='coerce')
+            if numeric.notna().sum() == values.notna().sum():
+                np.save(path+col+'.npy', numeric.to_numpy(dtype=np.float64))
+                meta['columns'].append(col)
+                continue
+        np.save(path+col+'.npy', values.fillna('').to_numpy().astype('str'))
+        meta['columns'].append(col)
+        meta['str_columns'].append(col)
+    if 'Tmag' in meta['columns']:
+        tmag = np.load(path+'Tmag.npy')
+        order = np.argsort(tmag, kind='stable')
+        np.save(path+'Tmag_order.npy', order)
+        np.save(path+'Tmag_sorted.npy', tmag[order])
+    with open(path+'meta.json', 'w') as f:
+        json.dump(meta, f)
+    print('Saved '+path+' ('+str(len(table))+' TICs)')
+    return TICStore(path)
+
+class TICStore(object):
+    '''Local TIC subset built with build_tic_store. Columns are memory-mapped
+    and loaded on first use.
+
+    Example:
+        store = load_tic_store(data_dir+'tic_store/')
+        feats = store.lookup(ticid, ['Teff', 'rad', 'mass', 'GAIAmag', 'd'],
+                             as_array=True)
+        ticid, tmag = store.magnitude_scan(10, 12, objType='STAR')'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path+'meta.json', 'r') as f:
+            self.meta = json.load(f)
+        self.ticid = np.load(path+'ID.npy', mmap_mode='r')
+        self._cols = {}
+
+    def __len__(self):
+        return len(self.ticid)
+
+    @property
+    def columns(self):
+        return self.meta['columns']
+
+    def column(self, col):
+        if col not in self._cols:
+            if col not in self.meta['columns']:
+                raise ValueError('No column '+col+' in TIC store '+self.path)
+            self._cols[col] = np.load(self.path+col+'.npy', mmap_mode='r')
+        return self._cols[col]
+
+    def rows(self, ticid):
+        '''Row of each TICID, or -1 if it is not in the store.'''
+        return ju.match_ticid(np.atleast_1d(ticid), self.ticid)
+
+    def lookup(self, ticid, columns=['Teff', 'rad', 'mass', 'GAIAmag', 'd'],
+               as_array=False, verbose=True):
+        '''Catalog values of every TICID, in the order of ticid. Missing
+        TICIDs get nan (numeric columns) or '' (string columns) and are
+        reported.
+        Returns: dictionary {column: values}, or, if as_array, a float array
+                 with shape=(len(ticid), len(columns))'''
+        rows = self.rows(ticid)
+        found = rows >= 0
+        if verbose and not np.all(found):
+            ju.report_missing(np.atleast_1d(ticid)[~found], name='TIC store',
+                              total=len(rows))
+        out = {}
+        for col in columns:
+            values = self.column(col)
+            fill = '' if col in self.meta['str_columns'] else np.nan
+            res = np.full(len(rows), fill, dtype=values.dtype)
+            res[found] = values[rows[found]]
+            out[col] = res
+        if as_array:
+            return np.stack([out[col].astype(np.float64) for col in columns],
+                            axis=1)
+        return out
+
+    def row(self, ticid):
+        '''All columns of one TIC, with np.ma.masked for empty values (like
+        a row of Catalogs.query_object), or None if it is not in the store.'''
+        ind = self.rows(ticid)[0]
+        if ind < 0:
+            return None
+        res = {'ID': int(self.ticid[ind])}
+        for col in self.columns:
+            value = self.column(col)[ind]
+            if (col in self.meta['str_columns'] and value == '') or \
+               (col not in self.meta['str_columns'] and np.isnan(value)):
+                value = np.ma.masked
+            res[col] = value
+        return res
+
+    def magnitude_scan(self, lowermag, uppermag, n=None, objType=None):
+        '''TICs with lowermag <= Tmag <= uppermag, sorted by Tmag (binary
+        search on the sorted magnitudes, so only the rows in range are read).
+        Returns: ticid, tmag (the first n, if n is given)'''
+        order = np.load(self.path+'Tmag_order.npy', mmap_mode='r')
+        tmag = self.column('Tmag')
+        if not os.path.exists(self.path+'Tmag_sorted.npy'):
+            # >> stores built without the sorted magnitudes: save them once
+            np.save(self.path+'Tmag_sorted.npy', tmag[order])
+        srt = np.load(self.path+'Tmag_sorted.npy', mmap_mode='r')
+        lo, hi = np.searchsorted(srt, min(lowermag, uppermag), side='left'), \
+            np.searchsorted(srt, max(lowermag, uppermag), side='right')
+        rows = np.asarray(order[lo:hi])
+        if type(objType) != type(None):
+            rows = rows[self.column('objType')[rows] == objType]
+        if type(n) != type(None):
+            rows = rows[:n]
+        return np.asarray(self.ticid[rows]), np.asarray(tmag[rows])
+
+def load_tic_store(path):
+    return TICStore(path)
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Cross-matching ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def sexagesimal_to_deg(values, hours=False):
+    '''Converts coordinates given as 'dd mm ss.s' or 'dd:mm:ss.s' strings to
+    degrees (numeric values are returned as they are, in degrees). Set hours
+    for right ascensions in hours (e.g. RAJ2000 of GCVS). Empty entries are
+    nan.'''
+    values = np.asarray(values)
+    if values.dtype.kind in 'fiu':
+        deg = values.astype(np.float64)
+    else:
+        parts = np.char.split(np.char.replace(values.astype('str'), ':', ' '))
+        deg = np.full(len(parts), np.nan)
+        for i, p in enumerate(parts):
+            if len(p) == 0 or p[0] in ['nan', '--']:
+                continue
+            sign = -1. if p[0].startswith('-') else 1.
+            vals = [abs(float(p[0]))] + [float(x) for x in p[1:3]]
+            deg[i] = sign * sum([v/60.**j for j, v in enumerate(vals)])
+    if hours:
+        deg = deg * 15.
+    return deg
+
+def radec_to_unit(ra, dec):
+    '''Unit vectors (shape=(N, 3)) of sky positions in degrees.'''
+    ra = np.radians(np.asarray(ra, dtype=np.float64))
+    dec = np.radians(np.asarray(dec, dtype=np.float64))
+    return np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra),
+                     np.sin(dec)], axis=1)
+
+def cross_match(ra, dec, cat_ra, cat_dec, tol=None, n_jobs=-1):
+    '''Nearest catalog object to every target on the sphere, found with a
+    KD-tree of unit vectors (chord distance is monotonic in angular
+    separation), so a sector is matched in O((N+M) log M) instead of one
+    separation computation per target against the whole catalog.
+    Parameters:
+        * ra, dec : target coordinates (degrees)
+        * cat_ra, cat_dec : catalog coordinates (degrees)
+        * tol : if given (arcsec), only matches within tol are searched for;
+                targets without one get sep=inf
+    Returns:
+        * sep : separation to the nearest catalog object (arcsec, nan for
+                targets without coordinates)
+        * ind : its row in the catalog (-1 if none)'''
+    from scipy.spatial import cKDTree
+    cat = radec_to_unit(cat_ra, cat_dec)
+    cat_rows = np.nonzero(np.all(np.isfinite(cat), axis=1))[0]
+    xyz = radec_to_unit(ra, dec)
+    valid = np.nonzero(np.all(np.isfinite(xyz), axis=1))[0]
+
+    if type(tol) == type(None):
+        bound = np.inf
+    else:
+        bound = 2*np.sin(np.radians(tol/3600.)/2) * (1+1e-9)
+    chord, nearest = cKDTree(cat[cat_rows]).query(xyz[valid], k=1,
+                                                  distance_upper_bound=bound,
+                                                  workers=n_jobs)
+    sep = np.full(len(xyz), np.nan)
+    ind = -np.ones(len(xyz), dtype='int')
+    found = np.isfinite(chord)
+    sep[valid] = np.inf
+    sep[valid[found]] = np.degrees(2*np.arcsin(np.minimum(chord[found]/2, 1.)))\
+                        * 3600.
+    ind[valid[found]] = cat_rows[nearest[found]]
+    return sep, ind
+
+def cached_cross_match(fname, ra, dec, cat_ra, cat_dec, tol=None):
+    '''cross_match, saved to fname (npz) and loaded from it when the
+    coordinates and tol are unchanged (e.g. one file per sector and
+    catalog).'''
+    import hashlib
+    h = hashlib.sha1()
+    for x in [ra, dec, cat_ra, cat_dec]:
+        h.update(np.ascontiguousarray(x, dtype=np.float64))
+    h.update(str(tol).encode())
+    key = h.hexdigest()
+    if os.path.exists(fname):
+        data = np.load(fname)
+        if str(data['key']) == key:
+            print('Loaded '+fname)
+            return data['sep'], data['ind']
+    sep, ind = cross_match(ra, dec, cat_ra, cat_dec, tol=tol)
+    np.savez(fname, sep=sep, ind=ind, key=key)
+    print('Saved '+fname)
+    return sep, ind
+
+def cross_match_catalog(ticid, ra, dec, catalog, out=None, tol=0.1,
+                        columns=['VarType', 'VarName'], ra_col='RAJ2000',
+                        dec_col='DEJ2000', ra_hours=True, cache_fname=None):
+    '''Cross-matches targets with a local catalog table.
+    Parameters:
+        * ticid, ra, dec : targets (degrees)
+        * catalog : table with named columns (e.g. a pandas DataFrame of a
+                    VizieR dump), or the file name of a csv
+        * tol : maximum separation (arcsec)
+        * columns : catalog columns written for matched targets
+        * ra_col, dec_col, ra_hours : catalog coordinate columns (sexagesimal
+                                      or degrees), RA in hours if ra_hours
+        * out : if given, one line per target is written,
+                'ticid,<columns>' (empty columns if not matched)
+        * cache_fname : npz cache of the nearest neighbors (see
+                        cached_cross_match)
+    Returns: sep (arcsec), ind : separation to and catalog row of the
+             nearest catalog object of every target (matched where
+             sep < tol)'''
+    if isinstance(catalog, str):
+        import pandas as pd
+        catalog = pd.read_csv(catalog)
+    cat_ra = sexagesimal_to_deg(catalog[ra_col], hours=ra_hours)
+    cat_dec = sexagesimal_to_deg(catalog[dec_col])
+    if type(cache_fname) != type(None):
+        sep, ind = cached_cross_match(cache_fname, ra, dec, cat_ra, cat_dec)
+    else:
+        sep, ind = cross_match(ra, dec, cat_ra, cat_dec)
+    match = sep < tol
+    print('Cross-matched '+str(np.count_nonzero(match))+' of '+\
+          str(len(ind))+' targets within '+str(tol)+' arcsec')
+
+    if type(out) != type(None):
+        values = [np.asarray(catalog[col]).astype('str') for col in columns]
+        with open(out, 'w') as f:
+            for i in range(len(ind)):
+                row = [values[j][ind[i]] if match[i] else '' \
+                       for j in range(len(columns))]
+                f.write(str(int(ticid[i]))+','+','.join(row)+'\n')
+        print('Saved '+out)
+    return sep, ind
@@ -0,0 +1,626 @@
+# -*- coding: utf-8 -*-
+"""
+cluster_utils.py
+
+Clustering sweeps that share work between parameter combinations.
+
+HDBSCAN
+* hdbscan_sweep
+* save_label_matrix
+* load_label_matrix
+
+Gaussian mixture model selection
+* gmm_select
+* save_gmm
+* load_gmm
+* gmm_matches
+
+Streaming (out-of-core) clustering
+* iter_shards
+* OnlineGMM
+* fit_streaming
+* predict_shards
+* save_stream_model
+* load_stream_model
+* stream_model_matches
+
+Per-cluster statistics (group-by)
+* GroupBy
+* encode
+* cluster_centr_dist
+* cluster_thresholds
+"""
+
+import numpy as np
+import time
+
+from . import metric_utils as mu
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: HDBSCAN :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def hdbscan_sweep(features, min_cluster_size=[10], min_samples=[10],
+                  metric=['euclidean'], p=[None], algorithm='best',
+                  cluster_selection_method='eom'):
+    '''Flat HDBSCAN clusterings for every combination of min_cluster_size,
+    min_samples, metric and p (p is only used for minkowski).
+
+    The mutual-reachability minimum spanning tree (and so the single linkage
+    tree) only depends on (metric, p, min_samples). It is built once per
+    combination, and the condensed tree is then cut for every
+    min_cluster_size.
+    Returns:
+        * params : list of (min_cluster_size, min_samples, metric, p)
+        * labels : int32 array, shape=(len(params), num light curves)
+        * times : seconds spent per parameter set (the spanning tree time is
+                  shared evenly between the min_cluster_size values)'''
+    import hdbscan
+    from hdbscan._hdbscan_tree import condense_tree, compute_stability, \
+        get_clusters
+
+    params, labels, times = [], [], []
+    for met in metric:
+        for p_val in (p if met == 'minkowski' else [None]):
+            for ms in min_samples:
+                start = time.time()
+                clusterer = hdbscan.HDBSCAN(min_cluster_size=\
+                                            int(np.min(min_cluster_size)),
+                                            min_samples=int(ms), metric=met,
+                                            p=p_val, algorithm=algorithm)
+                clusterer.fit(features)
+                tree = clusterer.single_linkage_tree_.to_numpy()
+                dur_tree = (time.time() - start) / len(min_cluster_size)
+
+                for mcs in min_cluster_size:
+                    start = time.time()
+                    condensed = condense_tree(tree, int(mcs))
+                    stability = compute_stability(condensed)
+                    res = get_clusters(condensed, stability,
+                                       cluster_selection_method=\
+                                       cluster_selection_method)
+                    params.append((mcs, ms, met, p_val))
+                    labels.append(res[0].astype('int32'))
+                    times.append(dur_tree + time.time() - start)
+
+    return params, np.array(labels, dtype='int32'), times
+
+def save_label_matrix(fname, ticid, labels, params):
+    '''Saves one clustering per row of labels to a single compressed .npz
+    file, together with the TICIDs (columns) and parameter sets (rows).'''
+    np.savez_compressed(fname, ticid=np.asarray(ticid), labels=labels,
+                        params=np.array([str(p) for p in params]))
+    print('Saved '+fname)
+
+def load_label_matrix(fname):
+    '''Returns ticid, labels and parameter sets saved by save_label_matrix.'''
+    with np.load(fname) as data:
+        return data['ticid'], data['labels'], list(data['params'])
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Gaussian mixture model selection ::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+_FEATURES = None # >> feature matrix shared by the GMM worker processes
+
+def _init_gmm_worker(features):
+    global _FEATURES
+    _FEATURES = features
+
+def _gmm_fit_task(args):
+    '''Fits (or continues fitting) one GMM on _FEATURES and returns it with
+    its BIC and AIC.'''
+    n, gmm, max_iter, kwargs = args
+    from sklearn.mixture import GaussianMixture
+    import warnings
+    from sklearn.exceptions import ConvergenceWarning
+    start = time.time()
+    if type(gmm) == type(None):
+        kwargs = dict(kwargs)
+        seed = kwargs.pop('seed')
+        n_subsample = kwargs.pop('n_subsample')
+        if seed == 'kmeans++':
+            # >> seed the means with k-means++ on a subsample
+            from sklearn.cluster import kmeans_plusplus
+            rng = np.random.default_rng(kwargs['random_state'])
+            sub = _FEATURES
+            if len(_FEATURES) > n_subsample:
+                sub = _FEATURES[rng.choice(len(_FEATURES), n_subsample,
+                                           replace=False)]
+            kwargs['means_init'], _ = \
+                kmeans_plusplus(sub, n, random_state=kwargs['random_state'])
+        gmm = GaussianMixture(n_components=n, warm_start=True, **kwargs)
+    gmm.max_iter = max_iter
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=ConvergenceWarning)
+        gmm.fit(_FEATURES)
+    return n, gmm, gmm.bic(_FEATURES), gmm.aic(_FEATURES), time.time()-start
+
+def _gmm_score_task(args):
+    gmm, exact_scores = args
+    labels = gmm.predict(_FEATURES)
+    if len(np.unique(labels)) > 1:
+        silhouette, ch, db, ci = mu.cluster_scores(_FEATURES, labels,
+                                                   exact=exact_scores,
+                                                   return_ci=True)
+        scores = (silhouette, ci[0], ci[1], ch, db)
+    else:
+        scores = (np.nan,)*5
+    return labels, scores
+
+def _gmm_map(func, tasks, features, n_jobs):
+    if n_jobs == 1:
+        _init_gmm_worker(features)
+        return [func(task) for task in tasks]
+    import multiprocessing as mp
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_jobs,
+                             mp_context=mp.get_context('spawn'),
+                             initializer=_init_gmm_worker,
+                             initargs=(features,)) as pool:
+        return list(pool.map(func, tasks))
+
+def gmm_select(features, n_components, n_jobs=1, seed='kmeans++',
+               n_subsample=10000, max_iter=100, early_iter=None,
+               keep_frac=0.5, covariance_type='full', random_state=0,
+               exact_scores=False):
+    '''Fits a Gaussian mixture model for each number of components in a
+    process pool and scores each fit.
+    Parameters:
+        * n_components : list of candidate numbers of components
+        * n_jobs : number of processes (the feature matrix is sent to each
+                   process once)
+        * seed : 'kmeans++' to seed the means with k-means++ on a subsample
+                 of n_subsample objects, or None for sklearn's default
+                 (k-means) initialization
+        * early_iter : if given, every candidate is first run for early_iter
+                       EM iterations, and only the keep_frac fraction with
+                       the lowest BIC are run to convergence (warm-started);
+                       the others are rejected and not scored
+        * exact_scores : see metric_utils.cluster_scores
+    Returns: list with one dictionary per candidate (in the order of
+             n_components) with keys n_components, gmm, labels, bic, aic,
+             silhouette, silhouette_lower, silhouette_upper (confidence
+             interval of the silhouette score), ch, db, time and rejected'''
+    kwargs = {'covariance_type': covariance_type,
+              'random_state': random_state, 'seed': seed,
+              'n_subsample': n_subsample}
+
+    if type(early_iter) == type(None):
+        tasks = [(n, None, max_iter, kwargs) for n in n_components]
+    else:
+        tasks = [(n, None, early_iter, kwargs) for n in n_components]
+    fits = _gmm_map(_gmm_fit_task, tasks, features, n_jobs)
+
+    rejected = np.zeros(len(fits), dtype='bool')
+    if type(early_iter) != type(None):
+        # >> early rejection by BIC, then continue the survivors
+        bic = np.array([f[2] for f in fits])
+        n_keep = max(1, int(np.ceil(keep_frac*len(fits))))
+        rejected[np.argsort(bic)[n_keep:]] = True
+        keep = np.nonzero(~rejected)[0]
+        print('Rejected '+str(np.count_nonzero(rejected))+' of '+\
+              str(len(fits))+' candidates after '+str(early_iter)+\
+              ' iterations')
+        tasks = [(fits[i][0], fits[i][1], max(max_iter-early_iter, 1), kwargs) \
+                 for i in keep]
+        for i, f in zip(keep, _gmm_map(_gmm_fit_task, tasks, features,
+                                       n_jobs)):
+            fits[i] = f[:4] + (fits[i][4] + f[4],)
+
+    keep = np.nonzero(~rejected)[0]
+    scored = _gmm_map(_gmm_score_task,
+                      [(fits[i][1], exact_scores) for i in keep],
+                      features, n_jobs)
+
+    results = []
+    for i in range(len(fits)):
+        n, gmm, bic, aic, dur = fits[i]
+        res = {'n_components': n, 'gmm': gmm, 'bic': bic, 'aic': aic,
+               'time': dur, 'rejected': rejected[i], 'labels': None,
+               'silhouette': np.nan, 'silhouette_lower': np.nan,
+               'silhouette_upper': np.nan, 'ch': np.nan, 'db': np.nan}
+        if not rejected[i]:
+            labels, scores = scored[list(keep).index(i)]
+            res['labels'] = labels
+            res['silhouette'], res['silhouette_lower'], \
+                res['silhouette_upper'], res['ch'], res['db'] = scores
+        results.append(res)
+    return results
+
+def _features_key(features):
+    import hashlib
+    h = hashlib.sha1(np.ascontiguousarray(features, dtype=np.float64))
+    h.update(str(np.shape(features)).encode())
+    return h.hexdigest()
+
+def save_gmm(gmm, fname, features=None):
+    '''Saves the fitted parameters of a GaussianMixture to a .npz file. If
+    the features the model was fitted on are given, their fingerprint is
+    saved too (see gmm_matches).'''
+    key = '' if type(features) == type(None) else _features_key(features)
+    np.savez(fname, weights=gmm.weights_, means=gmm.means_,
+             covariances=gmm.covariances_,
+             precisions_cholesky=gmm.precisions_cholesky_,
+             covariance_type=np.array(gmm.covariance_type),
+             n_features=gmm.means_.shape[1], features_key=np.array(key))
+    print('Saved '+fname)
+
+def gmm_matches(fname, features):
+    '''Whether the model saved in fname by save_gmm was fitted on features
+    (same number of features and same fingerprint). Models saved without a
+    fingerprint never match.'''
+    with np.load(fname) as data:
+        if 'features_key' not in data or \
+           int(data['n_features']) != np.shape(features)[1]:
+            return False
+        return str(data['features_key']) == _features_key(features)
+
+def load_gmm(fname):
+    '''Loads a GaussianMixture saved by save_gmm, ready for predict.'''
+    from sklearn.mixture import GaussianMixture
+    with np.load(fname) as data:
+        gmm = GaussianMixture(n_components=len(data['weights']),
+                              covariance_type=str(data['covariance_type']))
+        gmm.weights_ = data['weights']
+        gmm.means_ = data['means']
+        gmm.covariances_ = data['covariances']
+        gmm.precisions_cholesky_ = data['precisions_cholesky']
+    if gmm.covariance_type == 'full':
+        gmm.precisions_ = np.array([p @ p.T for p in \
+                                    gmm.precisions_cholesky_])
+    elif gmm.covariance_type == 'tied':
+        gmm.precisions_ = gmm.precisions_cholesky_ @ \
+                          gmm.precisions_cholesky_.T
+    else:
+        gmm.precisions_ = gmm.precisions_cholesky_**2
+    gmm.converged_ = True
+    gmm.n_iter_ = 0
+    gmm.lower_bound_ = np.nan
+    gmm.n_features_in_ = gmm.means_.shape[1]
+    return gmm
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Streaming (out-of-core) clustering ::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def iter_shards(shards, chunk_size=10000):
+    '''Yields chunks of at most chunk_size rows from a list of feature
+    shards. Each shard is an array or the path to a .npy file, which is
+    memory-mapped so that only one chunk is read into memory at a time.'''
+    for shard in shards:
+        if type(shard) == type(str()):
+            shard = np.load(shard, mmap_mode='r')
+        for start in range(0, len(shard), chunk_size):
+            yield np.asarray(shard[start:start+chunk_size], dtype=np.float64)
+
+class OnlineGMM(object):
+    '''Gaussian mixture model fitted by online (stochastic) EM, so that it
+    can be trained on feature shards that do not fit in memory. Running
+    averages of the sufficient statistics are updated with step size
+    (t + t0)**(-kappa) after each chunk (Cappe & Moulines 2009).
+
+    The fitted attributes (weights_, means_, covariances_) follow
+    sklearn.mixture.GaussianMixture, and to_gmm returns an equivalent
+    GaussianMixture.'''
+
+    def __init__(self, n_components=100, covariance_type='full', kappa=0.6,
+                 t0=2, reg_covar=1e-6, n_init_iter=20, random_state=0):
+        self.n_components = n_components
+        self.covariance_type = covariance_type
+        self.kappa = kappa
+        self.t0 = t0
+        self.reg_covar = reg_covar
+        self.n_init_iter = n_init_iter
+        self.random_state = random_state
+        self.n_steps_ = 0
+
+    def _init_from_chunk(self, X):
+        from sklearn.mixture import GaussianMixture
+        import warnings
+        from sklearn.exceptions import ConvergenceWarning
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=ConvergenceWarning)
+            gmm = GaussianMixture(n_components=self.n_components,
+                                  covariance_type=self.covariance_type,
+                                  max_iter=self.n_init_iter,
+                                  reg_covar=self.reg_covar,
+                                  random_state=self.random_state).fit(X)
+        self.weights_ = gmm.weights_
+        self.means_ = gmm.means_
+        self.covariances_ = gmm.covariances_
+        # >> sufficient statistics: weights, first and second moments
+        self.s0_ = self.weights_.copy()
+        self.s1_ = self.weights_[:,None] * self.means_
+        if self.covariance_type == 'full':
+            self.s2_ = self.weights_[:,None,None] * \
+                (self.covariances_ + np.einsum('ki,kj->kij', self.means_,
+                                               self.means_))
+        else:
+            self.s2_ = self.weights_[:,None] * \
+                (self.covariances_ + self.means_**2)
+
+    def _estimate_log_prob(self, X):
+        n, d = X.shape
+        log_prob = np.empty((n, self.n_components))
+        for k in range(self.n_components):
+            diff = X - self.means_[k]
+            if self.covariance_type == 'full':
+                chol = np.linalg.cholesky(self.covariances_[k])
+                sol = np.linalg.solve(chol, diff.T)
+                maha = np.sum(sol**2, axis=0)
+                logdet = 2*np.sum(np.log(np.diag(chol)))
+            else:
+                maha = np.sum(diff**2 / self.covariances_[k], axis=1)
+                logdet = np.sum(np.log(self.covariances_[k]))
+            log_prob[:,k] = -0.5*(d*np.log(2*np.pi) + logdet + maha)
+        return log_prob + np.log(self.weights_)
+
+    def _estimate_resp(self, X):
+        from scipy.special import logsumexp
+        log_prob = self._estimate_log_prob(X)
+        log_norm = logsumexp(log_prob, axis=1)
+        return np.exp(log_prob - log_norm[:,None]), log_norm
+
+    def partial_fit(self, X):
+        '''One online EM step on a chunk of features.'''
+        X = np.asarray(X, dtype=np.float64)
+        if not hasattr(self, 'means_'):
+            self._init_from_chunk(X)
+            self.n_steps_ = 1
+            return self
+
+        # >> E-step on the chunk, then step the sufficient statistics
+        resp, _ = self._estimate_resp(X)
+        rho = (self.n_steps_ + self.t0)**(-self.kappa)
+        self.s0_ = (1-rho)*self.s0_ + rho*np.mean(resp, axis=0)
+        self.s1_ = (1-rho)*self.s1_ + rho*(resp.T @ X)/len(X)
+        if self.covariance_type == 'full':
+            s2 = np.einsum('nk,ni,nj->kij', resp, X, X)/len(X)
+        else:
+            s2 = (resp.T @ X**2)/len(X)
+        self.s2_ = (1-rho)*self.s2_ + rho*s2
+        self.n_steps_ += 1
+
+        # >> M-step
+        s0 = np.maximum(self.s0_, 10*np.finfo(float).eps)
+        self.weights_ = s0 / np.sum(s0)
+        self.means_ = self.s1_ / s0[:,None]
+        if self.covariance_type == 'full':
+            d = X.shape[1]
+            self.covariances_ = self.s2_ / s0[:,None,None] - \
+                np.einsum('ki,kj->kij', self.means_, self.means_) + \
+                self.reg_covar*np.eye(d)
+        else:
+            self.covariances_ = np.maximum(self.s2_ / s0[:,None] - \
+                                           self.means_**2, 0) + self.reg_covar
+        return self
+
+    def fit(self, shards, n_epochs=1, chunk_size=10000):
+        for epoch in range(n_epochs):
+            for chunk in iter_shards(shards, chunk_size=chunk_size):
+                self.partial_fit(chunk)
+        return self
+
+    def predict_proba(self, X):
+        return self._estimate_resp(np.asarray(X, dtype=np.float64))[0]
+
+    def predict(self, X):
+        return np.argmax(self._estimate_log_prob(np.asarray(X,
+                                                            dtype=np.float64)),
+                         axis=1)
+
+    def score_samples(self, X):
+        return self._estimate_resp(np.asarray(X, dtype=np.float64))[1]
+
+    def to_gmm(self):
+        '''Returns an equivalent fitted sklearn GaussianMixture.'''
+        from sklearn.mixture import GaussianMixture
+        gmm = GaussianMixture(n_components=self.n_components,
+                              covariance_type=self.covariance_type)
+        gmm.weights_ = self.weights_
+        gmm.means_ = self.means_
+        gmm.covariances_ = self.covariances_
+        if self.covariance_type == 'full':
+            chol = np.linalg.cholesky(self.covariances_)
+            eye = np.eye(self.means_.shape[1])
+            gmm.precisions_cholesky_ = np.array( \
+                [np.linalg.solve(c, eye).T for c in chol])
+            gmm.precisions_ = np.array([p @ p.T for p in \
+                                        gmm.precisions_cholesky_])
+        else:
+            gmm.precisions_cholesky_ = 1. / np.sqrt(self.covariances_)
+            gmm.precisions_ = 1. / self.covariances_
+        gmm.converged_ = True
+        gmm.n_iter_ = self.n_steps_
+        gmm.lower_bound_ = np.nan
+        gmm.n_features_in_ = self.means_.shape[1]
+        return gmm
+
+def fit_streaming(shards, n_clusters=100, method='minibatch_kmeans',
+                  n_epochs=1, chunk_size=10000, random_state=0, **kwargs):
+    '''Fits a clustering model chunk by chunk on feature shards.
+    Parameters:
+        * shards : list of arrays or paths to .npy files, e.g. CAE
+                   bottlenecks of each sector
+        * method : 'minibatch_kmeans' (sklearn MiniBatchKMeans) or
+                   'online_gmm' (OnlineGMM)
+        * n_epochs : number of passes over the shards
+        * kwargs : passed to the model
+    Returns: fitted model (supports predict)'''
+    if method == 'minibatch_kmeans':
+        from sklearn.cluster import MiniBatchKMeans
+        model = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state,
+                                **kwargs)
+    elif method == 'online_gmm':
+        model = OnlineGMM(n_components=n_clusters, random_state=random_state,
+                          **kwargs)
+    else:
+        raise ValueError('Unknown streaming clustering method '+method)
+
+    for epoch in range(n_epochs):
+        for chunk in iter_shards(shards, chunk_size=chunk_size):
+            # >> OnlineGMM sets n_steps_ = 0 until its first partial_fit
+            if len(chunk) < n_clusters and \
+               getattr(model, 'n_steps_', 0) == 0 and \
+               not hasattr(model, 'cluster_centers_'):
+                raise ValueError('First chunk has fewer rows than clusters')
+            model.partial_fit(chunk)
+    return model
+
+def predict_shards(model, shards, chunk_size=10000):
+    '''Cluster labels for every row of the feature shards (e.g. a new
+    sector), without refitting.'''
+    labels = [model.predict(chunk) for chunk in \
+              iter_shards(shards, chunk_size=chunk_size)]
+    if len(labels) == 0:
+        return np.empty(0, dtype='int')
+    return np.concatenate(labels)
+
+def _shards_key(shards, chunk_size=10000):
+    # >> same fingerprint as _features_key of the concatenated shards
+    import hashlib
+    h = hashlib.sha1()
+    n, n_features = 0, 0
+    for chunk in iter_shards(shards, chunk_size=chunk_size):
+        h.update(np.ascontiguousarray(chunk))
+        n, n_features = n + len(chunk), chunk.shape[1]
+    h.update(str((n, n_features)).encode())
+    return h.hexdigest()
+
+def save_stream_model(model, fname, shards=None):
+    '''Saves a model returned by fit_streaming (pickle). If the feature
+    shards the model was fitted on are given, their fingerprint is saved
+    too (see stream_model_matches).'''
+    import pickle
+    key = '' if type(shards) == type(None) else _shards_key(shards)
+    with open(fname, 'wb') as f:
+        pickle.dump({'model': model, 'features_key': key}, f)
+    print('Saved '+fname)
+
+def _load_stream_pickle(fname):
+    import pickle
+    with open(fname, 'rb') as f:
+        data = pickle.load(f)
+    if not isinstance(data, dict): # >> saved without a fingerprint
+        data = {'model': data, 'features_key': ''}
+    return data
+
+def load_stream_model(fname):
+    return _load_stream_pickle(fname)['model']
+
+def stream_model_matches(fname, shards):
+    '''Whether the model saved in fname by save_stream_model was fitted on
+    the feature shards (same fingerprint). Models saved without a
+    fingerprint never match.'''
+    key = _load_stream_pickle(fname)['features_key']
+    return key != '' and key == _shards_key(shards)
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Per-cluster statistics (group-by) :::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+class GroupBy(object):
+    '''Groups the rows of an array by label (e.g. cluster number), so that
+    per-group statistics are computed for all groups at once instead of
+    with one np.nonzero(labels == i) per group.
+    Attributes:
+        * keys : sorted unique labels
+        * codes : group number of each row (keys[codes] == labels)
+        * counts : number of rows in each group
+        * order : row numbers sorted by group (stable)
+        * bounds : rows of group k are order[bounds[k]:bounds[k+1]]'''
+
+    def __init__(self, labels):
+        self.keys, self.codes, self.counts = \
+            np.unique(labels, return_inverse=True, return_counts=True)
+        self.codes = self.codes.reshape(-1)
+        self.order = np.argsort(self.codes, kind='stable')
+        self.bounds = np.concatenate([[0], np.cumsum(self.counts)])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def rows(self, k):
+        '''Row numbers of group number k.'''
+        return self.order[self.bounds[k]:self.bounds[k+1]]
+
+    def sum(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 1:
+            return np.bincount(self.codes, weights=values,
+                               minlength=len(self.keys))
+        out = np.zeros((len(self.keys),)+values.shape[1:])
+        np.add.at(out, self.codes, values)
+        return out
+
+    def mean(self, values):
+        counts = self.counts.reshape((-1,)+(1,)*(np.ndim(values)-1))
+        return self.sum(values) / counts
+
+    def std(self, values):
+        '''Population standard deviation of each group (as np.std).'''
+        values = np.asarray(values, dtype=np.float64)
+        mean = self.mean(values)
+        counts = self.counts.reshape((-1,)+(1,)*(values.ndim-1))
+        return np.sqrt(self.sum((values - mean[self.codes])**2) / counts)
+
+    def median(self, values):
+        '''Median of each group (along axis 0 for 2-D values), from one
+        sort of (group, value) per column.'''
+        values = np.asarray(values, dtype=np.float64)
+        flat = values.reshape(len(values), -1)
+        lo = self.bounds[:-1] + (self.counts-1)//2
+        hi = self.bounds[:-1] + self.counts//2
+        out = np.empty((len(self.keys), flat.shape[1]))
+        for j in range(flat.shape[1]):
+            srt = flat[np.lexsort((flat[:,j], self.codes)), j]
+            out[:,j] = 0.5*(srt[lo] + srt[hi])
+        return out.reshape((len(self.keys),)+values.shape[1:])
+
+    def crosstab(self, other, weights=None):
+        '''Contingency table of the groups against a second labelling:
+        table[k, c] is the number of rows in group k with other == cats[c]
+        (or the sum of their weights, e.g. a boolean mask).
+        Returns: table, cats'''
+        cats, other_codes = np.unique(other, return_inverse=True)
+        other_codes = other_codes.reshape(-1)
+        table = np.bincount(self.codes*len(cats) + other_codes,
+                            weights=weights,
+                            minlength=len(self.keys)*len(cats))
+        return table.reshape(len(self.keys), len(cats)), cats
+
+def encode(values, categories):
+    '''Label encoding: index of each value in categories (e.g. numerized
+    object types), from one searchsorted instead of a search per value.'''
+    categories = np.asarray(categories)
+    values = np.asarray(values)
+    order = np.argsort(categories, kind='stable')
+    pos = np.searchsorted(categories[order], values)
+    pos = np.minimum(pos, len(categories)-1)
+    missing = categories[order][pos] != values
+    if np.any(missing):
+        raise ValueError('Unknown labels: '+\
+                         ', '.join(np.unique(values[missing]).astype('str')))
+    return order[pos]
+
+def cluster_centr_dist(feats, groups):
+    '''Median center of every cluster and the squared distance of each
+    point to the center of its own cluster (as clstr_centr, for all clusters
+    at once).
+    Parameters:
+        * groups : GroupBy of the cluster labels (or the labels)
+    Returns: centr, shape=(num clusters, num features), and dist,
+             shape=(num points,)'''
+    if not isinstance(groups, GroupBy):
+        groups = GroupBy(groups)
+    centr = groups.median(feats)
+    dist = np.sum((feats - centr[groups.codes])**2, axis=1)
+    return centr, dist
+
+def cluster_thresholds(dist, groups, t_std=2):
+    '''Distance threshold of every cluster: median + t_std * std of the
+    distances of its members to the cluster center.'''
+    if not isinstance(groups, GroupBy):
+        groups = GroupBy(groups)
+    return groups.median(dist) + t_std*groups.std(dist)
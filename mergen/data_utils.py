@@ -105,6 +105,12 @@ import numpy.ma as ma
 
 # import plotting_functions as pf
 from . import plot_utils as pt
+from . import neighbor_utils as nu
+from . import cluster_utils as cu
+from . import metric_utils as mu
+from . import catalog_utils as ct
+from . import otype_utils as ou
+from . import product_utils as pu
 
 # import sklearn
 # from sklearn.cluster import KMeans
@@ -1982,7 +1988,8 @@ def lc_from_bulk_download(fits_path, target_list, fname_out, fname_targets,
 
 
 
-def tic_list_by_magnitudes(path, lowermag, uppermag, n, filelabel):
+def tic_list_by_magnitudes(path, lowermag, uppermag, n, filelabel,
+                           tic_store=None):
     """ Creates a fits file of the first n TICs that fall between the given
     magnitude ranges. 
     parameters: 
@@ -1991,19 +1998,25 @@ def tic_list_by_magnitudes(path, lowermag, uppermag, n, filelabel):
         * upper magnitude limit
         * n - number of TICs you want
         * file label (what to call the fits file)
+        * tic_store - local TICStore (catalog_utils) to scan instead of
+          querying MAST
     modified [lcg 07082020]
     """
     from astropy.io import fits
     
-    catalog_data = Catalogs.query_criteria(catalog="Tic", Tmag=[uppermag, lowermag], objType="STAR")
+    if type(tic_store) != type(None):
+        sorted_ticids, sorted_tmags = \
+            tic_store.magnitude_scan(lowermag, uppermag, objType='STAR')
+    else:
+        catalog_data = Catalogs.query_criteria(catalog="Tic", Tmag=[uppermag, lowermag], objType="STAR")
 
-    T_mags = np.asarray(catalog_data["Tmag"], dtype= float)
-    TICIDS = np.asarray(catalog_data["ID"], dtype = int)
+        T_mags = np.asarray(catalog_data["Tmag"], dtype= float)
+        TICIDS = np.asarray(catalog_data["ID"], dtype = int)
     
-    tmag_index = np.argsort(T_mags)
+        tmag_index = np.argsort(T_mags)
     
-    sorted_tmags = T_mags[tmag_index]
-    sorted_ticids = TICIDS[tmag_index]
+        sorted_tmags = T_mags[tmag_index]
+        sorted_ticids = TICIDS[tmag_index]
     
     hdr = fits.Header() # >> make the header
     hdu = fits.PrimaryHDU(sorted_ticids[0:n], header=hdr)
@@ -2564,7 +2577,7 @@ def create_save_featvec_homogenous_time(yourpath, times, intensities, filelabel,
     
     return feature_list
 
-def featvec(x_axis, sampledata, ticid=None, v=0): 
+def featvec(x_axis, sampledata, ticid=None, v=0, tic_store=None): 
     """calculates the feature vector of a single light curve
         version 0: features 0-15
         version 1: features 0-19
@@ -2606,6 +2619,9 @@ def featvec(x_axis, sampledata, ticid=None, v=0):
 
 	*** version 1 note: you may wish to go into the transitleastsquares's main.py file and
 	comment out all 'print' statements in order to save space while running this over lots of light curves
+	*** version 1: if tic_store (catalog_utils.TICStore) is given, the stellar radius
+	and mass are read from it instead of being queried from MAST (MAST is still
+	queried for TICs missing from the store)
         modified [lcg 07202020]"""
     #empty feature vector
     featvec = []
@@ -2684,7 +2700,13 @@ def featvec(x_axis, sampledata, ticid=None, v=0):
         
         if type(ticid) != type(None):
             dt = np.max(x_axis) - np.min(x_axis)            
-            ab, mass, mass_min, mass_max, radius, radius_min, radius_max = catalog_info(TIC_ID=int(ticid))
+            # >> local TIC, no MAST query (MAST for TICs missing from it)
+            if type(tic_store) != type(None) and \
+               tic_store.rows([ticid])[0] >= 0:
+                radius, mass = tic_store.lookup([ticid], ['rad', 'mass'],
+                                                as_array=True)[0]
+            else:
+                ab, mass, mass_min, mass_max, radius, radius_min, radius_max = catalog_info(TIC_ID=int(ticid))
             # >> find smallest period grid
             rm_set = []
             grid_lengths = [period_grid(1, 1, dt).shape[0]]
@@ -2806,12 +2828,18 @@ def calculate_variability_statistics(data_dir):
 
 
 def get_tess_features(ticid, cols=['Teff', 'rad', 'mass', 'GAIAmag', 'd',\
-                                   'objType', 'Tmag']):
-    '''Query catalog data https://arxiv.org/pdf/1905.10694.pdf'''
+                                   'objType', 'Tmag'], tic_store=None):
+    '''Query catalog data https://arxiv.org/pdf/1905.10694.pdf
+    If a local TICStore (catalog_utils) is given, the values are read from it
+    (MAST is only queried for TICs missing from the store).'''
     
 
     target = 'TIC '+str(int(ticid))
-    catalog_data = Catalogs.query_object(target, radius=0.02, catalog='TIC')
+    catalog_data = None
+    if type(tic_store) != type(None):
+        catalog_data = [tic_store.row(ticid)]
+    if type(catalog_data) == type(None) or catalog_data[0] is None:
+        catalog_data = Catalogs.query_object(target, radius=0.02, catalog='TIC')
 
     feats = []
     for col in cols:
@@ -2819,8 +2847,15 @@ def get_tess_features(ticid, cols=['Teff', 'rad', 'mass', 'GAIAmag', 'd',\
 
     return target, feats
 
-def get_tess_feature_all(data_dir=''):
+def get_tess_feature_all(data_dir='', sectors=[], tic_store=None):
+    '''Writes Sector<N>tic_cat_all.csv (all TIC columns of every target of
+    each sector). Rows are taken, in order of preference, from a previous
+    run of this function, from Sector<N>tic_cat.csv (see
+    get_TIC_catalog_sector), from a local TICStore (catalog_utils), and
+    otherwise queried from MAST. TICIDs are matched with one sorted join per
+    source instead of a search per target.'''
     import pandas as pd
+    from . import join_utils as ju
     # >> get column names
     columns = np.loadtxt(data_dir+'exo_CTL_08.01xTIC_v8.1_header.csv',
                          dtype='str', delimiter=',')
@@ -2835,7 +2870,7 @@ def get_tess_feature_all(data_dir=''):
         print('Sector '+str(sector))
         output_dir = data_dir + 'Sector'+str(sector)+'/'
         fname = output_dir+'all_targets_S%03d'%sector+'_v1.txt'
-        ticid = np.loadtxt(fname)[:,0] # >> take first column
+        ticid = np.loadtxt(fname)[:,0].astype('int') # >> take first column
 
         fname = output_dir+'Sector'+str(sector)+'tic_cat.csv'
         data = pd.read_csv(fname) # !! need to first do get_TIC_catalog_sector
@@ -2845,42 +2880,59 @@ def get_tess_feature_all(data_dir=''):
 
         # >> make new file
         fname = output_dir+'Sector'+str(sector)+'tic_cat_all.csv'
+        prog_lines = []
+        ticid_prog = np.empty(0, dtype='int')
         if os.path.exists(fname):
             prog = pd.read_csv(fname, index_col=False)
             prog.to_csv(output_dir+'Sector'+str(sector)+'backup.csv',
                         index=False)
             ticid_prog = prog['ID'].to_numpy()
+            prog_lines = prog.to_numpy().astype('str')
+
+        # >> row of each target in every source (-1 if missing)
+        rows_prog = ju.match_ticid(ticid, ticid_prog)
+        rows_data = ju.match_ticid(ticid, data_ticid)
+        if type(tic_store) != type(None):
+            rows_store = tic_store.rows(ticid)
+        else:
+            rows_store = -np.ones(len(ticid), dtype='int')
+        print('Completed: {}, in tic_cat: {}, in TIC store: {}, to query: {}'\
+              .format(np.count_nonzero(rows_prog >= 0),
+                      np.count_nonzero((rows_prog < 0) * (rows_data >= 0)),
+                      np.count_nonzero((rows_prog < 0) * (rows_data < 0) * \
+                                       (rows_store >= 0)),
+                      np.count_nonzero((rows_prog < 0) * (rows_data < 0) * \
+                                       (rows_store < 0))))
 
         with open(fname, 'w') as f:
             f.write(','.join(columns)+'\n')
 
-        for i in range(len(ticid)):
-            if i % 100 == 0:
-                print(str(i) + '/' + str(len(ticid)))
-
+            for i in range(len(ticid)):
+                if i % 100 == 0:
+                    print(str(i) + '/' + str(len(ticid)))
 
-            if ticid[i] not in ticid_prog:
-                if ticid[i] in data_ticid:
-                    ind = np.nonzero(data_ticid == ticid[i])[0][0]
-                    with open(fname, 'a') as f:
-                        f.write(','.join(lines[ind].split(',')[:124])+'\n')
+                if rows_prog[i] >= 0:
+                    f.write(','.join(prog_lines[rows_prog[i]])+'\n')
+                elif rows_data[i] >= 0:
+                    f.write(','.join(lines[rows_data[i]].split(',')[:124])+'\n')
                 else:
-                    target = 'TIC ' + str(int(ticid[i]))
-                    print('Querying '+target)
-                    catalog_data = \
-                        Catalogs.query_object(target, radius=0.02, catalog='TIC')
+                    if rows_store[i] >= 0:
+                        catalog_data = [tic_store.row(ticid[i])]
+                    else:
+                        target = 'TIC ' + str(int(ticid[i]))
+                        print('Querying '+target)
+                        catalog_data = \
+                            Catalogs.query_object(target, radius=0.02,
+                                                  catalog='TIC')
                     line = []
                     for col in columns:
-                        line.append(catalog_data[0][col])
-                    line = np.array(line) # >> clean up
-                    line[np.nonzero(line == 'nan')] = ''
-                    with open(fname, 'a') as f:
-                        f.write(','.join(line) +'\n')
-            else:
-                print('Already completed '+str(ticid[i]))
-                ind = np.nonzero(ticid_prog == ticid[i])[0][0]
-                with open(fname, 'a') as f:
-                    f.write(','.join(prog.loc[ind].to_numpy().astype('str'))+'\n')
+                        line.append(catalog_data[0].get(col, '') \
+                                    if isinstance(catalog_data[0], dict) \
+                                    else catalog_data[0][col])
+                    line = np.array(line).astype('str') # >> clean up
+                    line[np.nonzero((line == 'nan') + (line == '--'))] = ''
+                    f.write(','.join(line) +'\n')
+        print('Saved '+fname)
                 
 
     
@@ -3272,12 +3324,13 @@ def query_gcvs(data_dir='./', sector='all', tol=0.1, diag_plot=True):
     * data_dir
     * sector: 'all' or int, currently only handles short-cadence
     * tol: maximum separation of TIC target and GCVS target (in arcsec)
+    The nearest GCVS target of every TIC target is found with one KD-tree
+    query per sector (see catalog_utils.cross_match) and cached in
+    databases/Sector<N>_gcvs_xmatch.npz.
     '''
     import pandas as pd
     data = pd.read_csv(data_dir+'gcvs_database.csv')
     print('Loaded gcvs_database.csv')
-    data_coords = coord.SkyCoord(data['RAJ2000'], data['DEJ2000'],
-                                 unit=(u.hourangle, u.deg))
 
     if sector=='all':
         sectors = list(range(1,27))
@@ -3293,42 +3346,14 @@ def query_gcvs(data_dir='./', sector='all', tol=0.1, diag_plot=True):
                                   index_col=False)
         print('Loaded Sector'+str(sector)+'tic_cat_all.csv')
 
-        # >> find GCVS target closest to each TIC target
-        if os.path.exists(prefix+'_sep.txt'):
-            sep_arcsec = np.loadtxt(prefix+'_sep.txt')
-            min_inds = np.loadtxt(prefix+'_sep_inds.txt').astype('int')
-            print('Loaded '+prefix+'_sep.txt')
-        else:
-            min_sep = []
-            min_inds = []
-            for i in range(len(sector_data)):
-                print('TIC '+str(int(sector_data['ID'][i]))+'\t'+str(i)+'/'+\
-                      str(len(sector_data)))
-                ticid_coord = coord.SkyCoord(sector_data['ra'][i],
-                                             sector_data['dec'][i],
-                                             unit=(u.deg, u.deg)) 
-                sep = ticid_coord.separation(data_coords)
-                min_sep.append(np.nanmin(sep))
-                ind = np.nanargmin(sep)
-                min_inds.append(ind)
-
-            sep_arcsec = np.array([sep.to(u.arcsec).value for sep in min_sep])
-            min_inds = np.array(min_inds).astype('int')
-            np.savetxt(prefix+'_sep.txt', sep_arcsec)
-            np.savetxt(prefix+'_sep_inds.txt', min_inds)
-
-        # >> save the variability type if GCVS target is close enough
-        with open(out_fname, 'w') as f:
-
-            for i in range(len(sector_data)):
-                if sep_arcsec[i] < tol:
-                    ind = min_inds[i]            
-                    f.write(str(int(sector_data['ID'][i]))+','+\
-                            str(data['VarType'][ind])+','+\
-                            str(data['VarName'][ind])+'\n')
-
-                else:
-                    f.write(str(int(sector_data['ID'][i]))+',,\n')
+        # >> find GCVS target closest to each TIC target, and save the
+        # >> variability type if GCVS target is close enough
+        sep_arcsec, min_inds = \
+            ct.cross_match_catalog(sector_data['ID'].to_numpy(),
+                                   sector_data['ra'].to_numpy(),
+                                   sector_data['dec'].to_numpy(), data,
+                                   out=out_fname, tol=tol,
+                                   cache_fname=prefix+'_xmatch.npz')
 
         # >> plotting
         if diag_plot:
@@ -3581,164 +3606,84 @@ def make_redundant_otype_dict():
     return d, parents, subclasses
 
 
-def merge_otype(otype_list):
-
-    # >> merge classes
-    parent_dict, parents, subclasses = make_parent_dict()
-
-    new_otype_list = []
-    for otype in otype_list:
-        if otype in subclasses:
-            # >> find parent
-            for parent in parents:
-                if otype in parent_dict[parent]:
-                    new_otype = parent
-            new_otype_list.append(new_otype)
-        else:
-            new_otype_list.append(otype)
-    otype_list = new_otype_list
-
-    # >> remove redundant classes 
-    redundant_dict, parents, subclasses = make_redundant_otype_dict()
-    new_otype_list = []
-    for otype in otype_list:
-        if otype in parents:
-            if len(np.intersect1d(redundant_dict[otype], otype_list))>0:
-                new_otype_list.append('')
-            else:
-                new_otype_list.append(otype)
-        else:
-            new_otype_list.append(otype)    
-
-            
-    otype_list = np.unique(new_otype_list).astype('str')
-    otype = np.delete(otype, np.where(otype == ''))
-    return otype_list
-
-
-def get_parent_otypes(ticid, otypes, remove_classes=['PM','IR','UV','X']):
+def load_otype_taxonomy(data_dir=None, simbad=False, cache_dir=None):
+    '''Otype taxonomy compiled to lookup arrays (otype_utils.OtypeTaxonomy),
+    from make_parent_dict, make_redundant_otype_dict, make_remove_class_list
+    and, if data_dir is given, the SIMBAD to GCVS renames in
+    data_dir+'simbad_gcvs_label.txt'. The compiled taxonomy is kept in
+    memory for the session and, in cache_dir (default: data_dir), saved to
+    otype_taxonomy.npz; it is only recompiled when the sources change.'''
+    parent_dict, _, _ = make_parent_dict()
+    redundant_dict, _, _ = make_redundant_otype_dict()
+    rename = {}
+    if type(data_dir) != type(None) and \
+       os.path.exists(data_dir+'simbad_gcvs_label.txt'):
+        with open(data_dir+'simbad_gcvs_label.txt', 'r') as f:
+            for line in f:
+                if ' = ' in line:
+                    otype, otype_gcvs = line.split(' = ')
+                    rename[otype] = otype_gcvs.replace('\n', '')
+    if type(cache_dir) == type(None):
+        cache_dir = data_dir
+    fname = None
+    if type(cache_dir) != type(None):
+        fname = cache_dir+'otype_taxonomy.npz'
+    return ou.cached_taxonomy(fname, parent_dict=parent_dict,
+                              redundant_dict=redundant_dict,
+                              remove_classes=make_remove_class_list(
+                                  simbad=simbad, rmv_flagged=False),
+                              rename=rename)
+
+def merge_otype(otype_list, taxonomy=None):
+    '''Merges subclasses into their parent classes and removes redundant
+    classes from a list of otypes.'''
+    if type(taxonomy) == type(None):
+        taxonomy = load_otype_taxonomy()
+    label = taxonomy.resolve(['|'.join(otype_list)], remove=[],
+                             strip=False)[0]
+    if len(label) == 0:
+        return np.empty(0, dtype='str')
+    return np.array(label.split('|'))
+
+
+def get_parent_otypes(ticid, otypes, remove_classes=['PM','IR','UV','X'],
+                      taxonomy=None):
     '''Finds all the objects with same parent and combines them into the same
-    class
+    class. Targets left without classes are labeled 'NONE'.
     '''
-
-    parent_dict, parents, subclasses =make_parent_dict()
-    parents = list(parent_dict.keys())
-
-    # >> turn into array
-    subclasses = []
-    for parent in parents:
-        subclasses.extend(parent_dict[parent])
-
-    new_otypes = []
-    for i in range(len(otypes)):
-        otype = otypes[i].split('|')
-
-        new_otype=[]
-        for o in otype:
-            if not o in remove_classes:
-                if o in subclasses:
-                    for parent in parents: # >> find parent otype
-                        if o in parent_dict[parent]:
-                            new_o = parent
-                    new_otype.append(new_o)
-                else:
-                    new_otype.append(o)
-
-        # >> remove repeats
-        new_otype = np.unique(new_otype)
-
-        # >> remove parent if child in otype list e.g. E|EA or E|EW is redundant
-        for parent in parents:
-            if parent in new_otype:
-                if len(np.intersect1d(new_otype, parent_dict[parent]))>0:
-                    new_otype = np.delete(new_otype,
-                                          np.nonzero(new_otype==parent))
-
-        new_otypes.append('|'.join(new_otype.astype('str')))
-    
-    new_otypes = np.array(new_otypes)
-
-    # # >> get rid of empty classes
-    # inds = np.nonzero(new_otypes == '')
-    # new_otypes = np.delete(new_otypes, inds)
-    # ticid = np.delete(ticid, inds)
-
-    inds = np.nonzero(new_otypes == '')
-    new_otypes[inds] = 'NONE'
-                
+    if type(taxonomy) == type(None):
+        taxonomy = load_otype_taxonomy()
+    new_otypes = taxonomy.resolve(otypes, remove=remove_classes, strip=False,
+                                  redundant=False, fill='NONE')
     return ticid, new_otypes
 
 
 
 def get_parents_only(class_info, parent_dict=None,
-                     remove_classes=[], remove_flags=[]):
+                     remove_classes=[], remove_flags=[], taxonomy=None):
     '''Finds all the objects with same parent and combines them into the same
     class
+    * class_info : array of rows [ticid, otypes, main_id]
+    * parent_dict : {parent: [subclasses]} (default: make_parent_dict)
+    Targets left without classes are removed.
     TODO: get rid of this function
     '''
-    classes = []
-    new_class_info = []
-
-    if type(parent_dict) == type(None):
-        parent_dict = make_parent_dict()
-
-    parents = list(parent_dict.keys())
-
-    # >> turn into array
-    subclasses = []
-    for parent in parents:
-        subclasses.extend(parent_dict[parent])
-
-    for i in range(len(class_info)):
-        otype_list = class_info[i][1]
-
-        # >> remove any flags
-        for flag in remove_flags:
-            otype_list = otype_list.replace(flag, '|')
-        otype_list = otype_list.split('|')
-
-        new_otype_list=[]
-        for otype in otype_list:
-            if not otype in remove_classes:
-                if otype in subclasses:
-                    # >> find parent
-                    for parent in parents:
-                        if otype in parent_dict[parent]:
-                            new_otype = parent
-
-                    new_otype_list.append(new_otype)
-                else:
-                    new_otype_list.append(otype)
-
-        # >> remove repeats
-        new_otype_list = np.unique(new_otype_list)
-
-        # >> don't want e.g. E|EA or E|EW (redundant)
-        if 'E' in new_otype_list:
-            if len(np.intersect1d(new_otype_list, ['EA', 'EP', 'EW', 'EB']))>0:
-                new_otype_list = np.delete(new_otype_list, np.nonzero(new_otype_list=='E'))
-
-        if 'L' in new_otype_list and len(new_otype_list) > 1:
-            new_otype_list = np.delete(new_otype_list,
-                                       np.nonzero(new_otype_list=='L'))
-
-        if '' in new_otype_list:
-            new_otype_list = np.delete(new_otype_list,
-                                       np.nonzero(new_otype_list==''))
-
-        # if '|'.join(new_otype_list) == '|AR|EA|EB|RS|SB':
-        #     pdb.set_trace()
-
-        new_class_info.append([class_info[i][0], '|'.join(new_otype_list),
-                               class_info[i][2]])
+    if type(parent_dict) != type(None):
+        taxonomy = ou.compile_taxonomy(parent_dict=parent_dict)
+    elif type(taxonomy) == type(None):
+        taxonomy = load_otype_taxonomy()
+
+    # >> don't want e.g. E|EA or E|EW (redundant), or L with other classes
+    class_info = np.asarray(class_info)
+    labels = taxonomy.resolve(class_info[:,1], seps=['|']+list(remove_flags),
+                              remove=remove_classes, strip=False,
+                              redundant={'E': ['EA', 'EP', 'EW', 'EB'],
+                                         'L': ['*']})
+    new_class_info = np.stack([class_info[:,0], labels, class_info[:,2]],
+                              axis=1).astype('str')
 
     # >> get rid of empty classes
-    new_class_info = np.array(new_class_info)
-    new_class_info = np.delete(new_class_info,
-                               np.nonzero(new_class_info[:,1]==''), 0)
-            
-    
-    return new_class_info
+    return new_class_info[labels != '']
 
 def make_remove_class_list(simbad=False, rmv_flagged=True):
     '''Currently, our pipeline can only do clustering based on photometric data.
@@ -3759,52 +3704,24 @@ def make_remove_class_list(simbad=False, rmv_flagged=True):
     return rmv+sequence_descriptors+flagged
 
 def read_otype_txt(otypes, otype_txt, data_dir, simbad=False, add_chars=['+', '/'],
-                   uncertainty_flags=[':', '?', '*']):
-
-    rmv_classes = make_remove_class_list(simbad=simbad)
-
-    if simbad:
-        with open(data_dir+'simbad_gcvs_label.txt', 'r') as f:
-            lines = f.readlines()
-        otype_dict = {}
-        for line in lines:
-            otype, otype_gcvs = line.split(' = ')
-            otype_gcvs = otype_gcvs.replace('\n', '')
-            otype_dict[otype] = otype_gcvs
-
-    with open(otype_txt, 'r') as f:
-        lines = f.readlines()
-        for i in range(len(lines)):
-            tic, otype, main_id = lines[i].split(',')
-
-            # >> make list of labels
-            for char in add_chars:
-                otype = otype.replace(char, '|')
-            otype_list = otype.split('|')
-
-            # >> remove unceratinty flags
-            otype_list_new = []
-            stop=False
-            for o in otype_list:
-                if o == 'UGSU':
-                    stop=True
-                if len(o) > 0 and o != '**':
-                    # >> remove uncertainty flags
-                    if o[-1] in uncertainty_flags:
-                        o = o[:-1]
-                    if '(' in o: # >> remove (B) flag
-                        o = o[:o.index('(')]
-
-                    # >> convert to GCVS nomenclature
-                    if simbad and o in list(otype_dict.keys()): 
-                        o = otype_dict[o]
-
-                    # >> remove classes that require external information
-                    if o in rmv_classes:
-                        o = ''
-                    otype_list_new.append(o)
-
-            otypes[float(tic)] = np.unique(otype_list_new)
+                   uncertainty_flags=[':', '?', '*'], taxonomy=None):
+    '''Adds the cleaned otypes of every target in otype_txt (lines
+    ticid,otypes,main_id) to the dictionary otypes ({ticid: array of
+    otypes}). Uncertainty flags and (B) flags are removed, SIMBAD names are
+    converted to GCVS nomenclature (if simbad), and classes that require
+    external information are removed.'''
+    if type(taxonomy) == type(None):
+        taxonomy = load_otype_taxonomy(data_dir=data_dir, simbad=simbad)
+    rmv_classes = make_remove_class_list(simbad=simbad, rmv_flagged=False)
+
+    data = np.loadtxt(otype_txt, delimiter=',', dtype='str', ndmin=2)
+    labels = taxonomy.resolve(data[:,1], seps=['|']+list(add_chars),
+                              flags=uncertainty_flags, rename=simbad,
+                              remove=rmv_classes, parents=False,
+                              redundant=False)
+    for tic, label in zip(data[:,0].astype('float'), labels):
+        otypes[tic] = np.array(label.split('|')) if len(label) > 0 \
+                      else np.empty(0, dtype='str')
 
     return otypes
 
@@ -3975,32 +3892,19 @@ def load_otype_true_from_datadir(metapath, ticid, sector, savepath):
     return totype
 
 def load_otype_pred_from_txt(ensbpath, sector, ticid):
-    '''Reads *-ticid_to_label.txt and returns:
-    * otype : Object types'''
+    '''Reads the predicted object types saved by learn_utils.label_clusters
+    (product ticid_to_label/, or the legacy ticid_to_label.txt or
+    Sector*-ticid_to_label.txt) and returns:
+    * otype : Object types, ordered as ticid (UNCLASSIFIED if missing)'''
     print('Loading predicted object types...')
 
-    fname = ensbpath+'Sector'+str(sector)+'-ticid_to_label.txt'
-    fileo = np.loadtxt(fname, delimiter=',', dtype='str', skiprows=1)
-    ticid_unsorted = fileo[:,0].astype('float')
-    otype = fileo[:,1]
-
-    # >> re-order otype so that ticid_unsorted = ticid
-    orgsrti = np.argsort(ticid)      # >> indices that would sort ticid
-    orgunsrti = np.argsort(orgsrti)  # >> indices that would return original
-                                     # >> ordering of ticid
-    
-    intsc, _, srtinds = np.intersect1d(ticid, ticid_unsorted,
-                                       return_indices=True)
-    if len(intsc) != len(ticid):
-        sdiff = np.setdiff1d(intsc, ticid)
-        print('!! Variability classifications were not found for '+str(sdiff)+\
-              ' TICIDs.')
-
-
-
-
-
-    otype = otype[srtinds][orgunsrti] # >> order otype correctly
+    fname = ensbpath+'ticid_to_label.txt'
+    if not os.path.exists(pu.product_path(fname)+'meta.json') and \
+       not os.path.exists(fname):
+        fname = ensbpath+'Sector'+str(sector)+'-ticid_to_label.txt'
+    otype = pu.read_column(fname, 'otype', ticid, fill='UNCLASSIFIED',
+                           legacy=pu.parse_legacy_otypes,
+                           name='predicted object types')
 
     return otype
 
@@ -4142,7 +4046,8 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
                         output_dir='./', DEBUG=False, single_file=False,
                         simbad_database_txt='./simbad_database.txt',
                         database_dir='./databases/', pca=True, tsne=True,
-                        confusion_matrix=True, tsne_clustering=True):
+                        confusion_matrix=True, tsne_clustering=True,
+                        exact_scores=False):
     '''Performs a grid serach across parameter space for DBSCAN. Calculates
     
     Parameters:
@@ -4153,6 +4058,8 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
         * success metric : !!
         * output_dir : output directory, ending with '/'
         * DEBUG : if DEBUG, plots first 5 light curves in each class
+        * exact_scores : if False, the silhouette score is estimated from a
+          stratified sample (see metric_utils.cluster_scores)
         
     TODO : only loop over p if metric = 'minkowski'
     '''
@@ -4168,12 +4075,16 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
     accuracy = []
     param_num = 0
     p0=p
+    graphs = {} # >> radius graph at max(eps) for each (metric, p)
+    fits = {}   # >> DBSCAN fit for each (eps, min_samples, metric, p)
 
     with open(output_dir + 'dbscan_param_search.txt', 'a') as f:
-        f.write('{} {} {} {} {} {} {} {} {} {} {}\n'.format("eps\t\t", "samp\t\t", "metric\t\t", 
+        f.write('{} {} {} {} {} {} {} {} {} {} {} {} {}\n'.format("eps\t\t", "samp\t\t", "metric\t\t", 
                                                          "alg\t\t", "leaf\t", "p\t",
                                                          "classes\t",
-                                                         "silhouette\t\t\t", 'ch\t\t\t', 
+                                                         "silhouette\t\t\t",
+                                                         "sil_lower\t\t\t",
+                                                         "sil_upper\t\t\t", 'ch\t\t\t', 
                                                          'db\t\t\t', 'acc\t'))
 
     for i in range(len(eps)):
@@ -4187,12 +4098,20 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
                             p = [None]
 
                         for n in range(len(p)):
-                            db = DBSCAN(eps=eps[i],
-                                        min_samples=min_samples[j],
-                                        metric=metric[k],
-                                        algorithm=algorithm[l],
-                                        leaf_size=leaf_size[m],
-                                        p=p[n]).fit(bottleneck)
+                            # >> labels do not depend on algorithm/leaf_size,
+                            # >> and smaller eps reuse the radius graph
+                            key = (eps[i], min_samples[j], metric[k], p[n])
+                            if key not in fits:
+                                if key[2:] not in graphs:
+                                    graphs[key[2:]] = \
+                                        nu.radius_graph(bottleneck, np.max(eps),
+                                                        metric=metric[k],
+                                                        p=p[n])
+                                fits[key] = \
+                                    nu.precomputed_dbscan(graphs[key[2:]],
+                                                          eps[i],
+                                                          min_samples=min_samples[j])
+                            db = fits[key]
                             #print(db.labels_)
                             print(np.unique(db.labels_, return_counts=True))
                             classes_1, counts_1 = \
@@ -4230,31 +4149,26 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
                                                        leaf_size[m],
                                                        p[n]])
                                 
-                                # >> compute silhouette
-                                print('Computing silhouette score')
-                                silhouette = silhouette_score(bottleneck,db.labels_)
+                                # >> compute silhouette, calinski harabasz
+                                # >> and davies-bouldin scores
+                                print('Computing clustering scores')
+                                silhouette, ch_score, dav_boul_score, sil_ci = \
+                                    mu.cluster_scores(bottleneck, db.labels_,
+                                                      exact=exact_scores,
+                                                      return_ci=True)
                                 silhouette_scores.append(silhouette)
-                                
-                                # >> compute calinski harabasz score
-                                print('Computing calinski harabasz score')
-                                ch_score = calinski_harabasz_score(bottleneck,
-                                                                db.labels_)
                                 ch_scores.append(ch_score)
-                                
-                                # >> compute davies-bouldin score
-                                print('Computing davies-bouldin score')
-                                dav_boul_score = davies_bouldin_score(bottleneck,
-                                                             db.labels_)
                                 db_scores.append(dav_boul_score)
                                 
                             else:
                                 silhouette, ch_score, dav_boul_score = \
                                     np.nan, np.nan, np.nan
+                                sil_ci = (np.nan, np.nan)
                                 
                             print('Saving results to text file')
                             with open(output_dir + 'dbscan_param_search.txt', 'a') as f:
                                 f.write('{}\t\t {}\t\t {}\t\t {}\t {}\t \
-                                        {}\t {}\t\t\t {}\t\t\t {}\t\t\t {}\t {}\n'.format(eps[i],
+                                        {}\t {}\t\t\t {}\t\t\t {}\t\t\t {}\t\t\t {}\t\t\t {}\t {}\n'.format(eps[i],
                                                                    min_samples[j],
                                                                    metric[k],
                                                                    algorithm[l],
@@ -4262,6 +4176,8 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
                                                                    p[n],
                                                                    len(classes_1),
                                                                    silhouette,
+                                                                   sil_ci[0],
+                                                                   sil_ci[1],
                                                                    ch_score,
                                                                    dav_boul_score,
                                                                    acc))
@@ -4291,7 +4207,7 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
                                     print('Plot t-SNE...')
                                     pt.plot_tsne(bottleneck, db.labels_,
                                                  output_dir=output_dir,
-                                                 prefix=prefix)
+                                                 prefix=prefix, cache=True)
                                 # if tsne_clustering:
                                     
                                     
@@ -4308,7 +4224,7 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
         
     return parameter_sets, num_classes, silhouette_scores, db_scores, ch_scores, accuracy
 
-def KNN_plotting(path, features, k_values):
+def KNN_plotting(path, features, k_values, graph=None, cache_file=None):
     """ This is based on a metric for finding the best possible eps/minsamp
     value from the original DBSCAN paper (Ester et al 1996). Essentially,
     by calculating the average distances to the k-nearest neighbors and plotting
@@ -4321,38 +4237,44 @@ def KNN_plotting(path, features, k_values):
         * path to where you want to save the plots
         * features (should have any significant outliers clipped out)
         * k_values: array of integers, ie [2,3,5,10] for the k values
+        * graph: kNN graph (dist, ind) from neighbor_utils.knn_graph. If None,
+          it is computed once for max(k_values) (and cached in cache_file)
         
     output: 
         * plots the KNN curves into the path
+        * returns dictionary of the suggested eps for each k
     modified [lcg 08122020 - created]"""
-    from sklearn.neighbors import NearestNeighbors
+    if type(graph) == type(None):
+        graph = nu.cached_knn_graph(features, np.max(k_values)-1,
+                                    fname=cache_file)
+    eps = {}
     for n in range(len(k_values)):
-        neigh = NearestNeighbors(n_neighbors=k_values[n])
-        neigh.fit(features)
-    
-        k_dist, k_ind = neigh.kneighbors(features, return_distance=True)
-        
-        avg_kdist = np.mean(k_dist, axis=1)
+        avg_kdist = nu.mean_knn_distance(graph[0], k_values[n])
         avg_kdist_sorted = np.sort(avg_kdist)[::-1]
+        eps[k_values[n]] = nu.eps_heuristic(graph[0], k_values[n])
         
         plt.scatter(np.arange(len(features)), avg_kdist_sorted)
+        plt.axhline(eps[k_values[n]], color='r', ls='--',
+                    label='eps = {:.3g}'.format(eps[k_values[n]]))
+        plt.legend()
         plt.xlabel("Points")
         plt.ylabel("Average K-Neighbor Distance")
         plt.ylim((0, 50))
         plt.title("K-Neighbor plot for k=" + str(k_values[n]))
         plt.savefig(path + "kneighbors-" +str(k_values[n]) +"-plot-sorted.png")
         plt.close()    
+    return eps
 
 def load_paramscan_txt(path):
     """ load in the paramscan stuff from the text file
     returns: parameter sets, number of classes, metric scores (in order: silhouettte, db, ch)
     modified [lcg 07292020 - created]"""
-    params = np.genfromtxt(path, dtype=(float, int, 'S10', 'S10', int, int, int, np.float32, np.float32, np.float32), names=['eps', 'minsamp', 'metric', 'algorithm', 'leafsize', 'p', 'numclasses', 'silhouette', 'ch', 'db'])
+    params = np.genfromtxt(path, dtype=(float, int, 'S10', 'S10', int, int, int, np.float32, np.float32, np.float32, np.float32, np.float32, np.float32), names=['eps', 'minsamp', 'metric', 'algorithm', 'leafsize', 'p', 'numclasses', 'silhouette', 'sil_lower', 'sil_upper', 'ch', 'db', 'acc'])
     
     params = np.asarray(params)
     nan_indexes = []
     for n in range(len(params)):
-        if np.isnan(params[n][8]):
+        if np.isnan(params[n]['ch']):
             nan_indexes.append(int(n))
         
     nan_indexes = np.asarray(nan_indexes)
@@ -4366,8 +4288,10 @@ def load_paramscan_txt(path):
 
 def quick_hdbscan_param_search(features, min_samples=[2,3,4,5,6,7,8,15,50],
                                min_cluster_size=[2,3,5,15,50,100],
-                               metric=['all'], p0=[1,2,3,4], output_dir='./'):
-    
+                               metric=['all'], p0=[1,2,3,4], output_dir='./',
+                               ticid=None):
+    '''Labels for every parameter set are saved to hdbscan_labels.npz, with
+    columns identified by ticid (or row index if ticid is None).'''
     import hdbscan
     with open(output_dir + 'hdbscan_param_search.txt', 'a') as f:
         f.write('{} {} {} {} {} {} {}\n'.format("min_cluster_size", "min_samples",
@@ -4383,26 +4307,23 @@ def quick_hdbscan_param_search(features, min_samples=[2,3,4,5,6,7,8,15,50],
         metric.remove('arccos')
         metric.remove('pyfunc')        
         
-    for i in range(len(min_cluster_size)):
-        for j in range(len(metric)):
-            if metric[j] == 'minkowski':
-                p = p0
-            else:
-                p = [None]
-            for n in range(len(p)):
-                for k in range(len(min_samples)):    
-                    clusterer = hdbscan.HDBSCAN(min_cluster_size=int(min_cluster_size[i]),
-                                                metric=metric[j], min_samples=min_samples[k],
-                                                p=p[n], algorithm='best')
-                    clusterer.fit(features)
-                    classes, counts = np.unique(clusterer.labels_, return_counts=True)
-                    
-                    with open(output_dir + 'hdbscan_param_search.txt', 'a') as f:
-                        f.write('{} {} {} {} {} {} {} {}\n'.format(min_cluster_size[i],
-                                                       min_samples[k],
-                                                       metric[j], p[n],
+    # >> one spanning tree per (metric, p, min_samples), cut for every
+    # >> min_cluster_size
+    params, label_matrix, times = \
+        cu.hdbscan_sweep(features, min_cluster_size=min_cluster_size,
+                         min_samples=min_samples, metric=metric, p=p0)
+    for count in range(len(params)):
+        mcs, ms, met, p_val = params[count]
+        classes, counts = np.unique(label_matrix[count], return_counts=True)
+
+        with open(output_dir + 'hdbscan_param_search.txt', 'a') as f:
+            f.write('{} {} {} {} {} {} {} {}\n'.format(mcs, ms, met, p_val,
                                                        len(np.unique(classes))-1, 
                                                        counts[0], classes, counts))
+    if type(ticid) == type(None):
+        ticid = np.arange(len(features))
+    cu.save_label_matrix(output_dir+'hdbscan_labels.npz', ticid, label_matrix,
+                         params)
 
 def hdbscan_param_search(features, time, flux, ticid, target_info,
                             min_cluster_size=list(np.arange(5,30,2)),
@@ -4414,7 +4335,7 @@ def hdbscan_param_search(features, time, flux, ticid, target_info,
                             pca=False, tsne=False, confusion_matrix=True,
                             prefix='',
                             data_dir='./data/', save=False,
-                            parents=[], labels=[]):
+                            parents=[], labels=[], exact_scores=False):
     '''Performs a grid serach across parameter space for HDBSCAN. 
     
     Parameters:
@@ -4424,6 +4345,8 @@ def hdbscan_param_search(features, time, flux, ticid, target_info,
         * output_dir : output directory, ending with '/'
         * DEBUG : if DEBUG, plots first 5 light curves in each class
         * optional to plot pca & tsne coloring for it
+        * exact_scores : if False, the silhouette score is estimated from a
+          stratified sample (see metric_utils.cluster_scores)
         
     '''
     from astropy.io import fits
@@ -4451,9 +4374,9 @@ def hdbscan_param_search(features, time, flux, ticid, target_info,
         metric.remove('pyfunc')    
 
     with open(output_dir + 'hdbscan_param_search.txt', 'a') as f:
-        f.write('{} {} {} {}\n'.format("min_cluster_size", "min_samples",
-                                       "metric", "p", 'num_classes', 
-                                       'silhouette', 'db', 'ch', 'acc'))
+        f.write('{} {} {} {} {} {} {} {} {} {} {}\n'.format(
+            "min_cluster_size", "min_samples", "metric", "p", 'num_classes',
+            'silhouette', 'sil_lower', 'sil_upper', 'ch', 'db', 'acc'))
 
     for i in range(len(min_cluster_size)):
         for j in range(len(metric)):
@@ -4491,18 +4414,13 @@ def hdbscan_param_search(features, time, flux, ticid, target_info,
                         counts.append(counts_1)
                         num_noisy.append(counts_1[0])
                         parameter_sets.append([min_cluster_size[i],metric[j],p[n]])
-                        print('Computing silhouette score')
-                        silhouette = silhouette_score(features, labels)
+                        print('Computing clustering scores')
+                        silhouette, ch_score, dav_boul_score, sil_ci = \
+                            mu.cluster_scores(features, labels,
+                                              exact=exact_scores,
+                                              return_ci=True)
                         silhouette_scores.append(silhouette)
-                        
-                        # >> compute calinski harabasz score
-                        print('Computing calinski harabasz score')
-                        ch_score = calinski_harabasz_score(features, labels)
                         ch_scores.append(ch_score)
-                        
-                        # >> compute davies-bouldin score
-                        print('Computing davies-bouldin score')
-                        dav_boul_score = davies_bouldin_score(features, labels)
                         db_scores.append(dav_boul_score)                        
                                     
                         if confusion_matrix:
@@ -4522,7 +4440,8 @@ def hdbscan_param_search(features, time, flux, ticid, target_info,
                                                      min_samples[k],
                                                      metric[j], p[n],
                                                      len(classes_1),
-                                                     silhouette, ch_score,
+                                                     silhouette, sil_ci[0],
+                                                     sil_ci[1], ch_score,
                                                      dav_boul_score, acc])) + '\n')
                         # s = '{}\t {}\t {}\t {}\t {}\t {}\t {}\t {}\n'
                         # f.write(s.format(min_cluster_size[i], min_samples[k],
@@ -4559,7 +4478,7 @@ def hdbscan_param_search(features, time, flux, ticid, target_info,
                             print('Plot t-SNE...')
                             pt.plot_tsne(features,labels,
                                          output_dir=output_dir,
-                                         prefix=prefix)                
+                                         prefix=prefix, cache=True)                
                     plt.close('all')
                     param_num +=1
 
@@ -4569,13 +4488,13 @@ def hdbscan_param_search(features, time, flux, ticid, target_info,
 
 def gmm_param_search(features, ticid, data_dir,
                      num_components=[20, 100, 200, 500],
-                     output_dir='./'):
+                     output_dir='./', exact_scores=False):
     from sklearn.mixture import GaussianMixture       
-    from sklearn.metrics import silhouette_score
 
     with open(output_dir+'gmm_param_search.txt', 'a') as f:
-        f.write('{}\t{}\t{}\t{}\n'.format('num_components', 'recall',
-                                          'accuracy', 'silhouette'))
+        f.write('{}\t{}\t{}\t{}\t{}\t{}\n'.format('num_components', 'recall',
+                                                  'accuracy', 'silhouette',
+                                                  'sil_lower', 'sil_upper'))
 
     scores = []
     recall = []
@@ -4584,7 +4503,13 @@ def gmm_param_search(features, ticid, data_dir,
         clusterer = GaussianMixture(n_components=num_components[i])
         labels = clusterer.fit_predict(features)
 
-        score = silhouette_score(features, labels)
+        if exact_scores:
+            from sklearn.metrics import silhouette_score
+            score = silhouette_score(features, labels)
+            sil_ci = (score, score)
+        else:
+            score, lower, upper = mu.sampled_silhouette(features, labels)
+            sil_ci = (lower, upper)
         scores.append(score)
 
         prefix='gmm_n_'+str(i)+'-'
@@ -4597,8 +4522,10 @@ def gmm_param_search(features, ticid, data_dir,
         accuracies.append(np.mean(accuracy))
 
         with open(output_dir+'gmm_param_search.txt', 'a') as f:
-            f.write('{}\t{}\t{}\t{}\n'.format(num_components[i], np.mean(recalls),
-                                              accuracy, score))
+            f.write('{}\t{}\t{}\t{}\t{}\t{}\n'.format(num_components[i],
+                                                      np.mean(recalls),
+                                                      accuracy, score,
+                                                      sil_ci[0], sil_ci[1]))
 
     fig, ax = plt.subplots()
     ax.plot(num_components, recall, '.')
@@ -4662,6 +4589,7 @@ def lof_param_scan(ticid_feat, features,n_neighbors=list(range(10,40,10)),
     
     with open(output_dir + 'lof_param_search.txt', 'a') as f:
         f.write('n_neighbors metric p algorithm contamination rare_LOF\n')
+    graphs = {}
     for i in range(len(n_neighbors)):
         for j in range(len(metric)):
             if metric[j] == 'minkowski':
@@ -4669,16 +4597,18 @@ def lof_param_scan(ticid_feat, features,n_neighbors=list(range(10,40,10)),
             else:
                 p = [None]
             for k in range(len(p)):
+                # >> one kNN graph per (metric, p) at max(n_neighbors); the
+                # >> algorithm and contamination do not change the scores
+                if (metric[j], p[k]) not in graphs:
+                    graphs[(metric[j], p[k])] = \
+                        nu.knn_graph(features, np.max(n_neighbors),
+                                     metric=metric[j], p=p[k],
+                                     algorithm=algorithm[0])
+                dist, ind = graphs[(metric[j], p[k])]
+                lof = nu.local_outlier_factor(dist, ind,
+                                              n_neighbors=int(n_neighbors[i]))
                 for l in range(len(algorithm)):
                     for m in range(len(contamination)):
-                        clf = LocalOutlierFactor(n_neighbors=int(n_neighbors[i]),
-                                                 metric=metric[j],
-                                                 p=p[k], algorithm=algorithm[l],
-                                                 contamination=contamination[m])
-                        fit_predictor = clf.fit_predict(features)
-                        negative_factor = clf.negative_outlier_factor_
-                        lof = -1 * negative_factor
-                        
                         with open(output_dir + 'lof_param_search.txt', 'a') as f:
                             f.write('{} {} {} {} {} '.format(int(n_neighbors[i]),
                                                             metric[j], p[k],
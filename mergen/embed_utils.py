@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+embed_utils.py
+
+2-D embeddings of feature spaces for visualization. Backends, in order of
+preference for method='auto':
+    * 'opentsne' : FFT-accelerated t-SNE (openTSNE), multi-threaded
+    * 'umap'     : UMAP (umap-learn), multi-threaded
+    * 'sklearn'  : Barnes-Hut t-SNE (sklearn.manifold.TSNE), always available
+Embeddings are cached by a hash of the features and parameters, so the same
+feature set is never embedded twice. New objects can be placed into an
+existing embedding with Embedding.transform (native transform for openTSNE
+and UMAP; for sklearn, the distance-weighted mean position of the nearest
+embedded neighbors, which needs the fitted features). Cache files hold the
+embedding and the features hash, not the features themselves: pass the
+features to load_embedding (cached_embedding does) to transform with
+sklearn.
+
+Embedding backends
+* available_methods
+* Embedding
+* features_hash
+
+Caching
+* cached_embedding
+* load_embedding
+"""
+
+import numpy as np
+import os
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Embedding backends ::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def available_methods():
+    '''Embedding backends that can be imported, in order of preference.'''
+    methods = []
+    try:
+        import openTSNE
+        methods.append('opentsne')
+    except ImportError:
+        pass
+    try:
+        import umap
+        methods.append('umap')
+    except ImportError:
+        pass
+    methods.append('sklearn')
+    return methods
+
+def features_hash(features, **params):
+    '''sha1 of the features (as float64) and the embedding parameters.'''
+    import hashlib
+    h = hashlib.sha1(np.ascontiguousarray(features, dtype=np.float64))
+    h.update(str(np.shape(features)).encode())
+    h.update(str(sorted(params.items())).encode())
+    return h.hexdigest()
+
+class Embedding(object):
+    '''2-D (or n_components-D) embedding of a feature space.
+    Parameters:
+        * method : 'auto', 'opentsne', 'umap' or 'sklearn'
+        * perplexity, early_exaggeration : t-SNE parameters (openTSNE,
+                                           sklearn)
+        * n_neighbors : UMAP neighborhood size
+        * n_jobs : number of threads for openTSNE and UMAP (-1: all cores)
+    After fit, the embedding of the fitted features is in embedding_.'''
+
+    def __init__(self, method='auto', n_components=2, perplexity=30,
+                 n_neighbors=15, n_jobs=-1, random_state=0,
+                 early_exaggeration=12):
+        if method == 'auto':
+            method = available_methods()[0]
+        self.method = method
+        self.n_components = n_components
+        self.perplexity = perplexity
+        self.early_exaggeration = early_exaggeration
+        self.n_neighbors = n_neighbors
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def params(self):
+        return {'method': self.method, 'n_components': self.n_components,
+                'perplexity': self.perplexity, 'n_neighbors': self.n_neighbors,
+                'random_state': self.random_state,
+                'early_exaggeration': self.early_exaggeration}
+
+    def fit(self, features):
+        features = np.asarray(features, dtype=np.float64)
+        print('Computing '+self.method+' embedding of '+str(len(features))+\
+              ' objects...')
+        if self.method == 'opentsne':
+            from openTSNE import TSNE
+            self.model_ = TSNE(n_components=self.n_components,
+                               perplexity=self.perplexity, n_jobs=self.n_jobs,
+                               early_exaggeration=self.early_exaggeration,
+                               random_state=self.random_state).fit(features)
+            self.embedding_ = np.asarray(self.model_)
+        elif self.method == 'umap':
+            import umap
+            self.model_ = umap.UMAP(n_components=self.n_components,
+                                    n_neighbors=self.n_neighbors,
+                                    n_jobs=self.n_jobs).fit(features)
+            self.embedding_ = self.model_.embedding_
+        elif self.method == 'sklearn':
+            from sklearn.manifold import TSNE
+            self.model_ = None
+            self.embedding_ = TSNE(n_components=self.n_components,
+                                   perplexity=min(self.perplexity,
+                                                  len(features)-1),
+                                   early_exaggeration=self.early_exaggeration,
+                                   random_state=self.random_state)\
+                                   .fit_transform(features)
+        else:
+            raise ValueError('Unknown embedding method '+self.method)
+        self.features_ = features
+        return self
+
+    def transform(self, features, k=10):
+        '''Places new objects into the existing embedding.'''
+        features = np.atleast_2d(np.asarray(features, dtype=np.float64))
+        if type(getattr(self, 'model_', None)) != type(None):
+            return np.asarray(self.model_.transform(features))
+
+        # >> no native transform: distance-weighted mean of the positions of
+        # >> the k nearest fitted objects
+        from sklearn.neighbors import NearestNeighbors
+        if type(getattr(self, 'features_', None)) == type(None):
+            raise ValueError('Embedding has no fitted features: pass them to '+\
+                             'load_embedding to place new objects')
+        k = min(k, len(self.features_))
+        dist, ind = NearestNeighbors(n_neighbors=k).fit(self.features_)\
+                                                   .kneighbors(features)
+        weights = 1. / np.maximum(dist, 1e-12)
+        weights /= np.sum(weights, axis=1, keepdims=True)
+        return np.einsum('nk,nkd->nd', weights, self.embedding_[ind])
+
+    def save(self, fname, save_features=False):
+        '''Saves the embedding and the features hash (npz), and the backend
+        model, if any, for transform (pickle, fname with .pkl). The fitted
+        features are only stored if save_features is True.'''
+        arrays = {'embedding': self.embedding_,
+                  'features_key': np.array(features_hash(self.features_))}
+        if save_features:
+            arrays['features'] = self.features_
+        np.savez(fname, **arrays, **self.params())
+        if type(getattr(self, 'model_', None)) != type(None):
+            import pickle
+            with open(os.path.splitext(fname)[0]+'.pkl', 'wb') as f:
+                pickle.dump(self.model_, f)
+        print('Saved '+fname)
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Caching :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def load_embedding(fname, features=None):
+    '''Loads an Embedding saved with Embedding.save. features are the fitted
+    features (checked against the saved hash), needed by transform for
+    sklearn embeddings saved without them.'''
+    data = np.load(fname)
+    emb = Embedding(method=str(data['method']),
+                    n_components=int(data['n_components']),
+                    perplexity=float(data['perplexity']),
+                    n_neighbors=int(data['n_neighbors']),
+                    random_state=int(data['random_state']),
+                    early_exaggeration=float(data['early_exaggeration']) \
+                    if 'early_exaggeration' in data else 12)
+    emb.embedding_ = data['embedding']
+    emb.features_ = data['features'] if 'features' in data else None
+    if type(features) != type(None):
+        if 'features_key' in data and \
+           str(data['features_key']) != features_hash(features):
+            raise ValueError(fname+' was not fitted on the given features')
+        emb.features_ = np.asarray(features, dtype=np.float64)
+    emb.model_ = None
+    pkl = os.path.splitext(fname)[0]+'.pkl'
+    if os.path.exists(pkl):
+        import pickle
+        with open(pkl, 'rb') as f:
+            emb.model_ = pickle.load(f)
+    return emb
+
+def cached_embedding(features, cache_dir='./', method='auto', **kwargs):
+    '''Embedding of the features, loaded from cache_dir if the same features
+    were already embedded with the same parameters (file
+    embedding-<method>-<hash>.npz), otherwise computed and saved.
+    Returns: Embedding (positions in embedding_)'''
+    emb = Embedding(method=method, **kwargs)
+    key = features_hash(features, **emb.params())
+    fname = cache_dir+'embedding-'+emb.method+'-'+key[:16]+'.npz'
+    if os.path.exists(fname):
+        print('Loading '+fname)
+        return load_embedding(fname, features=features)
+    emb.fit(features)
+    emb.save(fname)
+    return emb
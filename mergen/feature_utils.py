@@ -61,7 +61,7 @@ def create_save_featvec_homogenous_time(yourpath, times, intensities, filelabel,
     
     return feature_list
 
-def featvec(x_axis, sampledata, ticid=None, v=0): 
+def featvec(x_axis, sampledata, ticid=None, v=0, tic_store=None): 
     """calculates the feature vector of a single light curve
         version 0: features 0-15
         version 1: features 0-19
@@ -103,6 +103,9 @@ def featvec(x_axis, sampledata, ticid=None, v=0):
 
 	*** version 1 note: you may wish to go into the transitleastsquares's main.py file and
 	comment out all 'print' statements in order to save space while running this over lots of light curves
+	*** version 1: if tic_store (catalog_utils.TICStore) is given, the stellar radius
+	and mass are read from it instead of being queried from MAST (MAST is still
+	queried for TICs missing from the store)
         modified [lcg 07202020]"""
     #empty feature vector
     featvec = []
@@ -181,7 +184,13 @@ def featvec(x_axis, sampledata, ticid=None, v=0):
         
         if type(ticid) != type(None):
             dt = np.max(x_axis) - np.min(x_axis)            
-            ab, mass, mass_min, mass_max, radius, radius_min, radius_max = catalog_info(TIC_ID=int(ticid))
+            # >> local TIC, no MAST query (MAST for TICs missing from it)
+            if type(tic_store) != type(None) and \
+               tic_store.rows([ticid])[0] >= 0:
+                radius, mass = tic_store.lookup([ticid], ['rad', 'mass'],
+                                                as_array=True)[0]
+            else:
+                ab, mass, mass_min, mass_max, radius, radius_min, radius_max = catalog_info(TIC_ID=int(ticid))
             # >> find smallest period grid
             rm_set = []
             grid_lengths = [period_grid(1, 1, dt).shape[0]]
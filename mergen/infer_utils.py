@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+infer_utils.py
+
+NumPy-only inference runtime for trained convolutional autoencoder encoders.
+A trained Keras model (as built by learn_utils.cae_encoder/conv_autoencoder)
+is exported once into a compact .npz weights file, which can then be run
+through the bottleneck without importing TensorFlow. This keeps feature
+extraction workers light (sub-second startup, no TF dependency).
+
+Exporting
+* export_encoder
+* encoder_spec
+
+Inference
+* load_encoder
+* encoder_forward
+* get_bottleneck_np
+* compare_bottleneck
+
+Layer kernels
+* conv1d_same
+* maxpool1d_same
+* activation
+"""
+
+import numpy as np
+import json
+
+# >> layers that are exported (everything else raises unless it is a no-op)
+SUPPORTED_LAYERS = ['InputLayer', 'Reshape', 'Conv1D', 'BatchNormalization',
+                    'Activation', 'MaxPooling1D', 'Dropout', 'Flatten',
+                    'Dense']
+NOOP_LAYERS = ['InputLayer', 'Dropout']
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Exporting :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def encoder_spec(model, bottleneck_name='bottleneck'):
+    '''Walks the layers of a Keras model up to and including the bottleneck
+    layer and returns a list of (layer config, list of weight arrays). Only
+    duck-typed attribute access is used, so this does not import TensorFlow
+    itself.
+    Parameters:
+        * model : Keras Model (full autoencoder or encoder)
+        * bottleneck_name : name of the bottleneck layer
+    '''
+    spec = []
+    for layer in model.layers:
+        kind = layer.__class__.__name__
+        if kind not in SUPPORTED_LAYERS:
+            raise ValueError('Cannot export layer '+layer.name+' of type '+\
+                             kind+' to the NumPy runtime')
+
+        cfg = layer.get_config()
+        entry = {'class': kind, 'name': layer.name}
+        if kind == 'Reshape':
+            entry['target_shape'] = list(cfg['target_shape'])
+        elif kind == 'Conv1D':
+            entry['strides'] = int(np.ravel(cfg['strides'])[0])
+            entry['padding'] = cfg['padding']
+            entry['activation'] = cfg['activation']
+            entry['use_bias'] = cfg['use_bias']
+        elif kind == 'BatchNormalization':
+            entry['epsilon'] = float(cfg['epsilon'])
+            entry['center'] = cfg['center']
+            entry['scale'] = cfg['scale']
+        elif kind == 'Activation':
+            entry['activation'] = cfg['activation']
+        elif kind == 'MaxPooling1D':
+            entry['pool_size'] = int(np.ravel(cfg['pool_size'])[0])
+            strides = cfg['strides']
+            if strides is None:
+                strides = cfg['pool_size']
+            entry['strides'] = int(np.ravel(strides)[0])
+            entry['padding'] = cfg['padding']
+        elif kind == 'Dense':
+            entry['activation'] = cfg['activation']
+            entry['use_bias'] = cfg['use_bias']
+
+        if 'padding' in entry and entry['padding'] not in ['same', 'valid']:
+            raise ValueError('Unsupported padding '+entry['padding']+\
+                             ' in layer '+layer.name)
+
+        weights = [np.asarray(w, dtype=np.float32) for w in \
+                   layer.get_weights()]
+        spec.append((entry, weights))
+
+        if layer.name == bottleneck_name:
+            break
+    else:
+        raise ValueError('No layer named '+bottleneck_name+' in model')
+
+    return spec
+
+def export_encoder(model, out, bottleneck_name='bottleneck', params=None):
+    '''Converts a trained encoder into a compact weights file readable by
+    load_encoder.
+    Parameters:
+        * model : Keras Model, or path to a saved model (e.g. model.hdf5)
+        * out : output path, e.g. output_dir+'encoder.npz'
+        * bottleneck_name : name of the bottleneck layer
+        * params : optional hyperparameter dictionary, stored alongside the
+                   weights for bookkeeping
+    Returns: path to the weights file'''
+    if type(model) == type(str()):
+        from . import learn_utils as lt
+        model = lt.load_model(model)
+
+    spec = encoder_spec(model, bottleneck_name=bottleneck_name)
+
+    arrays = {}
+    layers = []
+    for i, (entry, weights) in enumerate(spec):
+        entry['n_weights'] = len(weights)
+        layers.append(entry)
+        for j, w in enumerate(weights):
+            arrays['w%03d_%d'%(i,j)] = w
+
+    meta = {'layers': layers, 'bottleneck': bottleneck_name,
+            'input_dim': int(model.input_shape[1])}
+    if type(params) != type(None):
+        meta['params'] = {k: str(v) for k, v in params.items()}
+    arrays['meta'] = np.array(json.dumps(meta))
+
+    np.savez(out, **arrays)
+    print('Saved '+out)
+    return out
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Inference :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def load_encoder(path, return_input_dim=False):
+    '''Reads a weights file written by export_encoder. Returns a list of
+    (layer config, list of weight arrays), and the model input length if
+    return_input_dim.'''
+    with np.load(path, allow_pickle=False) as data:
+        meta = json.loads(str(data['meta']))
+        spec = []
+        for i, entry in enumerate(meta['layers']):
+            weights = [data['w%03d_%d'%(i,j)] for j in \
+                       range(entry['n_weights'])]
+            spec.append((entry, weights))
+    if return_input_dim:
+        return spec, meta.get('input_dim')
+    return spec
+
+def encoder_forward(spec, x, batch_size=1024, dtype=np.float32):
+    '''Runs x through the exported encoder layers in batches.
+    Parameters:
+        * spec : output of load_encoder (or path to the weights file)
+        * x : array with shape (num light curves, num data points)
+        * batch_size : number of light curves held in memory per pass
+    Returns: bottleneck array with shape (num light curves, latent_dim)'''
+    if type(spec) == type(str()):
+        spec = load_encoder(spec)
+
+    out = []
+    for start in range(0, len(x), batch_size):
+        h = np.asarray(x[start:start+batch_size], dtype=dtype)
+        for entry, weights in spec:
+            h = _apply_layer(entry, weights, h)
+        out.append(h)
+
+    if len(out) == 0:
+        return np.empty((0,0), dtype=dtype)
+    return np.concatenate(out, axis=0)
+
+def get_bottleneck_np(path, x_test, save=False, output_dir='',
+                      batch_size=1024):
+    '''Drop-in, TensorFlow-free counterpart to learn_utils.get_bottleneck.
+    Light curves longer than the model input are truncated from the start,
+    as in learn_utils.generate_batches.'''
+    spec, input_dim = load_encoder(path, return_input_dim=True)
+    if type(input_dim) != type(None) and x_test.shape[1] > input_dim:
+        x_test = x_test[:,-input_dim:]
+
+    bottleneck = encoder_forward(spec, x_test, batch_size=batch_size)
+    if save:
+        np.save(output_dir+'bottleneck_train.npy', bottleneck)
+    else:
+        return bottleneck
+
+def compare_bottleneck(bottleneck_ref, bottleneck, rtol=1e-4, atol=1e-4):
+    '''Summarizes agreement between a reference bottleneck (e.g. from Keras)
+    and one produced by another runtime.
+    Returns: dictionary with max/mean absolute error, max relative error and
+    whether all values agree within tolerance'''
+    bottleneck_ref = np.asarray(bottleneck_ref, dtype=np.float64)
+    bottleneck = np.asarray(bottleneck, dtype=np.float64)
+    err = np.abs(bottleneck - bottleneck_ref)
+    scale = np.maximum(np.abs(bottleneck_ref), atol)
+    return {'max_abs_err': float(np.max(err)) if err.size else 0.,
+            'mean_abs_err': float(np.mean(err)) if err.size else 0.,
+            'max_rel_err': float(np.max(err/scale)) if err.size else 0.,
+            'allclose': bool(np.allclose(bottleneck, bottleneck_ref,
+                                         rtol=rtol, atol=atol))}
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Layer kernels :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def _apply_layer(entry, weights, h):
+    kind = entry['class']
+    if kind in NOOP_LAYERS:
+        return h
+    elif kind == 'Reshape':
+        return h.reshape((len(h),)+tuple(entry['target_shape']))
+    elif kind == 'Flatten':
+        return h.reshape(len(h), -1)
+    elif kind == 'Conv1D':
+        bias = weights[1] if entry['use_bias'] else None
+        h = conv1d_same(h, weights[0], bias, strides=entry['strides'],
+                        padding=entry['padding'])
+        return activation(h, entry['activation'])
+    elif kind == 'BatchNormalization':
+        # >> weights are ordered [gamma], [beta], moving_mean, moving_variance
+        w = list(weights)
+        gamma = w.pop(0) if entry['scale'] else 1.
+        beta = w.pop(0) if entry['center'] else 0.
+        mean, var = w
+        inv = gamma / np.sqrt(var + entry['epsilon'])
+        return (h*inv + (beta - mean*inv)).astype(h.dtype)
+    elif kind == 'Activation':
+        return activation(h, entry['activation'])
+    elif kind == 'MaxPooling1D':
+        return maxpool1d_same(h, entry['pool_size'], strides=entry['strides'],
+                              padding=entry['padding'])
+    elif kind == 'Dense':
+        h = h @ weights[0]
+        if entry['use_bias']:
+            h = h + weights[1]
+        return activation(h, entry['activation'])
+    raise ValueError('Unsupported layer type '+kind)
+
+def _same_padding(length, kernel_size, strides):
+    '''Returns (output length, left pad, right pad) following the TensorFlow
+    convention for padding='same'.'''
+    out_len = -(-length // strides)
+    pad = max((out_len-1)*strides + kernel_size - length, 0)
+    return out_len, pad//2, pad - pad//2
+
+def conv1d_same(x, kernel, bias=None, strides=1, padding='same'):
+    '''1D convolution (cross-correlation, as in Keras Conv1D).
+    Parameters:
+        * x : array with shape (batch, length, in_channels)
+        * kernel : array with shape (kernel_size, in_channels, out_channels)
+        * bias : array with shape (out_channels,)'''
+    k = kernel.shape[0]
+    length = x.shape[1]
+    if padding == 'same':
+        out_len, left, right = _same_padding(length, k, strides)
+        if left or right:
+            x = np.pad(x, ((0,0), (left,right), (0,0)))
+    else:
+        out_len = (length - k)//strides + 1
+
+    # >> accumulate one kernel tap at a time to avoid an im2col temporary
+    out = np.zeros((x.shape[0], out_len, kernel.shape[2]), dtype=x.dtype)
+    stop = (out_len-1)*strides + 1
+    for i in range(k):
+        out += x[:, i:i+stop:strides, :] @ kernel[i]
+    if type(bias) != type(None):
+        out += bias
+    return out
+
+def maxpool1d_same(x, pool_size, strides=None, padding='same'):
+    '''Max pooling over the time axis of x with shape (batch, length,
+    channels).'''
+    if strides is None:
+        strides = pool_size
+    length = x.shape[1]
+    if padding == 'same':
+        out_len, left, right = _same_padding(length, pool_size, strides)
+        if left or right:
+            x = np.pad(x, ((0,0), (left,right), (0,0)),
+                       constant_values=-np.inf)
+    else:
+        out_len = (length - pool_size)//strides + 1
+
+    stop = (out_len-1)*strides + 1
+    out = x[:, 0:stop:strides, :].copy()
+    for i in range(1, pool_size):
+        np.maximum(out, x[:, i:i+stop:strides, :], out=out)
+    return out
+
+def activation(x, name):
+    '''NumPy implementations of the Keras activations used by the CAE.'''
+    if name in [None, 'linear']:
+        return x
+    elif name == 'relu':
+        return np.maximum(x, 0)
+    elif name == 'elu':
+        return np.where(x > 0, x, np.expm1(np.minimum(x, 0))).astype(x.dtype)
+    elif name == 'selu':
+        alpha, scale = 1.6732632423543772, 1.0507009873554805
+        return (scale*np.where(x > 0, x,
+                               alpha*np.expm1(np.minimum(x, 0)))).astype(x.dtype)
+    elif name == 'tanh':
+        return np.tanh(x)
+    elif name == 'sigmoid':
+        return 1. / (1. + np.exp(-x))
+    elif name in ['swish', 'silu']:
+        return x / (1. + np.exp(-x))
+    elif name == 'softplus':
+        return np.logaddexp(0, x).astype(x.dtype)
+    raise ValueError('Unsupported activation '+str(name))
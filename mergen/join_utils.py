@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+join_utils.py
+
+Aligning feature and label tables by TICID. Every table is a pair of
+(TICIDs, values) with one row per TICID; tables are matched with a sorted
+index (argsort + searchsorted), so a join costs O(N log N) instead of one
+np.nonzero per object. TICIDs missing from a table are always reported.
+
+Joins
+* match_ticid
+* align_to_ticid
+* join_ticid
+* report_missing
+"""
+
+import numpy as np
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Joins :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def match_ticid(ticid, table_ticid):
+    '''Row of table_ticid holding each TICID in ticid, or -1 if it is missing.
+    If a TICID appears more than once in table_ticid, its first row is used.'''
+    ticid = np.asarray(ticid).astype('int64')
+    table_ticid = np.asarray(table_ticid).astype('int64')
+    if len(table_ticid) == 0:
+        return -np.ones(len(ticid), dtype='int')
+    order = np.argsort(table_ticid, kind='stable')
+    srt = table_ticid[order]
+    pos = np.searchsorted(srt, ticid)
+    pos = np.minimum(pos, len(srt)-1)
+    rows = order[pos]
+    rows[srt[pos] != ticid] = -1
+    return rows
+
+def _fill_like(values, n, fill):
+    values = np.asarray(values)
+    dtype = np.result_type(values.dtype, np.asarray(fill).dtype)
+    return np.full((n,)+values.shape[1:], fill, dtype=dtype)
+
+def report_missing(missing, name='table', total=None, fname=None):
+    '''Prints (and optionally appends to fname) the number of TICIDs missing
+    from a table.'''
+    if len(missing) == 0:
+        return
+    msg = '!!! Missing '+str(len(missing))+' TICIDs'
+    if type(total) != type(None):
+        msg += ' (of '+str(total)+')'
+    msg += ' in '+name
+    print(msg)
+    if type(fname) != type(None):
+        with open(fname, 'a') as f:
+            f.write(name+' '+' '.join(np.asarray(missing).astype('str'))+'\n')
+
+def align_to_ticid(ticid, table_ticid, values, fill=np.nan, name='table',
+                   verbose=True, fname=None):
+    '''Left join of one table onto ticid: returns values reordered so that
+    row i belongs to ticid[i]. Rows of missing TICIDs are set to fill (the
+    output dtype is promoted if needed) and reported.'''
+    rows = match_ticid(ticid, table_ticid)
+    found = rows >= 0
+    values = np.asarray(values)
+    if np.all(found):
+        return values[rows]
+    out = _fill_like(values, len(rows), fill)
+    out[found] = values[rows[found]]
+    if verbose:
+        report_missing(np.asarray(ticid)[~found], name=name, total=len(ticid),
+                       fname=fname)
+    return out
+
+def join_ticid(ticid, tables, how='inner', fill=np.nan, verbose=True,
+               fname=None):
+    '''Joins several tables on TICID.
+    Parameters:
+        * ticid : TICIDs of the base table (the order of the output follows
+                  it)
+        * tables : list of (table_ticid, values) pairs, or dictionary
+                   {name: (table_ticid, values)}
+        * how : 'inner' (keep TICIDs found in every table) or 'left' (keep
+                every TICID, missing rows set to fill)
+        * fname : if given, missing TICIDs of each table are appended to it
+    Returns:
+        * ticid : TICIDs of the joined rows
+        * rows : rows of the base table that were kept (to subset any other
+                 arrays aligned with it, e.g. flux or target_info)
+        * values : list of the aligned values of each table
+        * missing : dictionary {table name: TICIDs missing from it}'''
+    if not isinstance(tables, dict):
+        tables = {'table '+str(i): t for i, t in enumerate(tables)}
+    ticid = np.asarray(ticid)
+    matches = {name: match_ticid(ticid, t[0]) for name, t in tables.items()}
+    missing = {}
+    for name in tables:
+        missing[name] = ticid[matches[name] < 0]
+        if verbose:
+            report_missing(missing[name], name=name, total=len(ticid),
+                           fname=fname)
+
+    if how == 'inner':
+        keep = np.ones(len(ticid), dtype='bool')
+        for name in tables:
+            keep &= matches[name] >= 0
+        rows = np.nonzero(keep)[0]
+        values = [np.asarray(t[1])[matches[name][rows]] \
+                  for name, t in tables.items()]
+    elif how == 'left':
+        rows = np.arange(len(ticid))
+        values = []
+        for name, t in tables.items():
+            found = matches[name] >= 0
+            vals = np.asarray(t[1])
+            out = _fill_like(vals, len(ticid), fill)
+            out[found] = vals[matches[name][found]]
+            values.append(out)
+    else:
+        raise ValueError('Unknown join type '+how)
+    return ticid[rows], rows, values, missing
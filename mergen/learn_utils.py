@@ -10,6 +10,7 @@ Clustering algorithms
 * run_dbscan
 * run_hdbscan
 * run_GMM
+* run_streaming_clustering
 * run_LOF
 * KNN_plotting
 * dbscan_param_search
@@ -22,6 +23,7 @@ Clustering algorithms
 
 Deep learning functions
 * autoencoder_preprocessing
+* build_sector_feature_table
 * bottleneck_preprocessing
 * post_process
 * param_summary
@@ -38,8 +40,15 @@ Autoencoder
 * vae_gan
 
 Iterative training scheme
+* transfer_weights
+* stage_key
+* stage_cached
+* reconstruction_error
+* split_by_error
 * split_reconstruction
 * split_segments
+* train_segment
+* train_segments_parallel
 * split_cae
 * iterative_cae
 * iterative_cae_clustering
@@ -57,6 +66,9 @@ Mock data
 Helper functions
 * get_activations
 * get_bottleneck
+* quantize_encoder
+* get_bottleneck_tflite
+* quantization_report
 * compile_model
 * Conv1DTranspose
 * swish
@@ -75,6 +87,7 @@ To Do List:
 import numpy as np
 # # from sklearn.manifold import TSNE
 import os
+import copy
 import pdb
 # # import matplotlib.pyplot as plt
 # import numpy as np
@@ -82,6 +95,13 @@ import pdb
 from . import plot_utils as pt
 # # import data_functions as df
 from . import data_utils as dt
+from . import neighbor_utils as nu
+from . import cluster_utils as cu
+from . import metric_utils as mu
+from . import embed_utils as eu
+from . import join_utils as ju
+from . import table_utils as tu
+from . import product_utils as pu
 # from astropy.io import fits
 # from astropy.timeseries import LombScargle
 # import random
@@ -124,9 +144,19 @@ def run_hdbscan(features, min_cluster_size = 10, metric = 'minkowski', min_sampl
     return clusterer, labels
     
 def run_gmm(ticid, feats, numclstr=100, runiter=False, numiter=1, save=True,
-            savepath='./'):
+            savepath='./', reuse=True):
+    '''Assigns clusters with a GMM. If reuse and the model chosen by
+    gmm_param_search was saved (gmm_model_<numclstr>.npz in savepath) and
+    fitted on the same features, it is loaded instead of refitting.'''
     from sklearn.mixture import GaussianMixture
-    gmm = GaussianMixture(n_components=numclstr, random_state=0).fit(feats)
+    fname = savepath+'gmm_model_'+str(numclstr)+'.npz'
+    if reuse and os.path.exists(fname) and cu.gmm_matches(fname, feats):
+        print('Loading '+fname)
+        gmm = cu.load_gmm(fname)
+    else:
+        if reuse and os.path.exists(fname):
+            print(fname+' was fitted on other features, refitting')
+        gmm = GaussianMixture(n_components=numclstr, random_state=0).fit(feats)
     clstr = gmm.predict(feats)
 
     if save:
@@ -136,34 +166,117 @@ def run_gmm(ticid, feats, numclstr=100, runiter=False, numiter=1, save=True,
         else:
             prefix = ''
             suffix = '_'+str(numclstr)+'.txt'
-        np.savetxt(savepath+prefix+'gmm_labels'+suffix, np.array([ticid, clstr]),
-                   header='TICID,ClusterNumber')
-        print('Saved '+savepath+prefix+'gmm_labels'+suffix)
+        # >> binary product (product_utils) replacing gmm_labels*.txt
+        pu.save_labels(savepath+prefix+'gmm_labels'+suffix, ticid, clstr,
+                       meta={'method': 'gmm', 'numclstr': numclstr})
     return clstr
     
+def run_streaming_clustering(ticid, shards, numclstr=100,
+                             method='online_gmm', n_epochs=1,
+                             chunk_size=10000, save=True, savepath='./',
+                             reuse=True):
+    '''Out-of-core alternative to run_gmm for feature sets that do not fit in
+    memory (e.g. many sectors). The model is fitted chunk by chunk on the
+    feature shards, then every shard is labelled.
+    Parameters:
+        * ticid : TICIDs of the rows of all shards, in order
+        * shards : list of arrays or paths to .npy files (memory-mapped)
+        * method : 'online_gmm' (stochastic EM) or 'minibatch_kmeans'
+        * reuse : if the model <method>_model_<numclstr>.pkl in savepath was
+                  fitted on the same shards, load it and only predict;
+                  otherwise the model is refitted
+    To label a new sector with an existing model, use
+    cluster_utils.load_stream_model and cluster_utils.predict_shards.
+    Returns: clstr, array of cluster numbers'''
+    fname = savepath+method+'_model_'+str(numclstr)+'.pkl'
+    if reuse and os.path.exists(fname) and \
+       cu.stream_model_matches(fname, shards):
+        print('Loading '+fname)
+        model = cu.load_stream_model(fname)
+    else:
+        if reuse and os.path.exists(fname):
+            print(fname+' was fitted on other features, refitting')
+        model = cu.fit_streaming(shards, n_clusters=numclstr, method=method,
+                                 n_epochs=n_epochs, chunk_size=chunk_size)
+        if save:
+            cu.save_stream_model(model, fname, shards=shards)
+    clstr = cu.predict_shards(model, shards, chunk_size=chunk_size)
+
+    if save:
+        out = savepath+method+'_labels_'+str(numclstr)+'.txt'
+        pu.save_labels(out, ticid, clstr,
+                       meta={'method': method, 'numclstr': numclstr})
+    return clstr
+
 def run_LOF(features, n_neighbors = 20, p = 2, metric = 'minkowski', contamination = 0.1,
-            algorithm = 'auto'):
-    from sklearn.neighbors import LocalOutlierFactor
-    
-    clf = LocalOutlierFactor(n_neighbors=n_neighbors, p=p, metric=metric,
-                             contamination=contamination, algorithm=algorithm)
-    clf.fit_predict(features)
-    negative_factor = clf.negative_outlier_factor_
-    
-    lof = -1 * negative_factor
+            algorithm = 'auto', graph=None, cache_file=None, backend='exact'):
+    '''Local outlier factor of every point. The kNN graph (dist, ind) can be
+    passed as graph, or cached in cache_file (see
+    neighbor_utils.cached_knn_graph), so that it is shared with other
+    LOF and k-distance computations. contamination only sets the
+    LocalOutlierFactor threshold and does not change the scores.
+    backend='rpforest' (or 'auto', 'pynndescent') uses approximate neighbors
+    for large feature tables.'''
+    if type(graph) == type(None):
+        graph = nu.cached_knn_graph(features, n_neighbors, fname=cache_file,
+                                    metric=metric, p=p, algorithm=algorithm,
+                                    backend=backend)
+    lof = nu.local_outlier_factor(graph[0], graph[1], n_neighbors=n_neighbors)
     return lof
     
 def run_tsne(features, n_components=2, perplexity=30, early_exaggeration=12,
-             save=True, savepath='./'):
+             save=True, savepath='./', backend='exact', method='sklearn',
+             ticid=None):
     '''Returns low-dimensional t-sidtributed Stochastic Neighbor Embedding to
     visualize high-deimsnional feature spaces. Using PCA to initially reduce
-    the dimensionality will suppress some noise.'''
+    the dimensionality will suppress some noise.
+    With backend='rpforest' (or 'auto', 'pynndescent'), the neighbors used for
+    the affinities are found approximately (see
+    neighbor_utils.ann_knn_graph), and a recall report is saved.
+    method='opentsne', 'umap' or 'auto' uses the multi-threaded backends of
+    embed_utils instead of sklearn, and supports placing new objects
+    (embed_utils.Embedding).
+    Every embedding is cached in savepath by feature hash and parameters, so
+    it is only computed again if the features or parameters change.
+    If ticid is given, the embedding is also saved as a product keyed by
+    TICID (savepath+'tsne/', see product_utils).'''
     from sklearn.manifold import TSNE
     print('Training tSNE...')
-    X = TSNE(n_components=n_components).fit_transform(features)
+    if method != 'sklearn' or backend == 'exact':
+        X = eu.cached_embedding(features, cache_dir=savepath, method=method,
+                                n_components=n_components,
+                                perplexity=perplexity,
+                                early_exaggeration=early_exaggeration)\
+                                .embedding_
+    else:
+        key = eu.features_hash(features, backend=backend,
+                               n_components=n_components,
+                               perplexity=perplexity,
+                               early_exaggeration=early_exaggeration)
+        fname = savepath+'embedding-sklearn-'+backend+'-'+key[:16]+'.npy'
+        if os.path.exists(fname):
+            print('Loading '+fname)
+            X = np.load(fname)
+        else:
+            # >> same number of neighbors as sklearn's exact affinity step
+            k = min(len(features)-1, int(3.*perplexity+1))
+            dist, ind = nu.knn_graph(features, k, backend=backend)
+            if save:
+                nu.recall_report(features, dist, ind,
+                                 fname=savepath+'tsne_ann_recall.txt')
+            X = TSNE(n_components=n_components, perplexity=perplexity,
+                     early_exaggeration=early_exaggeration,
+                     metric='precomputed', init='random', random_state=0)\
+                     .fit_transform(nu.knn_affinity_graph(dist, ind))
+            np.save(fname, X)
+            print('Saved '+fname)
 
     if save:
         np.save(savepath+'tsne.npy', X)
+        if type(ticid) != type(None):
+            pu.save_product(pu.product_path(savepath+'tsne.npy'), ticid,
+                            {'embedding': X}, kind='embedding',
+                            meta={'method': method})
         
         fig, ax = plt.subplots()
         ax.plot(X[:,0], X[:,1], '.k', alpha=0.5, ms=2)
@@ -179,7 +292,12 @@ def load_tsne_from_fits(ensbpath):
         X = hdul[0].data
     return X
 
-def load_tsne(ensbpath):
+def load_tsne(ensbpath, ticid=None):
+    '''t-SNE embedding, reordered to ticid if given (from the product saved
+    by run_tsne; the legacy tsne.npy has no TICIDs and is returned as is).'''
+    path = pu.product_path(ensbpath+'tsne.npy')
+    if type(ticid) != type(None) and os.path.exists(path+'meta.json'):
+        return pu.load_product(path).align('embedding', ticid)
     X = np.load(ensbpath+'tsne.npy')
     return X
 
@@ -207,17 +325,13 @@ def label_clusters(mg, c0='UNCLASSIFIED', t_std=2):
     from sklearn.metrics import confusion_matrix
     from scipy.optimize import linear_sum_assignment 
     
-    # >> find classified inds within thresholds
+    # >> find classified inds within thresholds (cluster centers, distances
+    # >> and thresholds for all clusters at once)
+    groups = cu.GroupBy(mg.clstr)
+    centr, dist = cu.cluster_centr_dist(mg.feats, groups)
+    thresh = cu.cluster_thresholds(dist, groups, t_std=t_std)
     totype_cut = np.copy(mg.totype)
-    for i in np.unique(mg.clstr):
-        inds = np.nonzero(mg.clstr == i)
-
-        # >> find cluster center
-        centr, dist = clstr_centr(mg.feats[inds])
-
-        # >> threshold 
-        thresh = np.median(dist) + t_std*np.std(dist)
-        totype_cut[inds][np.nonzero(dist > thresh)] = c0
+    totype_cut[dist > thresh[groups.codes]] = c0
                 
     inds = np.nonzero(totype_cut != c0)    
     cm  = confusion_matrix(mg.clstr[inds], mg.numtot[inds])
@@ -242,8 +356,8 @@ def label_clusters(mg, c0='UNCLASSIFIED', t_std=2):
         # >> check if there is a real label assigned
         if unqpot[i] != c0:
             otdict[int(unqpot[i])] = unqtot[i]
-    for i in np.unique(mg.clstr):
-        if i not in list(otdict.keys()):
+    for i in groups.keys:
+        if i not in otdict:
             otdict[i] = c0
 
     fname = mg.featpath+'label_eval.txt'
@@ -260,21 +374,13 @@ def label_clusters(mg, c0='UNCLASSIFIED', t_std=2):
     print('Saved '+fname)
 
     # >> create list of predicted otypes (potype)
-    potype = []
+    potype = list(np.array([otdict[i] for i in groups.keys])[groups.codes])
     # fname = ensbpath+'Sector'+str(sector)+'-ticid_to_label.txt'
     # fname = mg.featpath+'s-'+'-'.join(np.unique(mg.sector).astype('str'))+\
     #         '-ticid_to_label.txt'
     fname = mg.featpath+'ticid_to_label.txt'
-    with open(fname, 'w') as f:
-        # f.write('TICID,OTYPE,SECTOR\n')
-        f.write('TICID,OTYPE\n')
-        for i in range(len(mg.objid)):
-            otype = otdict[mg.clstr[i]]
-            potype.append(otype)
-            # !! tmp
-            # f.write(str(ticid[i])+','+otype+','+str(sectors[i])+'\n')
-            f.write(str(mg.objid[i])+','+otype+'\n')
-    print('Saved '+fname)
+    pu.save_product(pu.product_path(fname), mg.objid, {'otype': potype},
+                    kind='predictions')
 
     mg.cm = cm
     mg.otdict = otdict
@@ -283,60 +389,38 @@ def label_clusters(mg, c0='UNCLASSIFIED', t_std=2):
 
 
 
-def label_clusters_2(mg, t_std=2, n_std=1):
+def label_clusters_2(mg, t_std=2, n_std=1, c0='UNCLASSIFIED'):
+
+    # >> find centers and threshold distance from center, for all clusters
+    groups = cu.GroupBy(mg.clstr)
+    cen_clstr, dist = cu.cluster_centr_dist(mg.feats, groups)
+    thr_clstr = cu.cluster_thresholds(dist, groups, t_std=t_std)
+    within = dist < thr_clstr[groups.codes]
 
-    unq_clstr = sorted(np.unique(mg.clstr))
-    cen_clstr = []
-    thr_clstr = []
+    # >> number of classified members of each otype within the threshold
+    ot_cnts, ot = groups.crosstab(mg.totype, weights=within)
+    present, _ = groups.crosstab(mg.totype)
+    keep = ot != c0
+    ot_cnts, ot, present = ot_cnts[:,keep], ot[keep], present[:,keep] > 0
+
+    # >> method 1: label cluster (most abundant label within threshold)
     label = []
-    for i in unq_clstr:
-        if i % 10 == 0:
-            print(i)
-        inds = np.nonzero(mg.clstr == unq_clstr[i])
-
-        # >> find center
-        centr, dist = clstr_centr(mg.feats[inds])
-        cen_clstr.append(centr)
-
-        # >> threshold distance from center
-        thresh = np.median(dist) + t_std*np.std(dist)
-        thr_clstr.append(thresh)
-
-        # >> superimpose histograms of classified 
-        ot, cnts = np.unique(mg.totype[inds], return_counts=True)
-        ot_true = [] 
-        ot_cnts = []
-        for j in range(len(ot)):
-            if ot[j] != 'UNCLASSIFIED':
-                inds_ot = np.nonzero(mg.totype[inds] == ot[j])
-                # ax.hist(dist[inds_ot], bins, alpha=0.5, label=ot[j])
-                ot_true.append(ot[j])
-                ot_cnts.append(np.count_nonzero(dist[inds_ot] < thresh))
-
-        # pdb.set_trace()
-
-        # >> method 1: label cluster (most abundant label within threshold)
-        if len(ot_true) == 0:
-            label.append('UNCLASSIFIED')
-        elif len(ot_true) == 1:
-            label.append(ot_true[0])
+    for k in range(len(groups)):
+        cnts = ot_cnts[k][present[k]]
+        if len(cnts) == 0:
+            label.append(c0)
+        elif len(cnts) == 1:
+            label.append(ot[present[k]][0])
         else:
-            if np.sort(ot_cnts)[-1] > np.sort(ot_cnts)[-2]+n_std*np.std(ot_cnts):
-                label.append(ot_true[np.argmax(ot_cnts)])
+            srt = np.sort(cnts)
+            if srt[-1] > srt[-2]+n_std*np.std(cnts):
+                label.append(ot[present[k]][np.argmax(cnts)])
             else:
-                label.append('UNCLASSIFIED')
+                label.append(c0)
 
-
-    numpot = []
-    for i in range(len(mg.objid)):
-        dist = np.sum((mg.feats[i] - cen_clstr[mg.clstr[i]])**2)
-        if dist < thr_clstr[mg.clstr[i]]:
-            class_ind = list(mg.otdict.values()).index(label[mg.clstr[i]])
-            numpot.append(class_ind)
-        else:
-            unclassified_ind = list(mg.otdict.values()).index('UNCLASSIFIED')
-            numpot.append(unclassified_ind)
-    numpot = np.array(numpot)
+    otypes = list(mg.otdict.values())
+    label_num = np.array([otypes.index(l) for l in label])
+    numpot = np.where(within, label_num[groups.codes], otypes.index(c0))
 
     from sklearn.metrics import confusion_matrix
     # none_ind = list(mg.otdict.values()).index('UNCLASSIFIED')
@@ -360,7 +444,7 @@ def label_clusters_2(mg, t_std=2, n_std=1):
 
 
 ##### PARAM SCANS #####
-def KNN_plotting(savepath, features, k_values):
+def KNN_plotting(savepath, features, k_values, graph=None, cache_file=None):
     """ This is based on a metric for finding the best possible eps/minsamp
     value from the original DBSCAN paper (Ester et al 1996). By calculating the
     average distances to the k-nearest neighbors and plotting
@@ -372,29 +456,36 @@ def KNN_plotting(savepath, features, k_values):
         * features
         * k_values: list of k-values (min_samples) to test
             ie, [2,3,4,10]
-    Returns: nothing"""
+        * graph: kNN graph (dist, ind) from neighbor_utils.knn_graph with at
+          least max(k_values)-1 neighbors. If None, it is computed once (and
+          cached in cache_file, if given) for all k_values
+    Returns: eps, dictionary of the suggested DBSCAN eps for each k"""
     folderpath = savepath + "/KNN_plotting/"
     try:
         os.makedirs(folderpath)
     except OSError:
         print ("Directory %s already exists" % folderpath)
     
-    from sklearn.neighbors import NearestNeighbors
+    if type(graph) == type(None):
+        graph = nu.cached_knn_graph(features, np.max(k_values)-1,
+                                    fname=cache_file)
+    eps = {}
     for n in range(len(k_values)):
-        neigh = NearestNeighbors(n_neighbors=k_values[n])
-        neigh.fit(features)
-        k_dist, k_ind = neigh.kneighbors(features, return_distance=True)
-
-        avg_kdist_sorted = np.sort(np.mean(k_dist, axis=1))[::-1]
+        avg_kdist_sorted = np.sort(nu.mean_knn_distance(graph[0],
+                                                        k_values[n]))[::-1]
+        eps[k_values[n]] = nu.eps_heuristic(graph[0], k_values[n])
         
         plt.scatter(np.arange(len(features)), avg_kdist_sorted)
+        plt.axhline(eps[k_values[n]], color='r', ls='--',
+                    label='eps = {:.3g}'.format(eps[k_values[n]]))
+        plt.legend()
         plt.xlabel("Points")
         plt.ylabel("Average K-Neighbor Distance")
         plt.ylim((0, 30))
         plt.title("K-Neighbor plot for k=" + str(k_values[n]))
         plt.savefig(folderpath + "kneighbors-" +str(k_values[n]) +"-plot-sorted.png")
         plt.close()    
-    return
+    return eps
 def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
                         eps=list(np.arange(0.1,1.5,0.1)),
                         min_samples=[5],
@@ -406,7 +497,8 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
                         output_dir='./', DEBUG=False, single_file=False,
                         simbad_database_txt='./simbad_database.txt',
                         database_dir='./databases/', pca=True, tsne=True,
-                        confusion_matrix=True, tsne_clustering=True):
+                        confusion_matrix=True, tsne_clustering=True,
+                        exact_scores=False):
     '''Performs a grid serach across parameter space for DBSCAN. Calculates
     
     Parameters:
@@ -417,6 +509,8 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
         * success metric : !!
         * output_dir : output directory, ending with '/'
         * DEBUG : if DEBUG, plots first 5 light curves in each class
+        * exact_scores : if False, the silhouette score is estimated from a
+          stratified sample (see metric_utils.cluster_scores)
         
     TODO : only loop over p if metric = 'minkowski'
     '''
@@ -432,12 +526,16 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
     accuracy = []
     param_num = 0
     p0=p
+    graphs = {} # >> radius graph at max(eps) for each (metric, p)
+    fits = {}   # >> DBSCAN fit for each (eps, min_samples, metric, p)
 
     with open(output_dir + 'dbscan_param_search.txt', 'a') as f:
-        f.write('{} {} {} {} {} {} {} {} {} {} {}\n'.format("eps\t\t", "samp\t\t", "metric\t\t", 
+        f.write('{} {} {} {} {} {} {} {} {} {} {} {} {}\n'.format("eps\t\t", "samp\t\t", "metric\t\t", 
                                                          "alg\t\t", "leaf\t", "p\t",
                                                          "classes\t",
-                                                         "silhouette\t\t\t", 'ch\t\t\t', 
+                                                         "silhouette\t\t\t",
+                                                         "sil_lower\t\t\t",
+                                                         "sil_upper\t\t\t", 'ch\t\t\t', 
                                                          'db\t\t\t', 'acc\t'))
 
     for i in range(len(eps)):
@@ -451,12 +549,20 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
                             p = [None]
 
                         for n in range(len(p)):
-                            db = DBSCAN(eps=eps[i],
-                                        min_samples=min_samples[j],
-                                        metric=metric[k],
-                                        algorithm=algorithm[l],
-                                        leaf_size=leaf_size[m],
-                                        p=p[n]).fit(bottleneck)
+                            # >> labels do not depend on algorithm/leaf_size,
+                            # >> and smaller eps reuse the radius graph
+                            key = (eps[i], min_samples[j], metric[k], p[n])
+                            if key not in fits:
+                                if key[2:] not in graphs:
+                                    graphs[key[2:]] = \
+                                        nu.radius_graph(bottleneck, np.max(eps),
+                                                        metric=metric[k],
+                                                        p=p[n])
+                                fits[key] = \
+                                    nu.precomputed_dbscan(graphs[key[2:]],
+                                                          eps[i],
+                                                          min_samples=min_samples[j])
+                            db = fits[key]
                             #print(db.labels_)
                             print(np.unique(db.labels_, return_counts=True))
                             classes_1, counts_1 = \
@@ -494,31 +600,26 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
                                                        leaf_size[m],
                                                        p[n]])
                                 
-                                # >> compute silhouette
-                                print('Computing silhouette score')
-                                silhouette = silhouette_score(bottleneck,db.labels_)
+                                # >> compute silhouette, calinski harabasz
+                                # >> and davies-bouldin scores
+                                print('Computing clustering scores')
+                                silhouette, ch_score, dav_boul_score, sil_ci = \
+                                    mu.cluster_scores(bottleneck, db.labels_,
+                                                      exact=exact_scores,
+                                                      return_ci=True)
                                 silhouette_scores.append(silhouette)
-                                
-                                # >> compute calinski harabasz score
-                                print('Computing calinski harabasz score')
-                                ch_score = calinski_harabasz_score(bottleneck,
-                                                                db.labels_)
                                 ch_scores.append(ch_score)
-                                
-                                # >> compute davies-bouldin score
-                                print('Computing davies-bouldin score')
-                                dav_boul_score = davies_bouldin_score(bottleneck,
-                                                             db.labels_)
                                 db_scores.append(dav_boul_score)
                                 
                             else:
                                 silhouette, ch_score, dav_boul_score = \
                                     np.nan, np.nan, np.nan
+                                sil_ci = (np.nan, np.nan)
                                 
                             print('Saving results to text file')
                             with open(output_dir + 'dbscan_param_search.txt', 'a') as f:
                                 f.write('{}\t\t {}\t\t {}\t\t {}\t {}\t \
-                                        {}\t {}\t\t\t {}\t\t\t {}\t\t\t {}\t {}\n'.format(eps[i],
+                                        {}\t {}\t\t\t {}\t\t\t {}\t\t\t {}\t\t\t {}\t\t\t {}\t {}\n'.format(eps[i],
                                                                    min_samples[j],
                                                                    metric[k],
                                                                    algorithm[l],
@@ -526,6 +627,8 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
                                                                    p[n],
                                                                    len(classes_1),
                                                                    silhouette,
+                                                                   sil_ci[0],
+                                                                   sil_ci[1],
                                                                    ch_score,
                                                                    dav_boul_score,
                                                                    acc))
@@ -555,7 +658,7 @@ def dbscan_param_search(bottleneck, time, flux, ticid, target_info,
                                     print('Plot t-SNE...')
                                     pt.plot_tsne(bottleneck, db.labels_,
                                                  output_dir=output_dir,
-                                                 prefix=prefix)
+                                                 prefix=prefix, cache=True)
                                 # if tsne_clustering:
                                     
                                     
@@ -575,12 +678,12 @@ def load_paramscan_txt(path):
     """ load in the paramscan stuff from the text file
     returns: parameter sets, number of classes, metric scores (in order: silhouettte, db, ch)
     modified [lcg 07292020 - created]"""
-    params = np.genfromtxt(path, dtype=(float, int, 'S10', 'S10', int, int, int, np.float32, np.float32, np.float32), names=['eps', 'minsamp', 'metric', 'algorithm', 'leafsize', 'p', 'numclasses', 'silhouette', 'ch', 'db'])
+    params = np.genfromtxt(path, dtype=(float, int, 'S10', 'S10', int, int, int, np.float32, np.float32, np.float32, np.float32, np.float32, np.float32), names=['eps', 'minsamp', 'metric', 'algorithm', 'leafsize', 'p', 'numclasses', 'silhouette', 'sil_lower', 'sil_upper', 'ch', 'db', 'acc'])
     
     params = np.asarray(params)
     nan_indexes = []
     for n in range(len(params)):
-        if np.isnan(params[n][8]):
+        if np.isnan(params[n]['ch']):
             nan_indexes.append(int(n))
         
     nan_indexes = np.asarray(nan_indexes)
@@ -594,51 +697,55 @@ def load_paramscan_txt(path):
 
 def gmm_param_search(features, ticid, output_dir='./',
                      n_components=[200,150, 250, 50],
-                     tsne=None):
+                     tsne=None, exact_scores=False, n_jobs=1, seed='kmeans++',
+                     early_iter=None, criterion='silhouette', save_model=True):
+    '''Fits a GMM for each number of components and scores the clusterings
+    (see cluster_utils.gmm_select).
+    Parameters:
+        * exact_scores : if False, the silhouette score is estimated from a
+          stratified sample (see metric_utils.cluster_scores)
+        * n_jobs : number of candidate models fitted concurrently
+        * seed : 'kmeans++' seeds the means with k-means++ on a subsample
+        * early_iter : if given, candidates with a poor BIC after early_iter
+          EM iterations are rejected before being run to convergence
+        * criterion : 'silhouette', 'bic' or 'aic', used to pick the winner
+        * save_model : if True, the winning model is saved to
+          gmm_model_<n>.npz so that run_gmm can reuse it
+    Returns: number of components of the winning model'''
     
-    from datetime import datetime
-    from sklearn.mixture import GaussianMixture
-    from sklearn.metrics import silhouette_score, calinski_harabasz_score, \
-        davies_bouldin_score
-
     out = output_dir+'gmm_param_search.txt'
     with open(out, 'w') as f:
-        f.write('n_components,comp_time,Silhouette,Calinski-Harabasz,'+
-                'Davies-Bouldin\n')
+        f.write('n_components,comp_time,Silhouette,Silhouette_lower,'+
+                'Silhouette_upper,Calinski-Harabasz,Davies-Bouldin,BIC,AIC\n')
     print('Touch '+out)
-    scores = []
-    for i in range(len(n_components)): 
-        start = datetime.now() # >> start timer
-
-        gmm = GaussianMixture(n_components=n_components[i])
-        labels = gmm.fit_predict(features) # >> assigns clusters
 
-        suffix = '_'+str(n_components[i])+'.txt'
-        np.savetxt(output_dir+'gmm_labels'+suffix, np.array([ticid, labels]),
-                   header='TICID,ClusterNumber')
-
-        end = datetime.now() # >> end timer
-        dur_sec = (end-start).total_seconds()
-
-        # >> compute silhouette score
-        silhouette = silhouette_score(features, labels)
-
-        # >> compute calinski harabasz score
-        ch_score = calinski_harabasz_score(features, labels)
-
-        # >> compute davies-bouldin score
-        db_score = davies_bouldin_score(features, labels)
-
-        scores.append([silhouette, ch_score, db_score])
+    results = cu.gmm_select(features, n_components, n_jobs=n_jobs, seed=seed,
+                            early_iter=early_iter, exact_scores=exact_scores)
+    scores = []
+    for res in results:
+        scores.append([res['silhouette'], res['ch'], res['db'], res['bic'],
+                       res['aic']])
 
         with open(out, 'a') as f:
-            f.write('{},{},{},{},{}\n'.format(n_components[i], dur_sec, silhouette,
-                                              ch_score, db_score))
-
+            f.write('{},{},{},{},{},{},{},{},{}\n'.format(res['n_components'],
+                                                    res['time'],
+                                                    res['silhouette'],
+                                                    res['silhouette_lower'],
+                                                    res['silhouette_upper'],
+                                                    res['ch'], res['db'],
+                                                    res['bic'], res['aic']))
+        if res['rejected']:
+            continue
+
+        suffix = '_'+str(res['n_components'])+'.txt'
+        # >> same product as run_gmm, so load_gmm_from_txt reads the latest
+        pu.save_labels(output_dir+'gmm_labels'+suffix, ticid, res['labels'],
+                       meta={'method': 'gmm',
+                             'numclstr': res['n_components']})
 
         if type(tsne) != type(None):
-            pt.plot_tsne(features, labels, X=tsne, output_dir=output_dir,
-                         prefix='gmm-ncomp'+str(n_components[i])+'-')
+            pt.plot_tsne(features, res['labels'], X=tsne, output_dir=output_dir,
+                         prefix='gmm-ncomp'+str(res['n_components'])+'-')
 
     print('Wrote '+out)
 
@@ -647,48 +754,76 @@ def gmm_param_search(features, ticid, output_dir='./',
     ax[0,0].plot(n_components, scores[:,0], '.')
     ax[0,0].set_ylabel('Silhouette') # >> higher = better
     ax[0,0].set_xlabel('Number of Components')
-    ind = np.argmax(scores[:,0])
+    ind = np.nanargmax(scores[:,0])
     ax[0,0].plot([n_components[ind]], [scores[:,0][ind]], 'xr', label='best')
     ax[0,0].legend()
 
     ax[1,0].plot(n_components, scores[:,1], '.')
     ax[1,0].set_ylabel('Calinski-Harabasz') # >> higher = better
     ax[1,0].set_xlabel('Number of Components')
-    ind = np.argmax(scores[:,1])
+    ind = np.nanargmax(scores[:,1])
     ax[1,0].plot([n_components[ind]], [scores[:,1][ind]], 'xr', label='best')
     ax[1,0].legend()
 
     ax[0,1].plot(n_components, scores[:,2], '.')
     ax[0,1].set_ylabel('Davies-Bouldin') # >> lower = better
     ax[0,1].set_xlabel('Number of Components')
-    ind = np.argmin(scores[:,2])
+    ind = np.nanargmin(scores[:,2])
     ax[0,1].plot([n_components[ind]], [scores[:,2][ind]], 'xr', label='best')
     ax[0,1].legend()
 
-    ax[1,1].axis('off')
+    ax[1,1].plot(n_components, scores[:,3], '.', label='BIC')
+    ax[1,1].plot(n_components, scores[:,4], '.', label='AIC')
+    ax[1,1].set_ylabel('Information criterion') # >> lower = better
+    ax[1,1].set_xlabel('Number of Components')
+    ax[1,1].legend()
         
     plt.tight_layout()
     plt.savefig(output_dir+'gmm_performance.png')
     plt.close()
     print('Wrote '+output_dir+'gmm_performance.png')
 
-    return n_components[np.argmax(scores[:,0])]
+    if criterion == 'silhouette':
+        ind = np.nanargmax(scores[:,0])
+    elif criterion == 'bic':
+        ind = np.nanargmin(scores[:,3])
+    elif criterion == 'aic':
+        ind = np.nanargmin(scores[:,4])
+    else:
+        raise ValueError('Unknown criterion '+criterion)
+
+    if save_model:
+        cu.save_gmm(results[ind]['gmm'], output_dir+'gmm_model_'+\
+                    str(n_components[ind])+'.npz', features=features)
+
+    return n_components[ind]
 
 
 def quick_hdbscan_param_search(features, ticid, min_samples=[10, 15,50],
                                min_cluster_size=[10, 50,100,500,1000],
                                metric=['euclidean'],
                                p0=[1,2,3,4], output_dir='./',
-                               tsne=None):
+                               tsne=None, sweep=True, exact_scores=False):
+    '''Grid search over HDBSCAN parameters. Scores for each parameter set
+    are written to hdbscan_param_search.txt.
+    * sweep : if True, the spanning tree is built once per (metric, p,
+      min_samples) and cut for every min_cluster_size (see
+      cluster_utils.hdbscan_sweep), and all labels are saved to a single
+      label matrix, hdbscan_labels.npz, whose rows follow the count column
+      of hdbscan_param_search.txt. If False, HDBSCAN is refit for every
+      parameter set and labels are saved to the product
+      hdbscan_labels_<count>/ (see product_utils)
+    * exact_scores : if False, the silhouette score is estimated from a
+      stratified sample (see metric_utils.cluster_scores)'''
     
     import hdbscan
     import sklearn
     from datetime import datetime
 
     with open(output_dir + 'hdbscan_param_search.txt', 'w') as f:
-        f.write('count,num_clusters,comp_time,Silhouette,Calinski-Harabasz,'+\
-                'Davies-Bouldin,min_cluster_size,min_samples,metric,p,'+\
-                'num_noise\n')
+        f.write('count,num_clusters,comp_time,Silhouette,Silhouette_lower,'+\
+                'Silhouette_upper,Calinski-Harabasz,Davies-Bouldin,'+\
+                'min_cluster_size,min_samples,metric,p,num_noise\n')
     if metric[0] == 'all':
         metric = list(hdbscan.dist_metrics.METRIC_MAPPING.keys())
         metric.remove('seuclidean')
@@ -702,61 +837,69 @@ def quick_hdbscan_param_search(features, ticid, min_samples=[10, 15,50],
     count = 0
     scores = []
 
-    for i in range(len(min_cluster_size)):
-        for j in range(len(metric)):
-            if metric[j] == 'minkowski':
-                p = p0
-            else:
-                p = [None]
-            for n in range(len(p)):
-                for k in range(len(min_samples)):    
-                    start = datetime.now() # >> start timer
-                    clusterer = hdbscan.HDBSCAN(min_cluster_size=\
-                                                int(min_cluster_size[i]),
-                                                metric=metric[j],
-                                                min_samples=min_samples[k],
-                                                p=p[n], algorithm='best')
-                    clusterer.fit(features)
-                    labels = clusterer.labels_
-
-                    suffix = '_'+str(count)+'.txt'
-                    np.savetxt(output_dir+'hdbscan_labels'+suffix, np.array([ticid, labels]),
-                               header='TICID,ClusterNumber')
-                    print('Save '+output_dir+'hdbscan_labels'+suffix)
-
-                    end = datetime.now() # >> end timer
-                    dur_sec = (end-start).total_seconds()
-
-                    classes, counts = np.unique(clusterer.labels_,
-                                                return_counts=True)
-        
-                    if len(classes) > 1:
-                        # >> compute silhouette score
-                        silhouette = sklearn.metrics.silhouette_score(features,
-                                                                      labels)
-                        # >> compute calinski harabasz score
-                        ch_score = sklearn.metrics.calinski_harabasz_score(features,
-                                                                           labels)
-                        # >> compute davies-bouldin score
-                        db_score = sklearn.metrics.davies_bouldin_score(features,
-                                                                        labels)
-                    else:
-                        silhouette, ch_score, db_score=None, None, None
-                    scores.append([silhouette, ch_score, db_score])
-                    line = [str(count),str(len(np.unique(classes)-1)),
-                            str(dur_sec),str(silhouette),str(ch_score),
-                            str(db_score),str(min_cluster_size[i]),
-                            str(min_samples[k]),str(metric[j]),str(p[n]),
-                            str(counts[0])]
-                    with open(output_dir + 'hdbscan_param_search.txt', 'a') as f:
-                        f.write(','.join(line))
+    if sweep:
+        params, label_matrix, times = \
+            cu.hdbscan_sweep(features, min_cluster_size=min_cluster_size,
+                             min_samples=min_samples, metric=metric, p=p0)
+        cu.save_label_matrix(output_dir+'hdbscan_labels.npz', ticid,
+                             label_matrix, params)
+    else:
+        params, times = [], []
+        for i in range(len(min_cluster_size)):
+            for j in range(len(metric)):
+                if metric[j] == 'minkowski':
+                    p = p0
+                else:
+                    p = [None]
+                for n in range(len(p)):
+                    for k in range(len(min_samples)):
+                        params.append((min_cluster_size[i], min_samples[k],
+                                       metric[j], p[n]))
+
+    for count in range(len(params)):
+        mcs, ms, met, p_val = params[count]
+        if sweep:
+            labels = label_matrix[count]
+            dur_sec = times[count]
+        else:
+            start = datetime.now() # >> start timer
+            clusterer = hdbscan.HDBSCAN(min_cluster_size=int(mcs),
+                                        metric=met, min_samples=ms,
+                                        p=p_val, algorithm='best')
+            clusterer.fit(features)
+            labels = clusterer.labels_
+
+            suffix = '_'+str(count)+'.txt'
+            pu.save_labels(output_dir+'hdbscan_labels'+suffix, ticid, labels,
+                           meta={'method': 'hdbscan'})
+
+            end = datetime.now() # >> end timer
+            dur_sec = (end-start).total_seconds()
 
-                    if type(tsne) != type(None):
-                        pt.plot_tsne(features, clusterer.labels_, X=tsne,
-                                     output_dir=output_dir,
-                                     prefix='hdbscan-'+str(count)+'-')
+        classes, counts = np.unique(labels, return_counts=True)
+
+        if len(classes) > 1:
+            # >> compute silhouette, calinski harabasz and davies-bouldin
+            silhouette, ch_score, db_score, sil_ci = \
+                mu.cluster_scores(features, labels, exact=exact_scores,
+                                  return_ci=True)
+        else:
+            silhouette, ch_score, db_score=None, None, None
+            sil_ci = (None, None)
+        scores.append([silhouette, ch_score, db_score])
+        line = [str(count),str(len(np.unique(classes)-1)),
+                str(dur_sec),str(silhouette),str(sil_ci[0]),str(sil_ci[1]),
+                str(ch_score),
+                str(db_score),str(mcs),
+                str(ms),str(met),str(p_val),
+                str(counts[0])]
+        with open(output_dir + 'hdbscan_param_search.txt', 'a') as f:
+            f.write(','.join(line)+'\n')
 
-                    count += 1
+        if type(tsne) != type(None):
+            pt.plot_tsne(features, labels, X=tsne,
+                         output_dir=output_dir,
+                         prefix='hdbscan-'+str(count)+'-')
     
 
 def hdbscan_param_search(features, time, flux, ticid, target_info,
@@ -770,7 +913,8 @@ def hdbscan_param_search(features, time, flux, ticid, target_info,
                             pca=False, tsne=False, confusion_matrix=True,
                             single_file=False,
                             data_dir='./data/', save=False,
-                            parents=[], labels=[]):
+                            parents=[], labels=[], sweep=True,
+                            exact_scores=False):
     '''Performs a grid serach across parameter space for HDBSCAN. 
     
     Parameters:
@@ -780,6 +924,11 @@ def hdbscan_param_search(features, time, flux, ticid, target_info,
         * output_dir : output directory, ending with '/'
         * DEBUG : if DEBUG, plots first 5 light curves in each class
         * optional to plot pca & tsne coloring for it
+        * sweep : if True, labels for every min_cluster_size are cut from
+          one spanning tree per (metric, p, min_samples) (see
+          cluster_utils.hdbscan_sweep) instead of refitting HDBSCAN
+        * exact_scores : if False, the silhouette score is estimated from a
+          stratified sample (see metric_utils.cluster_scores)
         
     '''
     import hdbscan         
@@ -805,9 +954,15 @@ def hdbscan_param_search(features, time, flux, ticid, target_info,
         metric.remove('pyfunc')    
 
     with open(output_dir + 'hdbscan_param_search.txt', 'a') as f:
-        f.write('{} {} {} {}\n'.format("min_cluster_size", "min_samples",
-                                       "metric", "p", 'num_classes', 
-                                       'silhouette', 'db', 'ch', 'acc'))
+        f.write('{} {} {} {} {} {} {} {} {} {} {}\n'.format(
+            "min_cluster_size", "min_samples", "metric", "p", 'num_classes',
+            'silhouette', 'sil_lower', 'sil_upper', 'ch', 'db', 'acc'))
+
+    if sweep:
+        params, label_matrix, times = \
+            cu.hdbscan_sweep(features, min_cluster_size=min_cluster_size,
+                             min_samples=min_samples, metric=metric, p=p0)
+        sweep_inds = {params[i]: i for i in range(len(params))}
 
     for i in range(len(min_cluster_size)):
         for j in range(len(metric)):
@@ -817,11 +972,16 @@ def hdbscan_param_search(features, time, flux, ticid, target_info,
                 p = [None]
             for n in range(len(p)):
                 for k in range(len(min_samples)):
-                    clusterer = hdbscan.HDBSCAN(min_cluster_size=int(min_cluster_size[i]),
-                                                metric=metric[j], min_samples=min_samples[k],
-                                                p=p[n], algorithm='best')
-                    clusterer.fit(features)
-                    labels = clusterer.labels_
+                    if sweep:
+                        labels = label_matrix[sweep_inds[(min_cluster_size[i],
+                                                          min_samples[k],
+                                                          metric[j], p[n])]]
+                    else:
+                        clusterer = hdbscan.HDBSCAN(min_cluster_size=int(min_cluster_size[i]),
+                                                    metric=metric[j], min_samples=min_samples[k],
+                                                    p=p[n], algorithm='best')
+                        clusterer.fit(features)
+                        labels = clusterer.labels_
                     
                     if save:
                         hdr=fits.Header()
@@ -846,18 +1006,13 @@ def hdbscan_param_search(features, time, flux, ticid, target_info,
                         counts.append(counts_1)
                         num_noisy.append(counts_1[0])
                         parameter_sets.append([min_cluster_size[i],metric[j],p[n]])
-                        print('Computing silhouette score')
-                        silhouette = silhouette_score(features, labels)
+                        print('Computing clustering scores')
+                        silhouette, ch_score, dav_boul_score, sil_ci = \
+                            mu.cluster_scores(features, labels,
+                                              exact=exact_scores,
+                                              return_ci=True)
                         silhouette_scores.append(silhouette)
-                        
-                        # >> compute calinski harabasz score
-                        print('Computing calinski harabasz score')
-                        ch_score = calinski_harabasz_score(features, labels)
                         ch_scores.append(ch_score)
-                        
-                        # >> compute davies-bouldin score
-                        print('Computing davies-bouldin score')
-                        dav_boul_score = davies_bouldin_score(features, labels)
                         db_scores.append(dav_boul_score)                        
                                     
                         if confusion_matrix:
@@ -878,7 +1033,8 @@ def hdbscan_param_search(features, time, flux, ticid, target_info,
                                                      min_samples[k],
                                                      metric[j], p[n],
                                                      len(classes_1),
-                                                     silhouette, ch_score,
+                                                     silhouette, sil_ci[0],
+                                                     sil_ci[1], ch_score,
                                                      dav_boul_score, acc])) + '\n')
                         # s = '{}\t {}\t {}\t {}\t {}\t {}\t {}\t {}\n'
                         # f.write(s.format(min_cluster_size[i], min_samples[k],
@@ -916,7 +1072,7 @@ def hdbscan_param_search(features, time, flux, ticid, target_info,
                             print('Plot t-SNE...')
                             pt.plot_tsne(features,labels,
                                          output_dir=output_dir,
-                                         prefix=prefix)                
+                                         prefix=prefix, cache=True)                
                     plt.close('all')
                     param_num +=1
 
@@ -953,6 +1109,7 @@ def lof_param_scan(ticid_feat, features,n_neighbors=list(range(10,40,10)),
     
     with open(output_dir + 'lof_param_search.txt', 'a') as f:
         f.write('n_neighbors metric p algorithm contamination rare_LOF\n')
+    graphs = {}
     for i in range(len(n_neighbors)):
         for j in range(len(metric)):
             if metric[j] == 'minkowski':
@@ -960,16 +1117,18 @@ def lof_param_scan(ticid_feat, features,n_neighbors=list(range(10,40,10)),
             else:
                 p = [None]
             for k in range(len(p)):
+                # >> one kNN graph per (metric, p) at max(n_neighbors); the
+                # >> algorithm and contamination do not change the scores
+                if (metric[j], p[k]) not in graphs:
+                    graphs[(metric[j], p[k])] = \
+                        nu.knn_graph(features, np.max(n_neighbors),
+                                     metric=metric[j], p=p[k],
+                                     algorithm=algorithm[0])
+                dist, ind = graphs[(metric[j], p[k])]
+                lof = nu.local_outlier_factor(dist, ind,
+                                              n_neighbors=int(n_neighbors[i]))
                 for l in range(len(algorithm)):
                     for m in range(len(contamination)):
-                        clf = LocalOutlierFactor(n_neighbors=int(n_neighbors[i]),
-                                                 metric=metric[j],
-                                                 p=p[k], algorithm=algorithm[l],
-                                                 contamination=contamination[m])
-                        fit_predictor = clf.fit_predict(features)
-                        negative_factor = clf.negative_outlier_factor_
-                        lof = -1 * negative_factor
-                        
                         with open(output_dir + 'lof_param_search.txt', 'a') as f:
                             f.write('{} {} {} {} {} '.format(int(n_neighbors[i]),
                                                             metric[j], p[k],
@@ -1225,6 +1384,78 @@ def autoencoder_preprocessing(flux, time, ticid=None, target_info=None,
 
 
 
+def build_sector_feature_table(sector, ticid, rms=None, output_dir='./',
+                               prefix='', data_dir='./', bottleneck_dir='./',
+                               cams=[1,2,3,4], ccds=[1,2,3,4]):
+    '''Reads every available feature source of a sector once and saves them
+    as a feature table (output_dir+'feature_table/', see table_utils), so
+    that bottleneck_preprocessing(..., feature_table=...) and other callers
+    can select feature families without re-reading and re-joining the files.
+    Families (each added if its files exist):
+        * ENF : Sector<sector>_features_v0_all.fits in data_dir
+        * CAE : prefix+bottleneck_train/test.fits in bottleneck_dir
+        * TLS : per-CCD _features_v1.fits (rows in the order of ticid)
+        * TIC : Teff, rad, mass, GAIAmag, d from the TIC csv
+        * RMS : rms (rows in the order of ticid)
+    Other families (e.g. DAE) can be added with FeatureTable.add_family.
+    Returns: FeatureTable'''
+    families = {}
+    fname = data_dir + 'Sector'+str(sector)+'_features_v0_all.fits'
+    if os.path.exists(fname):
+        with fits.open(fname) as hdul:
+            families['ENF'] = (hdul[1].data, hdul[0].data)
+
+    fname = bottleneck_dir+prefix+'bottleneck_train.fits'
+    if os.path.exists(fname):
+        bottleneck, ticid_cae = [], []
+        for suffix in ['train', 'test']:
+            fname = bottleneck_dir+prefix+'bottleneck_'+suffix+'.fits'
+            if os.path.exists(fname):
+                with fits.open(fname) as hdul:
+                    bottleneck.append(hdul[0].data)
+                    ticid_cae.append(hdul[1].data)
+        families['CAE'] = (np.concatenate(ticid_cae),
+                           np.concatenate(bottleneck, axis=0))
+
+    fnames = [data_dir+'Sector'+str(sector)+'/'+'Sector'+str(sector)+'Cam'+\
+              str(cam)+'CCD'+str(ccd)+'/'+'Sector'+str(sector)+'Cam'+\
+              str(cam)+'CCD'+str(ccd)+'_features_v1.fits' \
+              for cam in cams for ccd in ccds]
+    if all([os.path.exists(f) for f in fnames]):
+        tls = []
+        for fname in fnames:
+            with fits.open(fname) as hdul:
+                tls.append(hdul[0].data)
+        tls = np.concatenate(tls, axis=0)
+        if len(tls) == len(ticid):
+            families['TLS'] = (ticid, tls)
+        else:
+            print('!!! TLS features do not match ticid, skipping TLS')
+
+    fname = data_dir+'Sector'+str(sector)+'/Sector'+str(sector)+\
+        'tic_cat_all.csv'
+    if os.path.exists(fname):
+        import pandas as pd
+        columns = ['Teff', 'rad', 'mass', 'GAIAmag', 'd']
+        tic_cat = pd.read_csv(fname)
+        families['TIC'] = (tic_cat['ID'].to_numpy(),
+                           tic_cat[columns].to_numpy(), columns)
+
+    if type(rms) != type(None):
+        families['RMS'] = (ticid, np.reshape(rms, (-1, 1)), ['rms'])
+
+    # >> rows with nans in a family are treated as missing from it
+    for name in families:
+        family = list(families[name])
+        good = np.all(~np.isnan(np.asarray(family[1], dtype=np.float64)\
+                                .reshape(len(family[1]), -1)), axis=1)
+        family[0], family[1] = np.asarray(family[0])[good], \
+            np.asarray(family[1])[good]
+        families[name] = tuple(family)
+
+    return tu.build_feature_table(output_dir+'feature_table/', ticid,
+                                  families)
+
 def bottleneck_preprocessing(sector, flux, ticid, target_info,
                              rms=None,
                              output_dir='./SectorX/', prefix='',
@@ -1234,7 +1465,8 @@ def bottleneck_preprocessing(sector, flux, ticid, target_info,
                              use_tess_features=True,
                              use_tls_features=True,
                              use_rms=True, norm=False,
-                             cams=[1,2,3,4], ccds=[1,2,3,4], log=False):
+                             cams=[1,2,3,4], ccds=[1,2,3,4], log=False,
+                             feature_table=None):
     '''Concatenates features (assumes features are already calculated and
     saved).
     
@@ -1252,9 +1484,36 @@ def bottleneck_preprocessing(sector, flux, ticid, target_info,
               * learned_features : bottleneck of the convolutional autoencoder
               * engineered_features : custom features (e.g. kurtosis, skew)
               * tess_features : Teff, mass, rad, GAIAmag, d
+        * feature_table : directory of a feature table built with
+          build_sector_feature_table. If given, the selected feature families
+          are read from it instead of the source files
               
     Returns feature vector for every light curve in TICID.
     '''
+
+    if type(feature_table) != type(None):
+        families = []
+        for use, name in [(use_tess_features, 'TIC'),
+                          (use_engineered_features, 'ENF'),
+                          (use_learned_features, 'CAE'), (use_rms, 'RMS'),
+                          (use_tls_features, 'TLS')]:
+            if use:
+                families.append(name)
+        table = tu.load_feature_table(feature_table)
+        ticid_table, features = table.select(families)
+        rows = ju.match_ticid(ticid_table, ticid)
+        keep = rows >= 0
+        features, rows = features[keep], rows[keep]
+        if log:
+            features = np.array(features)
+            for name in ['TIC', 'RMS']:
+                if name in families:
+                    cols = [table.columns(families).index(c) for c in \
+                            table.columns([name])]
+                    features[:,cols] = np.log(features[:,cols])
+        if norm:
+            features = dt.standardize(features, ax=0)
+        return features, flux[rows], ticid[rows], target_info[rows]
     
     features = []
     
@@ -1264,11 +1523,10 @@ def bottleneck_preprocessing(sector, flux, ticid, target_info,
             engineered_feature_vector = hdul[0].data
             engineered_feature_ticid = hdul[1].data
         # >> re-arrange so that engineered_feature_ticid[i] = ticid[i]
-        tmp = []
-        for i in range(len(ticid)):
-            ind = np.nonzero(engineered_feature_ticid == ticid[i])
-            tmp.append(engineered_feature_vector[ind])
-        engineered_feature_vector = np.array(tmp).reshape((len(ticid), 16))
+        engineered_feature_vector = \
+            ju.align_to_ticid(ticid, engineered_feature_ticid,
+                              engineered_feature_vector,
+                              name='engineered features')
         features.append(engineered_feature_vector)
             
     if use_learned_features:
@@ -1283,13 +1541,14 @@ def bottleneck_preprocessing(sector, flux, ticid, target_info,
         ticid_learned = np.concatenate([ticid_bottleneck_train,
                                         ticid_bottleneck_test])
         
-        intersection, comm1, comm2 = np.intersect1d(ticid_learned, ticid,
-                                                    return_indices=True)
-        
-        flux = flux[comm2]
-        ticid = ticid[comm2]
-        target_info = target_info[comm2]
-        learned_feature_vector = learned_feature_vector[comm1]
+        ticid, rows, [learned_feature_vector], _ = \
+            ju.join_ticid(ticid, {'learned features': (ticid_learned,
+                                                       learned_feature_vector)})
+        flux = flux[rows]
+        target_info = target_info[rows]
+        if use_engineered_features:
+            engineered_feature_vector = engineered_feature_vector[rows]
+            features = [engineered_feature_vector]
         features.append(learned_feature_vector)
         
     if use_tls_features:
@@ -1307,6 +1566,7 @@ def bottleneck_preprocessing(sector, flux, ticid, target_info,
                     
         # >> concatenate
         engineered_features_v1 = np.concatenate(engineered_features_v1, axis=0)
+        ticid_orig = ticid
             
         # >> take out any light curves with nans
         inds = np.nonzero(np.prod(~np.isnan(engineered_features_v1), axis=1))
@@ -1318,13 +1578,12 @@ def bottleneck_preprocessing(sector, flux, ticid, target_info,
         features.append(engineered_features_v1)
         
         if use_learned_features:
-            intersection, comm1, comm2 = np.intersect1d(ticid_v1, ticid,
-                                                        return_indices=True)
-            target_info = target_info_v1[comm1]
-            ticid = ticid_v1[comm1]
-            
-            flux = flux_v1[comm1]
-            learned_feature_vector = learned_feature_vector[comm2]
+            ticid, rows, [learned_feature_vector], _ = \
+                ju.join_ticid(ticid_v1, {'learned features': \
+                                         (ticid_orig, learned_feature_vector)})
+            target_info = target_info_v1[rows]
+            flux = flux_v1[rows]
+            engineered_features_v1 = engineered_features_v1[rows]
             features = []
             features.append(learned_feature_vector)
             features.append(engineered_features_v1)
@@ -1346,10 +1605,9 @@ def bottleneck_preprocessing(sector, flux, ticid, target_info,
         inds = np.nonzero(np.prod(~np.isnan(tess_features), axis=1))
         tess_features = tess_features[inds]
         ticid_tess = ticid_tess[inds]
-        intersection, comm1, comm2 = np.intersect1d(ticid_tess, ticid,
-                                                    return_indices=True)
         # >> take intersection, and get rid of TICID column
-        tess_features = tess_features[comm1]
+        ticid, comm2, [tess_features], _ = \
+            ju.join_ticid(ticid, {'TESS features': (ticid_tess, tess_features)})
         if log:
             tess_features = np.log(tess_features)        
         features = []
@@ -1357,7 +1615,6 @@ def bottleneck_preprocessing(sector, flux, ticid, target_info,
         
         target_info = target_info[comm2]
         flux = flux[comm2]
-        ticid = intersection
         
         if use_engineered_features:
             engineered_feature_vector = engineered_feature_vector[comm2]
@@ -1408,12 +1665,9 @@ def load_bottleneck_from_fits(bottleneck_dir, ticid, runIter=False, numIter=1):
     ticid_learned = np.concatenate([ticid_bottleneck_train,
                                     ticid_bottleneck_test])
 
-    sorted_inds = np.argsort(ticid)
-    # >> intersect1d returns sorted arrays, so
-    # >> ticid == ticid[sorted_inds][np.argsort(sorted_inds)]
-    new_inds = np.argsort(sorted_inds)
-    _, comm1, comm2 = np.intersect1d(ticid, ticid_learned, return_indices=True)
-    learned_feature_vector = learned_feature_vector[comm2][new_inds]
+    learned_feature_vector = ju.align_to_ticid(ticid, ticid_learned,
+                                               learned_feature_vector,
+                                               name='CAE-learned features')
 
     return learned_feature_vector
         
@@ -1428,15 +1682,12 @@ def load_bottleneck(savepath):
         bottleneck_train.extend(np.load(savepath+'model/'+fname))    
     return np.array(bottleneck_train)
 
-def load_reconstructions(featpath):
-    filo = fits.open(output_dir + 'x_predict_train.fits')
-    rcon = filo[0].data
-    ticid_filo = filo[1].data
+def load_reconstructions(featpath, ticid):
+    with fits.open(featpath + 'x_predict_train.fits') as filo:
+        rcon = filo[0].data
+        ticid_filo = filo[1].data
 
-    sorted_inds = np.argsort(ticid)
-    new_inds = np.argsort(sorted_inds)
-    _, comm1, comm2 = np.intersect1d(ticid, ticid_filo, return_indices=True)
-    rcon = rcon[comm2][new_inds]
+    rcon = ju.align_to_ticid(ticid, ticid_filo, rcon, name='reconstructions')
 
     return rcon
 
@@ -1450,26 +1701,13 @@ def load_gmm_from_txt(output_dir, ticid, runIter=False, numIter=1,
     else:
         prefix = ''
         suffix = '_'+str(numClusters)+'.txt'
-    txt = np.loadtxt(output_dir+prefix+'gmm_labels'+suffix)
-    ticid_cluster = txt[0].astype('int')
-    clusters = txt[1]
-
-    # sorted_inds = np.argsort(ticid)
-    # # >> intersect1d returns sorted arrays, so
-    # # >> ticid == ticid[sorted_inds][np.argsort(sorted_inds)]
-    # new_inds = np.argsort(sorted_inds)
-    # _, comm1, comm2 = np.intersect1d(ticid, ticid_cluster, return_indices=True)
-    # clusters = clusters[comm2][new_inds]
-
-    match = []
-    # for i in range(len(ticid)):
-    for i in range(len(ticid_cluster)):
-        match.append(ticid_cluster[i] == ticid[i])
-    if len(ticid) != np.count_nonzero(np.array(match)):
-        print('!!! Missing '+str(len(ticid)-np.count_nonzero(np.array(match)))+\
-             ' TICIDs')
-
-    return clusters.astype('int')
+    # >> reorder to match ticid (missing TICIDs get cluster -1); falls back to
+    # >> the legacy text file if there is no binary product
+    clusters = pu.read_column(output_dir+prefix+'gmm_labels'+suffix, 'clstr',
+                              ticid, fill=-1, legacy=pu.parse_legacy_labels,
+                              name='GMM labels')
+
+    return clusters
 
 def post_process(x, x_train, x_test, ticid_train, ticid_test, target_info_train,
                  target_info_test,
@@ -1635,24 +1873,27 @@ def post_process(x, x_train, x_test, ticid_train, ticid_test, target_info_train,
                                               min_samples=[3], min_cluster_size=[3],
                                               data_dir=data_dir)
 
-            if os.path.exists(output_dir+prefix+'hdbscan_labels.txt'):
-                _, labels = np.loadtxt(output_dir+prefix+'hdbscan_labels.txt')
+            fname = output_dir+prefix+'hdbscan_labels.txt'
+            if pu.has_product(fname):
+                labels = pu.read_column(fname, 'clstr', ticid_feat, fill=-1,
+                                        legacy=pu.parse_legacy_labels)
             else:
                 import hdbscan
                 clusterer = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size, 
                                             min_samples=min_samples,
                                             metric=metric).fit(features)
                 labels = clusterer.labels_
-                np.savetxt(output_dir+prefix+'hdbscan_labels.txt',
-                           np.array([ticid_feat, labels]))
+                pu.save_labels(fname, ticid_feat, labels,
+                               meta={'method': 'hdbscan'})
                 
         # -- GMM ---------------------------------------------------------------
         if run_gmm:
             print('Training GMM with '+str(n_components)+' components...')
             gmm = GaussianMixture(n_components=n_components)
             labels = gmm.fit_predict(features)
-            np.savetxt(output_dir+prefix+'gmm_labels.txt',
-                       np.array([ticid_feat, labels]))
+            pu.save_labels(output_dir+prefix+'gmm_labels.txt', ticid_feat,
+                           labels, meta={'method': 'gmm',
+                                         'numclstr': n_components})
         
         pt.classification_plots(features, x, flux_feat, ticid_feat, info_feat,
                                 labels, output_dir=output_dir, prefix=prefix,
@@ -2149,15 +2390,7 @@ def conv_autoencoder(x_train, y_train, x_test=None, y_test=None, params=None,
     # -- initialize weights ---------------------------------------------------
     if type(model_init) != type(None):
         print('Re-initializing weights')
-        model1 = tf.keras.models.load_model(model_init, custom_objects={'tf': tf}) 
-        conv_inds1 = np.nonzero(['conv' in x.name for x in model1.layers])[0]
-        conv_inds2 = np.nonzero(['conv' in x.name for x in model.layers])[0]
-        dense_inds1 = np.nonzero(['dense' in x.name for x in model1.layers])[0]
-        dense_inds2 = np.nonzero(['dense' in x.name for x in model.layers])[0]        
-        for i in range(len(conv_inds1)):
-            model.layers[conv_inds2[i]].set_weights(model1.layers[conv_inds1[i]].get_weights())
-        for i in range(len(dense_inds1)):
-            model.layers[conv_inds2[i]].set_weights(model1.layers[conv_inds1[i]].get_weights())        
+        transfer_weights(model, model_init)
     
     # -- compile model --------------------------------------------------------
     print('Compiling model...')
@@ -3037,6 +3270,95 @@ def vae_gan(x_train, y_train, x_test, y_test, params,
 # :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::;::
 # ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
  
+def transfer_weights(model, model_init):
+    '''Warm-starts model from the weights of model_init (a Keras model or a
+    path to a saved model). Convolutional and dense layers are matched in
+    order of appearance, and weights are only copied where the shapes agree,
+    so a model trained on full light curves can seed a model trained on
+    shorter segments or with a different latent dimension.
+    Returns: number of layers transferred'''
+    if type(model_init) == type(str()):
+        model_init = tf.keras.models.load_model(model_init,
+                                                custom_objects={'tf': tf})
+    n_transferred = 0
+    for kind in ['conv', 'batch_normalization', 'dense']:
+        inds1 = np.nonzero([kind in l.name for l in model_init.layers])[0]
+        inds2 = np.nonzero([kind in l.name for l in model.layers])[0]
+        for i, j in zip(inds1, inds2):
+            w1 = model_init.layers[i].get_weights()
+            w2 = model.layers[j].get_weights()
+            if len(w1) == len(w2) and \
+               all([a.shape == b.shape for a, b in zip(w1, w2)]):
+                model.layers[j].set_weights(w1)
+                n_transferred += 1
+    print('Transferred weights for '+str(n_transferred)+' layers')
+    return n_transferred
+
+def stage_key(*args):
+    '''Returns a hash identifying an iteration of the iterative CAE scheme
+    from its inputs, e.g. stage_key(iteration, ticid, params). Arrays are
+    hashed by content, dictionaries by their sorted items.'''
+    import hashlib
+    h = hashlib.sha1()
+    for arg in args:
+        if isinstance(arg, np.ndarray):
+            h.update(str(arg.dtype).encode())
+            h.update(str(arg.shape).encode())
+            h.update(np.ascontiguousarray(arg).tobytes())
+        elif isinstance(arg, dict):
+            h.update(repr(sorted([(str(k), repr(v)) for k, v in \
+                                  arg.items()])).encode())
+        else:
+            h.update(repr(arg).encode())
+    return h.hexdigest()
+
+def stage_cached(output_dir, prefix, stage, key):
+    '''True if the artifacts of stage (e.g. 'train', 'post_process') saved
+    with prefix in output_dir were produced with the same key.'''
+    fname = output_dir+prefix+stage+'_cache_key.txt'
+    if not os.path.exists(fname):
+        return False
+    with open(fname, 'r') as f:
+        return f.read().strip() == key
+
+def save_stage_key(output_dir, prefix, stage, key):
+    with open(output_dir+prefix+stage+'_cache_key.txt', 'w') as f:
+        f.write(key+'\n')
+
+def reconstruction_error(x, x_predict, chunk_size=1024, power=3):
+    '''Mean |x - x_predict|**power for each target, computed chunk by chunk
+    so that only chunk_size rows are held in memory at once.
+    Parameters:
+        * x, x_predict : arrays, memmaps or paths to .npy files with shape
+                         (num light curves, num data points[, 1])
+        * chunk_size : number of light curves per chunk
+    Returns: err, shape=(num light curves,)'''
+    if type(x) == type(str()):
+        x = np.load(x, mmap_mode='r')
+    if type(x_predict) == type(str()):
+        x_predict = np.load(x_predict, mmap_mode='r')
+
+    err = np.empty(len(x))
+    for start in range(0, len(x), chunk_size):
+        end = start + chunk_size
+        diff = np.asarray(x[start:end], dtype=np.float64) - x_predict[start:end]
+        diff = diff.reshape(len(diff), -1)
+        np.abs(diff, out=diff)
+        err[start:end] = np.mean(diff**power, axis=1)
+    return err
+
+def split_by_error(err, error_threshold=0.5):
+    '''Splits targets into the lowest error_threshold fraction of
+    reconstruction errors and the rest, using a partial sort.
+    Returns: (inds_low, inds_high), each sorted in ascending index order'''
+    split_ind = int(error_threshold*len(err))
+    if split_ind <= 0:
+        return np.empty(0, dtype='int'), np.arange(len(err))
+    if split_ind >= len(err):
+        return np.arange(len(err)), np.empty(0, dtype='int')
+    part = np.argpartition(err, split_ind)
+    return np.sort(part[:split_ind]), np.sort(part[split_ind:])
+
 def split_reconstruction(x, flux_train, flux_test,
                          x_train, x_test, x_predict_train, x_predict_test, 
                          ticid_train, ticid_test, target_info_train, 
@@ -3044,84 +3366,81 @@ def split_reconstruction(x, flux_train, flux_test,
                          n_split=2, input_psd=False,
                          concat_ext_feats=False, train_psd_only=False,
                          error_threshold=0.5, 
-                         return_highest_error_ticid=True, output_dir='./', prefix=''):
+                         return_highest_error_ticid=True, output_dir='./',
+                         prefix='', chunk_size=1024, return_inds=False):
+    '''Splits the training and testing sets by reconstruction error. Errors
+    are computed chunk by chunk (x_train, x_predict_train, ... may be memmaps)
+    and the split uses a partial sort, so no full-size error temporary or
+    reordered copies are made.
+    Parameters:
+        * error_threshold : fraction of targets assigned to the low
+                            reconstruction error set
+        * return_inds : if True, only return the index sets
+                        (inds_train, inds_test), each a list of
+                        [low error indices, high error indices]
+    '''
     if len(x_test) == 0:
         x_predict_test = np.empty((0, x_train.shape[-1]))
     
-    # if concat_ext_feats or input_psd: 
-    #     err_train = (x_train[0] - x_predict_train[0])**2
-    #     err_test = (x_test[0] - x_predict_test[0])**2
-    # else:      
-    #     err_train = (x_train - x_predict_train)**2
-    #     err_test = (x_test - x_predict_test)**2
-        
     if concat_ext_feats or input_psd: 
-        err_train = np.abs(x_train[0] - x_predict_train[0])**3
-        err_test = np.abs(x_test[0] - x_predict_test[0])**3
+        err_train = reconstruction_error(x_train[0], x_predict_train[0],
+                                         chunk_size=chunk_size)
+        err_test = reconstruction_error(x_test[0], x_predict_test[0],
+                                        chunk_size=chunk_size)
     else:      
-        err_train = np.abs(x_train - x_predict_train)**3
-        err_test = np.abs(x_test - x_predict_test)**3
-        
-    err_train = np.mean(err_train, axis=1)
-    err_train = err_train.reshape(np.shape(err_train)[0])
-    ranked_train = np.argsort(err_train)
-    err_test = np.mean(err_test, axis=1)
-    err_test = err_test.reshape(np.shape(err_test)[0])
-    ranked_test = np.argsort(err_test)    
+        err_train = reconstruction_error(x_train, x_predict_train,
+                                         chunk_size=chunk_size)
+        err_test = reconstruction_error(x_test, x_predict_test,
+                                        chunk_size=chunk_size)
+
+    inds_train = list(split_by_error(err_train, error_threshold))
+    inds_test = list(split_by_error(err_test, error_threshold))
     del err_train
     del err_test
-    
-    # >> re-order arrays
-    flux_train = flux_train[ranked_train]
-    ticid_train = ticid_train[ranked_train]
-    info_train = target_info_train[ranked_train]
-    flux_test = flux_test[ranked_test]
-    ticid_test = ticid_test[ranked_test]
-    info_test = target_info_test[ranked_test]
+
+    np.savetxt(output_dir+prefix+'ticid_highest_error_train.txt',
+               ticid_train[inds_train[1]])
+    np.savetxt(output_dir+prefix+'ticid_lowest_error_train.txt',
+               ticid_train[inds_train[0]])
+    np.savetxt(output_dir+prefix+'ticid_highest_error_test.txt',
+               ticid_test[inds_test[1]])
+    np.savetxt(output_dir+prefix+'ticid_lowest_error_test.txt',
+               ticid_test[inds_test[0]])
+
+    if return_inds:
+        return inds_train, inds_test
+
+    # >> gather subsets (one copy per subset, no intermediate reordering)
+    def take(arr, inds):
+        if type(arr) == type(None):
+            return [None for _ in inds]
+        return [arr[i] for i in inds]
+
     if concat_ext_feats or input_psd:
-        x_train = x_train[0][ranked_train]
-        x_train_feat = x_train[1][ranked_train]
-        x_test = x_test[0][ranked_test]
-        x_test_feat = x_test[1][ranked_test]
+        x_train_feat = take(x_train[1], inds_train)
+        x_test_feat = take(x_test[1], inds_test)
+        x_train = [[a, b] for a, b in zip(take(x_train[0], inds_train),
+                                          x_train_feat)]
+        x_test = [[a, b] for a, b in zip(take(x_test[0], inds_test),
+                                         x_test_feat)]
     else:
-        x_train = x_train[ranked_train]
-        x_test = x_test[ranked_test]
-        
-    # >> now split
-    train_len = len(x_train)
-    test_len = len(x_test)
-    # split_ind = int(train_len/n_split)
-    split_ind = int(error_threshold*train_len)
-    flux_train = np.split(flux_train, [split_ind])
-    flux_test = np.split(flux_test, [split_ind])
-    x_train = np.split(x_train, [split_ind])
-    x_test = np.split(x_test, [split_ind])
-    if concat_ext_feats or input_psd:
-        x_train_feat = np.split(x_train_feat, [split_ind])
-        x_train[0] = np.concatenate([x_train[0], x_train_feat[0]], axis=0)
-        x_train[1] = np.concatenate([x_train[1], x_train_feat[1]], axis=0)        
-        x_test_feat = np.split(x_test_feat, [split_ind])
-        x_test[0] = np.concatenate([x_test[0], x_test_feat[0]], axis=0)
-        x_test[1] = np.concatenate([x_test[1], x_test_feat[1]], axis=0)
-    ticid_train = np.split(ticid_train, [split_ind])
-    info_train = np.split(info_train, [split_ind])
-    ticid_test = np.split(ticid_test, [split_ind])
-    info_test = np.split(info_test, [split_ind])    
-    features = np.split(features, [split_ind])
-    x_predict_train = np.split(x_predict_train, [split_ind])
-    x_predict_test = np.split(x_predict_test, [split_ind])
+        x_train = take(x_train, inds_train)
+        x_test = take(x_test, inds_test)
+    flux_train = take(flux_train, inds_train)
+    flux_test = take(flux_test, inds_test)
+    ticid_train = take(ticid_train, inds_train)
+    ticid_test = take(ticid_test, inds_test)
+    info_train = take(target_info_train, inds_train)
+    info_test = take(target_info_test, inds_test)
+    features = take(features, inds_train)
+    x_predict_train = take(x_predict_train, inds_train)
+    x_predict_test = take(x_predict_test, inds_test)
     
     if train_psd_only:
         x_train = x_train_feat
         x_test = x_test_feat
         x = x[1]
 
-    np.savetxt(output_dir+prefix+'ticid_highest_error_train.txt', ticid_train[1])
-    np.savetxt(output_dir+prefix+'ticid_lowest_error_train.txt', ticid_train[0])
-    np.savetxt(output_dir+prefix+'ticid_highest_error_test.txt', ticid_test[1])
-    np.savetxt(output_dir+prefix+'ticid_lowest_error_test.txt', ticid_test[0])
-    
-
     if return_highest_error_ticid:
         return x, flux_train[-1], flux_test[-1], x_train[-1], x_test[-1],\
             ticid_train[-1], ticid_test[-1], info_train[-1], info_test[-1],\
@@ -3198,11 +3517,150 @@ def split_segments(x, x_train, x_test, p, target_info_train, target_info_test,
     return x, x_train, x_test, rms_train, rms_test
 
 
+def train_segment(x, x_train, x_test, prefix, p, ticid_train, ticid_test,
+                  target_info_train, target_info_test, output_dir='./',
+                  save_model_epoch=False, model_init=None, plot=False):
+    '''Trains the CAE for a single light curve segment (see split_cae) and
+    returns its training set bottleneck.'''
+    model, history, bottleneck_train, bottleneck_test, x_predict, x_predict_train = \
+        conv_autoencoder(x_train, x_train, x_test, x_test, p,
+                         ticid_train=ticid_train, ticid_test=ticid_test,
+                         val=False, save_model=True, predict=True, 
+                         save_bottleneck=True, prefix=prefix,
+                         output_dir=output_dir,
+                         save_model_epoch=save_model_epoch,
+                         model_init=model_init)
+
+    if plot:
+        pt.diagnostic_plots(history, model, p, output_dir, x, x_train, x_test,
+                            x_predict, x_predict_train=x_predict_train,
+                            target_info_test=target_info_test,
+                            target_info_train=target_info_train, prefix=prefix,
+                            ticid_train=ticid_train, ticid_test=ticid_test, 
+                            bottleneck_train=bottleneck_train, bottleneck=bottleneck_test,
+                            plot_epoch = True,
+                            plot_in_out = False,
+                            plot_in_out_train = True,
+                            plot_in_bottle_out=False,
+                            plot_latent_test = False,
+                            plot_latent_train = True,
+                            plot_kernel=False,
+                            plot_intermed_act=False,
+                            make_movie = False,
+                            plot_lof_test=False,
+                            plot_lof_train=False,
+                            plot_lof_all=False,
+                            plot_reconstruction_error_test=False,
+                            plot_reconstruction_error_train=True,
+                            plot_reconstruction_error_all=False,
+                            load_bottleneck=True)
+    return bottleneck_train
+
+def _to_shared(arr):
+    '''Copies arr into a new shared memory block. Returns the block and a
+    picklable (name, shape, dtype) descriptor.'''
+    from multiprocessing import shared_memory
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    view[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+def _from_shared(desc):
+    '''Attaches to a shared memory block made by _to_shared and returns it
+    with a (zero-copy) array view.'''
+    from multiprocessing import shared_memory
+    name, shape, dtype = desc
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def _train_segment_worker(args):
+    i, descs, prefix, threads_per_job, kwargs = args
+    if type(threads_per_job) != type(None):
+        tf.config.threading.set_intra_op_parallelism_threads(threads_per_job)
+        tf.config.threading.set_inter_op_parallelism_threads(threads_per_job)
+    blocks, views = [], []
+    for desc in descs:
+        shm, view = _from_shared(desc)
+        blocks.append(shm)
+        views.append(view)
+    try:
+        bottleneck_train = train_segment(*views, prefix, **kwargs)
+        return i, np.array(bottleneck_train)
+    finally:
+        del views
+        for shm in blocks:
+            shm.close()
+
+def train_segments_parallel(x, x_train, x_test, prefix0, n_jobs=4,
+                            threads_per_job=None, **kwargs):
+    '''Trains one CAE per segment in a pool of n_jobs processes. Segments
+    are handed to the workers as views into shared memory, and the
+    bottlenecks are returned in segment order regardless of which process
+    finishes first.
+    Parameters:
+        * x, x_train, x_test : lists of segments, as returned by
+                               split_segments
+        * threads_per_job : TensorFlow/BLAS threads per process. Defaults to
+                            the number of cores divided by n_jobs
+        * kwargs : passed to train_segment
+    Returns: list of training set bottlenecks, one per segment'''
+    import multiprocessing as mp
+    from concurrent.futures import ProcessPoolExecutor
+
+    n_split = len(x_train)
+    n_jobs = min(n_jobs, n_split)
+    if type(threads_per_job) == type(None):
+        threads_per_job = max(1, (os.cpu_count() or 1) // n_jobs)
+
+    # >> limit BLAS threads in the workers (inherited through the environment)
+    env = {}
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        env[var] = os.environ.get(var)
+        os.environ[var] = str(threads_per_job)
+
+    blocks, tasks = [], []
+    try:
+        for i in range(n_split):
+            descs = []
+            for arr in [x[i], x_train[i], x_test[i]]:
+                shm, desc = _to_shared(arr)
+                blocks.append(shm)
+                descs.append(desc)
+            tasks.append((i, descs, prefix0+'segment'+str(i)+'-',
+                          threads_per_job, kwargs))
+
+        print('Training '+str(n_split)+' segments in '+str(n_jobs)+\
+              ' processes ('+str(threads_per_job)+' threads each)...')
+        bottlenecks = [None]*n_split
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 mp_context=mp.get_context('spawn')) as pool:
+            for i, bottleneck_train in pool.map(_train_segment_worker, tasks):
+                bottlenecks[i] = bottleneck_train
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+        for var in env.keys():
+            if env[var] is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = env[var]
+
+    return bottlenecks
+
 def split_cae(x, flux_train, flux_test, p, target_info_train, target_info_test,
               ticid_train, ticid_test, sectors, n_split=4, len_var=0.1, 
               data_dir='./', database_dir='./', output_dir='./', prefix0='',
               momentum_dump_csv='./Table_of_momentum_dumps.csv', debug=True,
-              save_model_epoch=False, plot=False, hyperparam_opt=False, p_opt={}):
+              save_model_epoch=False, plot=False, hyperparam_opt=False, p_opt={},
+              model_init=None, n_jobs=1, threads_per_job=None):
+    '''Trains a CAE on each of n_split light curve segments. If model_init
+    (path to a saved model) is given, each segment model is warm-started
+    from its compatible layers (see transfer_weights).
+    * n_jobs : number of segment models trained concurrently in separate
+      processes (hyperparameter optimization always runs sequentially)
+    * threads_per_job : number of TensorFlow/BLAS threads in each process'''
     # -- split x_train into n_split segments randomly --------------------------
 
     print('Splitting light curves into '+str(n_split)+' segments...')
@@ -3214,57 +3672,43 @@ def split_cae(x, flux_train, flux_test, p, target_info_train, target_info_test,
 
     # -- train each segment ----------------------------------------------------
     features = np.empty((len(x_train[0])+len(x_test[0]), 0))
-    for i in range(n_split):
-        print('Segment ' + str(i) + '...')
-        prefix = prefix0+'segment'+str(i)+'-'
-
-        if hyperparam_opt:
-            print('Starting hyperparameter optimization...')
-            p_opt['latent_dim'] = [14,16]
-            t = talos.Scan(x=x_train, y=x_train, params=p_opt, model=conv_autoencoder,
-                           experiment_name=prefix, reduction_metric='val_loss',
-                           minimize_loss=True, reduction_method='correlation',
-                           fraction_limit=0.001)      
-            analyze_object = talos.Analyze(t)
-            data_frame, best_param_ind,p = \
-                pt.hyperparam_opt_diagnosis(analyze_object, output_dir+prefix,
-                                           supervised=False)        
-            p['epochs'] = p['epochs']*3
-
-
-
-        model, history, bottleneck_train, bottleneck_test, x_predict, x_predict_train = \
-            conv_autoencoder(x_train[i], x_train[i], x_test[i], x_test[i], p,
-                             ticid_train=ticid_train, ticid_test=ticid_test,
-                             val=False, save_model=True, predict=True, 
-                             save_bottleneck=True, prefix=prefix,
-                             output_dir=output_dir,
-                             save_model_epoch=save_model_epoch)
-        features = np.append(features, bottleneck_train, axis=1)
-
-        if plot:
-            pt.diagnostic_plots(history, model, p, output_dir, x[i], x_train[i], x_test[i],
-                                x_predict, x_predict_train=x_predict_train,
-                                target_info_test=target_info_test,
-                                target_info_train=target_info_train, prefix=prefix,
-                                ticid_train=ticid_train, ticid_test=ticid_test, 
-                                bottleneck_train=bottleneck_train, bottleneck=bottleneck_test,
-                                plot_epoch = True,
-                                plot_in_out = False,
-                                plot_in_out_train = True,
-                                plot_in_bottle_out=False,
-                                plot_latent_test = False,
-                                plot_latent_train = True,
-                                plot_kernel=False,
-                                plot_intermed_act=False,
-                                make_movie = False,
-                                plot_lof_test=False,
-                                plot_lof_train=False,
-                                plot_lof_all=False,
-                                plot_reconstruction_error_test=False,
-                                plot_reconstruction_error_train=True,
-                                plot_reconstruction_error_all=False,
-                                load_bottleneck=True)
+    segment_kwargs = dict(p=p, ticid_train=ticid_train, ticid_test=ticid_test,
+                          target_info_train=target_info_train,
+                          target_info_test=target_info_test,
+                          output_dir=output_dir, save_model_epoch=save_model_epoch,
+                          model_init=model_init, plot=plot)
+    if n_jobs > 1 and not hyperparam_opt:
+        # >> segments are independent: train them concurrently, each process
+        # >> reading its segment from shared memory
+        bottlenecks = train_segments_parallel(x, x_train, x_test, prefix0,
+                                              n_jobs=n_jobs,
+                                              threads_per_job=threads_per_job,
+                                              **segment_kwargs)
+        for i in range(n_split):
+            features = np.append(features, bottlenecks[i], axis=1)
+        prefix = prefix0+'segment'+str(n_split-1)+'-'
+    else:
+        for i in range(n_split):
+            print('Segment ' + str(i) + '...')
+            prefix = prefix0+'segment'+str(i)+'-'
+
+            if hyperparam_opt:
+                print('Starting hyperparameter optimization...')
+                p_opt['latent_dim'] = [14,16]
+                t = talos.Scan(x=x_train, y=x_train, params=p_opt, model=conv_autoencoder,
+                               experiment_name=prefix, reduction_metric='val_loss',
+                               minimize_loss=True, reduction_method='correlation',
+                               fraction_limit=0.001)      
+                analyze_object = talos.Analyze(t)
+                data_frame, best_param_ind,p = \
+                    pt.hyperparam_opt_diagnosis(analyze_object, output_dir+prefix,
+                                               supervised=False)        
+                p['epochs'] = p['epochs']*3
+                segment_kwargs['p'] = p
+
+            bottleneck_train = train_segment(x[i], x_train[i], x_test[i],
+                                             prefix, **segment_kwargs)
+            features = np.append(features, bottleneck_train, axis=1)
 
     # -- novelty detection & classification ------------------------------------
 
@@ -3318,8 +3762,19 @@ def iterative_cae(flux_train, flux_test, x, p, ticid_train,
                   concat_ext_feats=False, use_rms=False, do_diagnostic_plots=True,
                   do_iteration_summary=True, do_ensemble_summary=True,
                   novelty_detection=True, 
-                  run=True, hyperparam_opt=False, p_opt={}):
-    '''len(n_split)=iterations'''
+                  run=True, hyperparam_opt=False, p_opt={},
+                  warm_start=True, use_cache=True, n_jobs=1,
+                  threads_per_job=None):
+    '''len(n_split)=iterations
+    * n_jobs, threads_per_job : segment models are trained in n_jobs
+      processes with threads_per_job threads each (see split_cae)
+    * warm_start : if True, segment models of later iterations are
+      initialized from the compatible layers of the iteration 0 model
+    * use_cache : if True, each stage (training, post-processing) records a
+      key made from the iteration, a hash of the targets in its subset and a
+      hash of the parameters, and is skipped on re-runs when the key is
+      unchanged. E.g. changing error_threshold only recomputes the stages
+      downstream of the split.'''
 
     # -- first iteration -------------------------------------------------------
     print('-'*17)
@@ -3344,7 +3799,15 @@ def iterative_cae(flux_train, flux_test, x, p, ticid_train,
                                        supervised=False)        
         p['epochs'] = p['epochs']*3
 
-    if run:
+    # >> stage keys are hashed from the parameters as given: training fills
+    # >> in derived entries of p (n_features, n_samples, per-layer lists), which
+    # >> would otherwise change the keys of later stages between runs
+    p_key = copy.deepcopy(p)
+    key = stage_key(0, ticid_train, ticid_test, p_key)
+    cached = use_cache and stage_cached(output_dir, prefix, 'train', key)
+    if cached:
+        print('Loading cached '+prefix+'model...')
+    if run and not cached:
         model, history, bottleneck_train, bottleneck_test, x_predict_test, x_predict_train = \
             conv_autoencoder(x_train, x_train, x_test, x_test, p,
                              ticid_train=ticid_train, ticid_test=ticid_test,
@@ -3353,6 +3816,7 @@ def iterative_cae(flux_train, flux_test, x, p, ticid_train,
                              output_dir=output_dir,
                              save_model_epoch=save_model_epoch)
         plot_epoch=True
+        save_stage_key(output_dir, prefix, 'train', key)
     else:
         history=None
         plot_epoch=False,
@@ -3387,6 +3851,8 @@ def iterative_cae(flux_train, flux_test, x, p, ticid_train,
         flux_feat, ticid_feat, info_feat = flux_train, ticid_train, target_info_train
         features = bottleneck_train
 
+    model_init = output_dir+'iteration0-model.hdf5' if warm_start else None
+
     # -- additional iterations -------------------------------------------------
     for i in [2]: # range(1,iterations+1):
         # >> split by reconstruction error
@@ -3401,20 +3867,25 @@ def iterative_cae(flux_train, flux_test, x, p, ticid_train,
                                  output_dir=output_dir, prefix=prefix)
 
         # >> do postprocessing on lowest reconstruction error
-        post_process(x, x_train[0], x_test[0], ticid_train[0], ticid_test[0],
-                     info_train[0], info_test[0], p, output_dir, sectors,
-                     data_dir=data_dir, database_dir=database_dir, prefix=prefix,
-                     momentum_dump_csv=momentum_dump_csv, use_rms=use_rms,
-                     features=features[0],  novelty_detection=novelty_detection,
-                     flux_feat=np.concatenate([flux_train[0],
-                                               flux_test[0]], axis=0),
-                     ticid_feat=np.concatenate([ticid_train[0], ticid_test[0]]),
-                     info_feat=np.concatenate([info_train[0],
-                                               info_test[0]], axis=0),
-                     x_predict=np.concatenate([x_predict_train[0],
-                                               x_predict_test[0]], axis=0),
-                     do_summary=do_iteration_summary,
-                     do_diagnostic_plots=do_diagnostic_plots)
+        key = stage_key(prefix, ticid_train[0], ticid_test[0], p_key)
+        if use_cache and stage_cached(output_dir, prefix, 'post_process', key):
+            print('Skipping cached '+prefix+'post-processing')
+        else:
+            post_process(x, x_train[0], x_test[0], ticid_train[0], ticid_test[0],
+                         info_train[0], info_test[0], p, output_dir, sectors,
+                         data_dir=data_dir, database_dir=database_dir, prefix=prefix,
+                         momentum_dump_csv=momentum_dump_csv, use_rms=use_rms,
+                         features=features[0],  novelty_detection=novelty_detection,
+                         flux_feat=np.concatenate([flux_train[0],
+                                                   flux_test[0]], axis=0),
+                         ticid_feat=np.concatenate([ticid_train[0], ticid_test[0]]),
+                         info_feat=np.concatenate([info_train[0],
+                                                   info_test[0]], axis=0),
+                         x_predict=np.concatenate([x_predict_train[0],
+                                                   x_predict_test[0]], axis=0),
+                         do_summary=do_iteration_summary,
+                         do_diagnostic_plots=do_diagnostic_plots)
+            save_stage_key(output_dir, prefix, 'post_process', key)
 
 
         # >> do split_cae on highest reconstruction error
@@ -3424,18 +3895,30 @@ def iterative_cae(flux_train, flux_test, x, p, ticid_train,
 
         prefix='iteration'+str(i)+'-'
         p['latent_dim']=latent_dim[i-1]
+        # >> the parameters given to split_cae (the key of this iteration's
+        # >> post-processing below uses them too)
+        p_key = dict(p_key, latent_dim=latent_dim[i-1])
         flux_train, flux_test, info_train, info_test, ticid_train, ticid_test =\
             flux_train[1], flux_test[1], info_train[1], info_test[1], \
             ticid_train[1], ticid_test[1]
-        if run:
-            x_train, x_test, x_predict_train, x_predict_test =\
+        key = stage_key(i, ticid_train, ticid_test, p_key, n_split[i-1],
+                        len_var, model_init, hyperparam_opt,
+                        p_opt if hyperparam_opt else None, input_psd)
+        cached = use_cache and stage_cached(output_dir, prefix, 'train', key)
+        x_split = None
+        if cached:
+            print('Loading cached '+prefix+'segment models...')
+        if run and not cached:
+            x_split, x_test_split, x_predict_train, x_predict_test =\
                 split_cae(x, flux_train, flux_test, p, info_train, info_test,
                           ticid_train, ticid_test, sectors, n_split=n_split[i-1],
                           len_var=len_var, data_dir=data_dir, database_dir=database_dir,
                           output_dir=output_dir, prefix0=prefix,
                           momentum_dump_csv=momentum_dump_csv, debug=True,
                           save_model_epoch=False, plot=do_diagnostic_plots,
-                          hyperparam_opt=hyperparam_opt)
+                          hyperparam_opt=hyperparam_opt, model_init=model_init,
+                          n_jobs=n_jobs, threads_per_job=threads_per_job)
+            save_stage_key(output_dir, prefix, 'train', key)
 
 
         x_predict_test = np.empty((len(flux_test), 0))
@@ -3463,8 +3946,13 @@ def iterative_cae(flux_train, flux_test, x, p, ticid_train,
 
             start = x_predict_train.shape[1]
             end = start+segment_len
-            segment_train = dt.standardize(flux_train[:,start:end])
-            segment_test = dt.standardize(flux_test[:,start:end])
+            if type(x_split) != type(None):
+                # >> reuse the segments standardized by split_cae
+                segment_train = x_split[:,start:end]
+                segment_test = x_test_split[:,start:end]
+            else:
+                segment_train = dt.standardize(flux_train[:,start:end])
+                segment_test = dt.standardize(flux_test[:,start:end])
 
             if do_diagnostic_plots:
                 pt.diagnostic_plots(history, model, p, output_dir,
@@ -3489,17 +3977,22 @@ def iterative_cae(flux_train, flux_test, x, p, ticid_train,
 
 
     # -- plots for last iteration ----------------------------------------------
-    post_process(x, x_train, x_test, ticid_train, ticid_test,
-                 info_train, info_test, p, output_dir, sectors,
-                 data_dir=data_dir, database_dir=database_dir, prefix=prefix,
-                 momentum_dump_csv=momentum_dump_csv, use_rms=use_rms,
-                 features=features, 
-                 flux_feat=np.concatenate([flux_train, flux_test], axis=0),
-                 ticid_feat=np.concatenate([ticid_train, ticid_test]),
-                 info_feat=np.concatenate([info_train, info_test], axis=0),
-                 x_predict=np.concatenate([x_predict_train, x_predict_test], axis=0),
-                 do_summary=do_iteration_summary,
-                 do_diagnostic_plots=do_diagnostic_plots)
+    key = stage_key(prefix, ticid_train, ticid_test, p_key, features.shape)
+    if use_cache and stage_cached(output_dir, prefix, 'post_process', key):
+        print('Skipping cached '+prefix+'post-processing')
+    else:
+        post_process(x, x_train, x_test, ticid_train, ticid_test,
+                     info_train, info_test, p, output_dir, sectors,
+                     data_dir=data_dir, database_dir=database_dir, prefix=prefix,
+                     momentum_dump_csv=momentum_dump_csv, use_rms=use_rms,
+                     features=features, 
+                     flux_feat=np.concatenate([flux_train, flux_test], axis=0),
+                     ticid_feat=np.concatenate([ticid_train, ticid_test]),
+                     info_feat=np.concatenate([info_train, info_test], axis=0),
+                     x_predict=np.concatenate([x_predict_train, x_predict_test], axis=0),
+                     do_summary=do_iteration_summary,
+                     do_diagnostic_plots=do_diagnostic_plots)
+        save_stage_key(output_dir, prefix, 'post_process', key)
 
 
     # -- summary plots for entire ensemble -------------------------------------
@@ -3573,8 +4066,11 @@ def iterative_cae(flux_train, flux_test, x, p, ticid_train,
         #                         output_dir=output_dir+'Sector'+str(sectors[0]))
 
 def iterative_cae_clustering(ensemble_dir, data_dir, sectors=[], num_iter=2,
-                             n_clusters=[100,100,100], first_iter_only=False):
-    '''Do clustering'''
+                             n_clusters=[100,100,100], first_iter_only=False,
+                             method='gmm', chunk_size=10000):
+    '''Do clustering. method is 'gmm' (GaussianMixture on all features), or
+    'online_gmm' / 'minibatch_kmeans' to fit chunk by chunk (see
+    cluster_utils.fit_streaming).'''
     for sector in sectors:
         print('Sector '+ str(sector))
         output_dir=ensemble_dir+'Ensemble-Sector_'+str(sector)+'/'
@@ -3610,8 +4106,9 @@ def iterative_cae_clustering(ensemble_dir, data_dir, sectors=[], num_iter=2,
                 out_file = output_dir+prefix+'gmm_labels-n'+\
                            str(n_clusters[i])+'.txt'
    
-            if os.path.exists(out_file):
-                _, y_pred = np.loadtxt(out_file)
+            if pu.has_product(out_file):
+                ticid, y_pred = pu.read_product(out_file, 'clstr',
+                                                legacy=pu.parse_legacy_labels)
             else:
 
                 fnames = fm.filter(os.listdir(output_dir),
@@ -3635,10 +4132,19 @@ def iterative_cae_clustering(ensemble_dir, data_dir, sectors=[], num_iter=2,
                     features = features[comm1]
                     ticid = ticid[comm2]
                 
-                gmm = GaussianMixture(n_components=n_clusters[i])
-                y_pred = gmm.fit_predict(features)
-                np.savetxt(out_file,
-                           np.array([ticid, y_pred]))
+                if method == 'gmm':
+                    gmm = GaussianMixture(n_components=n_clusters[i])
+                    y_pred = gmm.fit_predict(features)
+                else:
+                    model = cu.fit_streaming([features],
+                                             n_clusters=n_clusters[i],
+                                             method=method,
+                                             chunk_size=chunk_size)
+                    y_pred = cu.predict_shards(model, [features],
+                                               chunk_size=chunk_size)
+                pu.save_labels(out_file, ticid, y_pred,
+                               meta={'method': method,
+                                     'numclstr': n_clusters[i]})
 
             assignments, ticid_label = \
                 pt.assign_real_labels(ticid, y_pred, data_dir=data_dir,
@@ -4027,6 +4533,133 @@ def get_bottleneck(model, x_test, p, save=False, output_dir='', vae=False):
     else:
         return bottleneck
 
+def quantize_encoder(model, output_dir='./', mode='int8', x_train=None,
+                     batch_fnames=None, params=None, num_calib=500,
+                     prefix='', seed=0):
+    '''Post-training quantization of the encoder (input -> bottleneck) with
+    TFLite, for high-throughput CPU embedding.
+    Parameters:
+        * model : trained Keras autoencoder, or path to model.hdf5
+        * mode : 'int8' (int8 weights and activations, calibrated with a
+                 representative dataset) or 'float16' (float16 weights)
+        * x_train, batch_fnames : representative dataset, either in memory or
+                                  as training shards (.npy files)
+        * num_calib : number of light curves used for calibration, drawn at
+                      random (without replacement) with the given seed
+    Returns: path to the .tflite file'''
+    if type(model) == type(str()):
+        model = load_model(model)
+    encoder = Model(inputs=model.input,
+                    outputs=model.get_layer('bottleneck').output)
+    input_dim = encoder.input_shape[1]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(encoder)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == 'int8':
+        def representative_dataset():
+            # >> draw calibration light curves from the training set/shards
+            if type(batch_fnames) == type(None):
+                shards = [x_train]
+            else:
+                shards = [np.load(f, mmap_mode='r') for f in batch_fnames]
+            bounds = np.cumsum([0]+[len(chunk) for chunk in shards])
+            rng = np.random.default_rng(seed)
+            inds = np.sort(rng.choice(bounds[-1], min(num_calib, bounds[-1]),
+                                      replace=False))
+            for ind in inds:
+                k = np.searchsorted(bounds, ind, side='right') - 1
+                x = np.asarray(shards[k][ind-bounds[k]][-input_dim:],
+                               dtype=np.float32)
+                yield [x.reshape(1, -1)]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = \
+            [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    else:
+        raise ValueError('Unknown quantization mode '+mode)
+
+    fname = output_dir+prefix+'encoder_'+mode+'.tflite'
+    with open(fname, 'wb') as f:
+        f.write(converter.convert())
+    print('Saved '+fname)
+    return fname
+
+def get_bottleneck_tflite(path, x_test, batch_size=256, num_threads=None):
+    '''Runs x_test through a quantized encoder written by quantize_encoder.
+    Input and output stay float32; quantization happens inside the graph.'''
+    interpreter = tf.lite.Interpreter(model_path=path,
+                                      num_threads=num_threads)
+    inp = interpreter.get_input_details()[0]
+    out = interpreter.get_output_details()[0]
+    input_dim = inp['shape'][1]
+    x_test = x_test[:,-input_dim:]
+
+    bottleneck = []
+    for start in range(0, len(x_test), batch_size):
+        batch = np.asarray(x_test[start:start+batch_size], dtype=np.float32)
+        interpreter.resize_tensor_input(inp['index'], batch.shape)
+        interpreter.allocate_tensors()
+        interpreter.set_tensor(inp['index'], batch)
+        interpreter.invoke()
+        bottleneck.append(interpreter.get_tensor(out['index']).copy())
+    return np.concatenate(bottleneck, axis=0)
+
+def quantization_report(model, path, x_test, params=None, numclstr=100,
+                        output_dir='./', prefix=''):
+    '''Compares bottleneck vectors and downstream GMM labels from the
+    full-precision model and a quantized encoder, and reports throughput.
+    Parameters:
+        * model : trained Keras autoencoder
+        * path : path to quantized encoder (.tflite)
+        * x_test : light curves to embed, shape=(num light curves, num data
+                   points)
+        * numclstr : number of GMM components used for the label comparison
+    Returns: dictionary of accuracy and timing summaries'''
+    from sklearn.mixture import GaussianMixture
+    from sklearn.metrics import adjusted_rand_score
+    from . import infer_utils as iu
+
+    input_dim = model.input_shape[1]
+    x_test = x_test[:,-input_dim:]
+
+    start = time.time()
+    bottleneck_ref = get_bottleneck(model, x_test, params)
+    time_ref = time.time() - start
+    start = time.time()
+    bottleneck_q = get_bottleneck_tflite(path, x_test)
+    time_q = time.time() - start
+
+    report = iu.compare_bottleneck(bottleneck_ref, bottleneck_q)
+    norm = np.linalg.norm(bottleneck_ref, axis=1) * \
+           np.linalg.norm(bottleneck_q, axis=1)
+    cos = np.sum(bottleneck_ref*bottleneck_q, axis=1) / \
+          np.where(norm > 0, norm, 1.)
+    report['min_cosine'] = float(np.min(cos))
+    report['mean_cosine'] = float(np.mean(cos))
+
+    # >> downstream labels: fit on full precision, predict on both
+    numclstr = min(numclstr, len(x_test))
+    gmm = GaussianMixture(n_components=numclstr,
+                          random_state=0).fit(bottleneck_ref)
+    clstr_ref = gmm.predict(bottleneck_ref)
+    clstr_q = gmm.predict(bottleneck_q)
+    report['label_agreement'] = float(np.mean(clstr_ref == clstr_q))
+    report['adjusted_rand'] = float(adjusted_rand_score(clstr_ref, clstr_q))
+
+    report['time_full'] = time_ref
+    report['time_quantized'] = time_q
+    report['speedup'] = time_ref / time_q if time_q > 0 else np.inf
+
+    fname = output_dir+prefix+'quantization_report.txt'
+    with open(fname, 'w') as f:
+        f.write('Quantized encoder: '+path+'\n')
+        f.write('Number of light curves: '+str(len(x_test))+'\n')
+        for key in report.keys():
+            f.write(key+': '+str(report[key])+'\n')
+    print('Saved '+fname)
+    return report
+
 def compile_model(model, params):
 
     if params['optimizer'] == 'adam':
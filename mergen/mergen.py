@@ -20,7 +20,6 @@ The Mergen methods are organized into five main sections:
 6) Loading Mergen Products
 
 To Do List:
-* Set up pipeline function (kind of a run-all thing)
 * Include example script?
 * Include option to process multiple sector
 """
@@ -30,6 +29,25 @@ from . import data_utils    as dt
 from . import catalog_utils as ct
 from . import plot_utils    as pt
 from . import feature_utils as ft
+from . import infer_utils   as iu
+from . import neighbor_utils as nu
+from . import cluster_utils as cu
+from . import join_utils as ju
+from . import table_utils as tu
+from . import otype_utils as ou
+from . import product_utils as pu
+from . import pipeline_utils as pl
+
+# >> products and configuration saved in the product bundle (save_bundle)
+BUNDLE_ARRAYS = ['objid', 'feats', 'clstr', 'nvlty', 'tsne', 'totype',
+                 'numtot', 'potype', 'numpot']
+BUNDLE_CONFIG = ['datapath', 'savepath', 'datatype', 'sector', 'featgen',
+                 'metapath', 'timescale', 'mdumpcsv', 'filelabel', 'runiter',
+                 'numiter', 'numclstr', 'clstrmeth', 'name', 'parampath']
+# >> configuration that defines the bundled products: load only uses a bundle
+# >> saved with the same values
+BUNDLE_KEYS = ['datatype', 'sector', 'featgen', 'timescale', 'runiter',
+               'numiter', 'numclstr', 'clstrmeth']
 
 class mergen(object):
     """ Main mergen class. Initialize this to work with everything else
@@ -45,7 +63,7 @@ class mergen(object):
                  featgen=None,  metapath=None, timescale=None,
                  mdumpcsv=None, filelabel=None, runiter=False, numiter=1,
                  numclstr=None, clstrmeth=None, name=None,
-                 parampath=None):
+                 parampath=None, featshards=None):
         """Creates mergen object from which most common routines can easily be
         run
         Parameters:
@@ -72,6 +90,11 @@ class mergen(object):
             * numiter : int, number of iterations in the iterative CAE scheme
             * numclstr : int, number of clusters assumed by the GMM clustering
                          algorithm
+            * clstrmeth : string, clustering method: 'gmm', 'hdbscan', or
+                          'online_gmm' / 'minibatch_kmeans' (out-of-core)
+            * featshards : list of .npy files of features (rows ordered as
+                           objid), used by the out-of-core clustering
+                           methods instead of feats
         """
 
         # >> initialize Mergen attributes based on provided arguments
@@ -103,54 +126,113 @@ class mergen(object):
             else:
                 self.featpath = self.savepath+self.featgen+"/"
         dt.create_dir(self.featpath)
+        if not hasattr(self, 'ENFpath'):
+            self.ENFpath = self.featpath
 
     def initiate_meta(self):
         dt.init_meta_folder(self.metapath)
 
-    def run(self):
-        # >> load data
-        self.load_lightcurves_local()
-        
-        # >> preprocessing and feature generation
-        if self.featgen == "DAE":
-            self.data_preprocess("DAE")
-            self.generate_dae_features()
-            self.run_feature_analysis("DAE")
-            self.run_vis("DAE")
-        if self.featgen == "CAE":
-            self.data_preprocess("CAE")
-            self.generate_cae_features()   
-            self.run_feature_analysis("CAE")
-            self.run_vis("CAE")
+    def build_pipeline(self):
+        """Stage graph of run (see pipeline_utils), for featgen. Stage outputs
+        are cached in featpath+'stages/'.
+        Returns: pl.Pipeline"""
         if self.featgen == "ENF":
-            self.data_preprocess("ENF")
-            self.generate_engineered()
-            self.run_feature_analysis("ENF")
-            self.run_vis("ENF")
+            prep_out, feat_in = ['flux'], ['time', 'flux']
+            generate = mergen.generate_engineered
+        else:
+            prep_out, feat_in = ['x_train', 'x_test'], ['x_train', 'objid']
+            generate = {"CAE": mergen.generate_cae_features,
+                        "DAE": mergen.generate_dae_features}[self.featgen]
+
+        # >> the GMM parameter search and HDBSCAN score clusterings on the
+        # >> t-SNE, otherwise clustering does not wait for it
+        clstr_in = ['feats', 'objid']
+        if self.clstrmeth == 'hdbscan' or \
+           (self.clstrmeth == 'gmm' and type(self.numclstr) == type(None)):
+            clstr_in.append('tsne')
+
+        stages = [
+            pl.Stage('lightcurves', mergen.load_lightcurves_local,
+                     outputs=['time', 'flux', 'objid'],
+                     params=['datapath', 'datatype', 'sector'],
+                     cache=['objid']),
+            pl.Stage('preprocess', mergen.preprocess_data,
+                     inputs=['flux', 'time', 'objid'], outputs=prep_out,
+                     params=['featgen', 'datapath'], cache=False),
+            pl.Stage('features', generate, inputs=feat_in, outputs=['feats'],
+                     params=['featgen', 'parampath', 'batch_fnames']),
+            pl.Stage('true_otypes', mergen.load_true_otypes,
+                     inputs=['objid'], outputs=['totype', 'numtot', 'otdict'],
+                     params=['metapath']),
+            pl.Stage('tsne', mergen.generate_tsne, inputs=['feats', 'objid'],
+                     outputs=['tsne']),
+            pl.Stage('novelty', mergen.generate_novelty_scores,
+                     inputs=['feats', 'objid'], outputs=['nvlty']),
+            pl.Stage('clusters', mergen.generate_clusters, inputs=clstr_in,
+                     outputs=['clstr', 'numclstr'],
+                     params=['clstrmeth', 'numclstr', 'runiter', 'numiter',
+                             'featshards']),
+            pl.Stage('pred_otypes', mergen.generate_predicted_otypes,
+                     inputs=['clstr', 'feats', 'objid', 'totype', 'numtot'],
+                     outputs=['potype', 'otdict', 'cm', 'unqpot']),
+            pl.Stage('numerize', mergen.numerize_otypes,
+                     inputs=['totype', 'potype'], outputs=['numpot']),
+            pl.Stage('vis', mergen.run_vis,
+                     inputs=['feats', 'clstr', 'tsne', 'numtot', 'otdict',
+                             'objid', 'numclstr'],
+                     params=['clstrmeth', 'datapath']),
+            pl.Stage('bundle', mergen.save_bundle,
+                     inputs=BUNDLE_ARRAYS+['otdict'], params=BUNDLE_CONFIG)]
+        return pl.Pipeline(stages, self.featpath+'stages/')
+
+    def run(self, targets=None, force=False, n_jobs=2):
+        """Runs the pipeline (load light curves, preprocess, generate
+        features, t-SNE, novelty scores, clustering, predicted object types,
+        visualizations, product bundle) as a stage graph (see
+        build_pipeline). Stages whose inputs and parameters are unchanged
+        since the last run are loaded from featpath+'stages/' instead of
+        rerun (e.g. after changing numclstr, only clustering and the stages
+        after it rerun), and independent stages run concurrently.
+        Parameters:
+            * targets : names of the stages to bring up to date (default: all)
+            * force : True, or names of stages to rerun anyway
+            * n_jobs : number of stages run at once
+        Returns: timings, dictionary {stage name: seconds}"""
+        self.pipeline = self.build_pipeline()
+        self.timings = self.pipeline.run(self, targets=targets, force=force,
+                                         n_jobs=n_jobs)
+        return self.timings
             
     def run_pretrained(self):
-        """Skips feature extraction and loads saved extracted features."""
+        """Skips feature extraction and loads saved extracted features (from
+        the product bundle, if run saved one)."""
         self.load_lightcurves_local()        
-        self.load(self.featgen)
-        self.run_vis(self.featgen)
+        self.load()
+        self.run_vis()
 
     # ==========================================================================
     # == Data and Preprocessing ================================================
     # ==========================================================================
 
-    def load_lightcurves_local(self, lcdir, sector):
-        """Load in data saved in metafiles on datapath"""
+    def load_lightcurves_local(self, lcdir=None, sector=None):
+        """Load in data saved in metafiles on datapath (default lcdir:
+        datapath, sector: sector)"""
+        if type(lcdir) == type(None):
+            lcdir = self.datapath
+        if type(sector) == type(None):
+            sector = self.sector
         #check for self.datatype to determine loading scheme. 
         #figure out consistent stuff for FFI original locations
         if self.datatype == "FFI-Lygos":
             self.time, self.flux, self.errors, self.objid = \
-            dt.load_all_lygos(self.datapath)
+            dt.load_all_lygos(lcdir)
         elif self.datatype == "SPOC":
             # self.flux, self.time, self.objid, self.target_info = \
             # dt.load_data_from_metafiles(self.datapath, self.sector)
 
-            self.flux, self.time, self.meta = \
+            self.time, self.flux, self.meta = \
                     dt.load_data_from_metafiles(lcdir, sector)
+            self.objid = np.array([m['TICID'] for m in self.meta])
         
     def download_lightcurves(self):
         """Downloads and process light SPOC light curves, if not already
@@ -165,6 +247,7 @@ class mergen(object):
         if self.featgen == "ENF":
             self.flux = dt.normalize(self.flux)
         else:
+            from . import learn_utils as lt
             self.x_train, self.x_test = \
             lt.autoencoder_preprocessing(self.flux, self.time, 
                                          ticid=self.objid,
@@ -178,6 +261,7 @@ class mergen(object):
     def optimize_params(self):
         dt.create_dir(self.featpath+'model/')
         dt.create_dir(self.featpath+'model/opt/')
+        from . import learn_utils as lt
         lt.hyperparam_optimizer(self.featpath+'model/opt/', self.featgen,
                                 x_train=self.x_train,
                                 batch_fnames=self.batch_fnames)
@@ -206,6 +290,7 @@ class mergen(object):
         """Trains deep autoencoder to extract representative features from
 
         periodograms."""
+        from . import learn_utils as lt
         self.model, self.hist, self.feats = \
         lt.deep_autoencoder(self.x_train, self.x_train,
                             ticid_train=self.objid,
@@ -222,6 +307,7 @@ class mergen(object):
             * hist : Keras history dictionary
             * feats : CAE-derived features
             * rcon : reconstructions of the input light curves"""        
+        from . import learn_utils as lt
         res = lt.conv_autoencoder(x_train=self.x_train, y_train=self.x_train, 
                                   output_dir=self.featpath+'model/',
                                   ticid_train=self.objid,
@@ -234,11 +320,47 @@ class mergen(object):
             self.model, self.hist = res
 
     def save_ae_features(self, reconstruct=True):
+        from . import learn_utils as lt
         self.feats = lt.save_autoencoder_products(parampath=self.parampath,
                                                   output_dir=self.featpath+'model/',
                                                   batch_fnames=self.batch_fnames,
                                                   reconstruct=reconstruct)
 
+    def export_encoder(self):
+        """Converts the trained autoencoder saved in featpath into a compact
+        NumPy weights file (model/encoder.npz) so that features can be
+        extracted without TensorFlow."""
+        iu.export_encoder(self.featpath+'model/model.hdf5',
+                          self.featpath+'model/encoder.npz')
+
+    def generate_bottleneck_np(self, x=None):
+        """Computes bottleneck features with the NumPy encoder runtime.
+        Requires export_encoder to have been run.
+        Returns:
+            * feats : CAE-derived features, shape=(len(x), latent_dim)"""
+        if type(x) == type(None):
+            x = self.x_train
+        self.feats = iu.get_bottleneck_np(self.featpath+'model/encoder.npz', x)
+        return self.feats
+
+    def quantize_encoder(self, mode='int8', report=True):
+        """Writes a post-training quantized encoder (model/encoder_<mode>.tflite)
+        calibrated on the training data, and optionally an accuracy report
+        comparing it to the full-precision model."""
+        from . import learn_utils as lt
+        model = lt.load_model(self.featpath+'model/model.hdf5')
+        fname = lt.quantize_encoder(model, self.featpath+'model/', mode=mode,
+                                    x_train=self.x_train,
+                                    batch_fnames=self.batch_fnames)
+        if report:
+            x = self.x_train
+            if type(x) == type(None):
+                x = np.load(self.batch_fnames[0])
+            lt.quantization_report(model, fname, x,
+                                   numclstr=self.numclstr or 100,
+                                   output_dir=self.featpath+'model/')
+        return fname
+
     def produce_ae_visualizations(self):
         if self.featgen == "DAE":
             pt.produce_ae_visualizations(self.freq[0], self.x_train, self.rcon,
@@ -262,6 +384,7 @@ class mergen(object):
         """Run clustering algorithm on feature space.
         Returns:
             * clstr : array of cluster numbers, shape=(len(objid),)"""
+        from . import learn_utils as lt
         print('Performing clustering analysis in feature space...')
         if self.clstrmeth == 'gmm':
             if type(self.numclstr) == type(None):
@@ -278,14 +401,51 @@ class mergen(object):
             lt.quick_hdbscan_param_search(self.feats, self.objid, output_dir=self.featpath,
                                           tsne=self.tsne)
 
-    def generate_tsne(self):
-        """Reduces dimensionality of feature space for visualization."""
-        self.tsne = lt.run_tsne(self.feats, savepath=self.featpath+'model/')
+        elif self.clstrmeth in ['online_gmm', 'minibatch_kmeans']:
+            shards = self.featshards
+            if type(shards) == type(None):
+                shards = [self.feats]
+            if type(self.numclstr) == type(None):
+                self.numclstr = 100
+            self.clstr = lt.run_streaming_clustering(self.objid, shards,
+                                                     numclstr=self.numclstr,
+                                                     method=self.clstrmeth,
+                                                     savepath=self.featpath)
+
+    def build_similarity_index(self, fname=None):
+        """Indexes the feature space (feats, objid) for similarity queries
+        and saves the index (default: featpath+'similarity_index.npz')."""
+        if type(fname) == type(None):
+            fname = self.featpath+'similarity_index.npz'
+        sector = self.sector if np.ndim(self.sector) == 0 else None
+        self.simidx = nu.SimilarityIndex().fit(self.feats, self.objid,
+                                               sector=sector)
+        self.simidx.save(fname)
+
+    def query_similar(self, ticid, k=50):
+        """Returns the TICIDs, feature-space distances and sectors of the k
+        light curves most similar to TIC ticid."""
+        if not hasattr(self, 'simidx'):
+            fname = self.featpath+'similarity_index.npz'
+            if os.path.exists(fname):
+                self.simidx = nu.load_similarity_index(fname)
+            else:
+                self.build_similarity_index()
+        return self.simidx.query(ticid, k=k)
+
+    def generate_tsne(self, method='sklearn'):
+        """Reduces dimensionality of feature space for visualization.
+        method : 'sklearn', or 'opentsne' / 'umap' / 'auto' for the cached,
+                 multi-threaded backends of embed_utils"""
+        from . import learn_utils as lt
+        self.tsne = lt.run_tsne(self.feats, savepath=self.featpath+'model/',
+                                method=method, ticid=self.objid)
 
     def generate_predicted_otypes(self):
         """Predicts object types using known classifications.
         Returns:
             * potype : array of predicted object types, shape=(len(objid),)"""
+        from . import learn_utils as lt
         lt.label_clusters(self)
         # self.potype = \
         #     lt.label_clusters(self.featpath, self.sector,
@@ -307,7 +467,16 @@ class mergen(object):
         self.nvlty = pt.generate_novelty_scores(self.feats, self.objid,
                                                 self.ensbpath+self.featgen+'/')
 
+    def score_new_novelty(self, feats, objid, refit_frac=None):
+        """Scores new objects (e.g. a new sector's features) against the
+        saved novelty model without refitting LOF on every object.
+        Returns: novelty scores of the new objects, shape=(len(objid),)"""
+        return pt.score_new_novelty(feats, objid,
+                                    self.ensbpath+self.featgen+'/',
+                                    refit_frac=refit_frac)
+
     def generate_rcon(self):
+        from . import learn_utils as lt
         self.rcon = lt.load_reconstructions(self.ensbpath+self.featgen+'/',
                                             self.objid)
 
@@ -350,16 +519,45 @@ class mergen(object):
         if self.featgen == "ENF":
             self.feats = dt.load_ENF_feature_metafile(self.ENFpath)
         elif self.featgen == "CAE" or self.featgen == "DAE": 
+            from . import learn_utils as lt
             self.feats = \
                 lt.load_bottleneck(self.featpath)
 
+    def save_feature_table(self, family=None):
+        """Adds feats (keyed by objid) to the feature table in savepath
+        (savepath+'feature_table/'), as the family featgen by default."""
+        if type(family) == type(None):
+            family = self.featgen
+        path = self.savepath+'feature_table/'
+        if os.path.exists(path+'meta.json'):
+            table = tu.load_feature_table(path)
+            table.add_family(family, self.objid, self.feats)
+        else:
+            tu.build_feature_table(path, self.objid,
+                                   {family: (self.objid, self.feats)})
+
+    def load_feature_table(self, families):
+        """Sets feats to the given feature families of the feature table
+        (e.g. ['CAE', 'ENF']). If objid is already set, the rows are aligned
+        to it (objects missing from the table get nan, see
+        table_utils.FeatureTable.select), so that the other objid-aligned
+        products stay aligned. Otherwise objid is set to the objects that
+        have all of the families."""
+        table = tu.load_feature_table(self.savepath+'feature_table/')
+        if type(getattr(self, 'objid', None)) != type(None):
+            self.objid, self.feats = table.select(families, ticid=self.objid)
+        else:
+            self.objid, self.feats = table.select(families)
+
     def load_gmm_clusters(self):
         """ clstr : array of cluster numbers, shape=(len(objid),)"""
+        from . import learn_utils as lt
         self.clstr = \
             lt.load_gmm_from_txt(self.featpath, self.objid,
                                  self.runiter, self.numiter, self.numclstr)
 
     def load_reconstructions(self):
+        from . import learn_utils as lt
         self.rcon = lt.load_reconstructions(self.ensbpath+self.featgen+'/',
                                             self.objid)
 
@@ -382,22 +580,13 @@ class mergen(object):
         cat = np.loadtxt(self.metapath+'spoc/otypes_S1_26.txt', skiprows=2,
                          delimiter=',', dtype='str')
     
-        # >> reorder to match objid
-        inter, comm1, comm2 = np.intersect1d(cat[:,0].astype('int'), self.objid,
-                                             return_indices=True)
-        cat = cat[:,1][comm1]
+        # >> reorder to match objid (objects missing from the catalog are
+        # >> UNCLASSIFIED)
+        cat = ju.align_to_ticid(self.objid, cat[:,0].astype('int'), cat[:,1],
+                                fill='UNCLASSIFIED', name='otype catalog')
 
         # >> remove Pec (peculiar) label for classification
-        for i in range(len(cat)):
-            if 'Pec' in cat[i]:
-                if cat[i] == 'Pec':
-                    cat[i] = 'UNCLASSIFIED'
-                else:
-                    ot = cat[i].split('|')
-                    ot.pop(ot.index('Pec'))
-                    cat[i] = '|'.join(ot)
-
-        self.totype = cat
+        self.totype = ou.strip_atoms(cat, ['Pec'], fill='UNCLASSIFIED')
 
         # >> add specific paper classifications
         obj_dir = self.metapath+'spoc/obj/'
@@ -405,13 +594,11 @@ class mergen(object):
         for f in fnames:
             ticid_f = np.loadtxt(obj_dir+f)
             otype_f = f.split('_')[0]
-            inter, comm1, comm2 = np.intersect1d(self.objid, ticid_f, return_indices=True)
-            self.totype[comm1] = otype_f
+            inds = ju.match_ticid(self.objid, np.atleast_1d(ticid_f)) >= 0
+            self.totype[inds] = otype_f
 
-        unqtot = np.unique(self.totype)
+        unqtot, self.numtot = np.unique(self.totype, return_inverse=True)
         self.otdict = {i: unqtot[i] for i in range(len(unqtot))}
-        self.numtot = np.array([np.nonzero(unqtot == ot)[0][0] for \
-                                ot in self.totype])
 
     def numerize_otypes(self):
         """
@@ -421,8 +608,7 @@ class mergen(object):
         * numpot : numerized predicted object types, shape=(len(objid),)
         """
         unqtot = np.unique(self.totype)
-        self.numpot = np.array([np.nonzero(unqtot == ot)[0][0] for \
-                                ot in self.potype])
+        self.numpot = cu.encode(self.potype, unqtot)
 
     def load_pred_otypes(self):
         """ potype : predicted object types"""
@@ -430,9 +616,67 @@ class mergen(object):
                                                   self.sector, self.objid)
 
     def load_tsne(self):
-        self.tsne = lt.load_tsne(self.featpath+'model/')
+        from . import learn_utils as lt
+        self.tsne = lt.load_tsne(self.featpath+'model/', ticid=self.objid)
             
-    def load(self):
+    def save_bundle(self, fname=None):
+        """Saves the products of a run (objid, feats, clstr, nvlty, tsne, true
+        and predicted object types and their encodings) and the
+        configuration to a single memory-mapped file (default:
+        featpath+'bundle.mgb'), which load opens in one step."""
+        if type(fname) == type(None):
+            fname = self.featpath+'bundle.mgb'
+        arrays = {}
+        for attr in BUNDLE_ARRAYS:
+            if type(getattr(self, attr, None)) != type(None):
+                arrays[attr] = getattr(self, attr)
+        config = {attr: getattr(self, attr, None) for attr in BUNDLE_CONFIG}
+        otdict = getattr(self, 'otdict', {})
+        meta = {'config': config,
+                'otdict': {str(k): otdict[k] for k in otdict},
+                'created': datetime.now().isoformat()}
+        pu.save_bundle(fname, arrays, meta=meta)
+
+    def load_bundle(self, fname=None):
+        """Sets the products saved by save_bundle as attributes (arrays are
+        memory-mapped). The saved configuration is kept in bundle_config."""
+        if type(fname) == type(None):
+            fname = self.featpath+'bundle.mgb'
+        bundle = pu.load_bundle(fname)
+        for attr in bundle.keys():
+            setattr(self, attr, bundle[attr])
+        self.otdict = {int(k): v for k, v in bundle.meta['otdict'].items()}
+        self.bundle_config = bundle.meta['config']
+        print('Loaded '+fname)
+        return bundle
+
+    def bundle_mismatch(self, fname=None):
+        """Configuration attributes (BUNDLE_KEYS) whose values differ from
+        the ones the bundle was saved with."""
+        import json
+        if type(fname) == type(None):
+            fname = self.featpath+'bundle.mgb'
+        config = pu.load_bundle(fname).meta['config']
+        # >> compare as saved (JSON), e.g. numpy integers as ints
+        return [attr for attr in BUNDLE_KEYS if config.get(attr) != \
+                json.loads(json.dumps(getattr(self, attr, None),
+                                      default=pu._json_default))]
+
+    def load(self, fname=None):
+        """Loads the Mergen products: from the bundle saved by run (see
+        save_bundle) if there is one and it was saved with the current
+        configuration (see BUNDLE_KEYS), otherwise from the individual
+        product files."""
+        if type(fname) == type(None):
+            fname = self.featpath+'bundle.mgb'
+        if os.path.exists(fname):
+            mismatch = self.bundle_mismatch(fname)
+            if len(mismatch) == 0:
+                self.load_bundle(fname)
+                return
+            print(fname+' was saved with different '+', '.join(mismatch)+\
+                  ', loading the individual products')
+
         self.load_features()
         # self.load_reconstructions()
         
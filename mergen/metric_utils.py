@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+metric_utils.py
+
+Clustering quality metrics that scale to large feature sets. The exact
+silhouette score needs all pairwise distances (O(N^2) time and memory), so
+it is estimated from a stratified sample of points, each scored against the
+full data set, with a confidence interval. Calinski-Harabasz and
+Davies-Bouldin are computed from per-cluster sufficient statistics, which can
+be accumulated chunk by chunk.
+
+Silhouette
+* silhouette_points
+* sampled_silhouette
+
+Sufficient statistics
+* ClusterStats
+* calinski_harabasz
+* davies_bouldin
+
+Parameter searches
+* cluster_scores
+"""
+
+import numpy as np
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Silhouette ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def silhouette_points(features, labels, inds, metric='euclidean',
+                      chunk_size=None, max_bytes=2**28):
+    '''Exact silhouette coefficients of the points features[inds], each
+    scored against every point in features. Memory use is
+    chunk_size x len(features) distances; by default chunk_size is the
+    largest number of rows (at most 256) whose distances fit in max_bytes.'''
+    from sklearn.metrics import pairwise_distances
+    from scipy.sparse import csr_matrix
+
+    unq, codes = np.unique(labels, return_inverse=True)
+    n = len(features)
+    if type(chunk_size) == type(None):
+        chunk_size = int(np.clip(max_bytes // (8*n), 1, 256))
+    counts = np.bincount(codes, minlength=len(unq)).astype(float)
+    onehot = csr_matrix((np.ones(n), (np.arange(n), codes)),
+                        shape=(n, len(unq)))
+
+    sil = np.empty(len(inds))
+    for start in range(0, len(inds), chunk_size):
+        batch = inds[start:start+chunk_size]
+        dist = pairwise_distances(features[batch], features, metric=metric)
+        sums = np.asarray((onehot.T @ dist.T).T) # >> (batch, num clusters)
+        own = codes[batch]
+        rows = np.arange(len(batch))
+
+        # >> mean distance to own cluster (excluding self), and to nearest
+        # >> other cluster
+        n_own = counts[own]
+        a = sums[rows, own] / np.maximum(n_own-1, 1)
+        mean_other = sums / counts
+        mean_other[rows, own] = np.inf
+        b = np.min(mean_other, axis=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            s = (b - a) / np.maximum(a, b)
+        s[n_own <= 1] = 0. # >> singletons score 0, as in sklearn
+        sil[start:start+chunk_size] = np.nan_to_num(s)
+    return sil
+
+def sampled_silhouette(features, labels, n_sample=5000, conf=0.95,
+                       metric='euclidean', random_state=0):
+    '''Estimates the mean silhouette score from a stratified sample.
+    Each cluster contributes a number of points proportional to its size
+    (at least 2 where possible), and every sampled point is scored exactly
+    against the full data set. If len(features) <= n_sample, all points are
+    used and the result equals sklearn.metrics.silhouette_score.
+    Returns: (estimate, lower, upper) of the conf confidence interval'''
+    from scipy.stats import norm
+    rng = np.random.default_rng(random_state)
+    n = len(features)
+    unq, codes = np.unique(labels, return_inverse=True)
+    counts = np.bincount(codes, minlength=len(unq))
+
+    if n <= n_sample:
+        sil = silhouette_points(features, labels, np.arange(n), metric=metric)
+        est = np.mean(sil)
+        return est, est, est
+
+    # >> allocate the sample between clusters (strata)
+    alloc = np.maximum(np.round(counts * n_sample / n).astype(int),
+                       np.minimum(counts, 2))
+    alloc = np.minimum(alloc, counts)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    inds = np.concatenate([rng.choice(order[bounds[k]:bounds[k+1]], alloc[k],
+                                      replace=False) \
+                           for k in range(len(unq))])
+    sil = silhouette_points(features, labels, inds, metric=metric)
+
+    # >> stratified mean and variance (with finite population correction)
+    strata = codes[inds]
+    weights = counts / n
+    means = np.bincount(strata, weights=sil, minlength=len(unq)) / alloc
+    sq = np.bincount(strata, weights=(sil - means[strata])**2,
+                     minlength=len(unq))
+    var_k = sq / np.maximum(alloc-1, 1)
+    est = np.sum(weights * means)
+    var = np.sum(weights**2 * var_k / alloc * (1 - alloc/counts))
+    half = norm.ppf(0.5 + conf/2) * np.sqrt(var)
+    return est, est-half, est+half
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Sufficient statistics :::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+class ClusterStats(object):
+    '''Per-cluster counts, sums and sums of squared norms, accumulated over
+    any number of chunks. Enough for the Calinski-Harabasz score; the
+    Davies-Bouldin score also needs the mean distance of each point to its
+    centroid, which is accumulated by update_dispersion in a second pass
+    (once all chunks have been added with update).'''
+
+    def __init__(self):
+        self.clusters = np.empty(0)
+        self.counts = np.empty(0)
+        self.sums = None
+        self.sqnorms = np.empty(0)
+        self.dists = None
+
+    def _codes(self, labels):
+        unq = np.unique(labels)
+        new = np.setdiff1d(unq, self.clusters)
+        if len(new) > 0:
+            clusters = np.union1d(self.clusters, new)
+            pos = np.searchsorted(clusters, self.clusters)
+            counts = np.zeros(len(clusters))
+            sqnorms = np.zeros(len(clusters))
+            counts[pos], sqnorms[pos] = self.counts, self.sqnorms
+            if type(self.sums) != type(None):
+                sums = np.zeros((len(clusters), self.sums.shape[1]))
+                sums[pos] = self.sums
+                self.sums = sums
+            self.clusters, self.counts, self.sqnorms = clusters, counts, sqnorms
+        return np.searchsorted(self.clusters, labels)
+
+    def update(self, features, labels):
+        '''Adds a chunk of points to the statistics.'''
+        features = np.asarray(features, dtype=np.float64)
+        if type(self.sums) == type(None):
+            self.sums = np.zeros((0, features.shape[1]))
+        codes = self._codes(labels)
+        k = len(self.clusters)
+        self.counts += np.bincount(codes, minlength=k)
+        self.sqnorms += np.bincount(codes, weights=np.sum(features**2, axis=1),
+                                    minlength=k)
+        np.add.at(self.sums, codes, features)
+        return self
+
+    def centroids(self):
+        return self.sums / self.counts[:,None]
+
+    def update_dispersion(self, features, labels):
+        '''Second pass: adds the distances of a chunk of points to their
+        cluster centroids (needed for davies_bouldin).'''
+        features = np.asarray(features, dtype=np.float64)
+        codes = np.searchsorted(self.clusters, labels)
+        if type(self.dists) == type(None):
+            self.dists = np.zeros(len(self.clusters))
+        dist = np.linalg.norm(features - self.centroids()[codes], axis=1)
+        self.dists += np.bincount(codes, weights=dist,
+                                  minlength=len(self.clusters))
+        return self
+
+    def calinski_harabasz(self):
+        n, k = np.sum(self.counts), len(self.clusters)
+        if k < 2 or n <= k:
+            return np.nan
+        mean = np.sum(self.sums, axis=0) / n
+        within = np.sum(self.sqnorms - np.sum(self.sums**2, axis=1)/self.counts)
+        between = np.sum(self.counts * \
+                         np.sum((self.centroids() - mean)**2, axis=1))
+        if within == 0:
+            return 1.
+        return between * (n - k) / (within * (k - 1))
+
+    def davies_bouldin(self):
+        from scipy.spatial.distance import cdist
+        if len(self.clusters) < 2:
+            return np.nan
+        if type(self.dists) == type(None):
+            raise ValueError('Run update_dispersion before davies_bouldin')
+        intra = self.dists / self.counts
+        centr = self.centroids()
+        centr_dist = cdist(centr, centr)
+        if np.allclose(intra, 0) or np.allclose(centr_dist, 0):
+            return 0.
+        centr_dist[centr_dist == 0] = np.inf
+        combined = (intra[:,None] + intra[None,:]) / centr_dist
+        return np.mean(np.max(combined, axis=1))
+
+def calinski_harabasz(features, labels, chunk_size=100000):
+    '''Calinski-Harabasz score from per-cluster sufficient statistics.'''
+    stats = ClusterStats()
+    for start in range(0, len(features), chunk_size):
+        stats.update(features[start:start+chunk_size],
+                     labels[start:start+chunk_size])
+    return stats.calinski_harabasz()
+
+def davies_bouldin(features, labels, chunk_size=100000, stats=None):
+    '''Davies-Bouldin score from per-cluster sufficient statistics (two
+    passes over the data).'''
+    if type(stats) == type(None):
+        stats = ClusterStats()
+        for start in range(0, len(features), chunk_size):
+            stats.update(features[start:start+chunk_size],
+                         labels[start:start+chunk_size])
+    for start in range(0, len(features), chunk_size):
+        stats.update_dispersion(features[start:start+chunk_size],
+                                labels[start:start+chunk_size])
+    return stats.davies_bouldin()
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Parameter searches ::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def cluster_scores(features, labels, exact=False, n_sample=5000,
+                   return_ci=False, chunk_size=100000):
+    '''Silhouette, Calinski-Harabasz and Davies-Bouldin scores for a
+    clustering, as used by the parameter searches.
+    Parameters:
+        * exact : if True, use the sklearn implementations (O(N^2) for the
+                  silhouette score)
+        * n_sample : size of the stratified sample used for the silhouette
+                     estimate
+        * return_ci : if True, also return the (lower, upper) confidence
+                      interval of the silhouette estimate
+    Returns: silhouette, ch_score, db_score[, silhouette_ci]'''
+    if exact:
+        from sklearn.metrics import silhouette_score, \
+            calinski_harabasz_score, davies_bouldin_score
+        silhouette = silhouette_score(features, labels)
+        ci = (silhouette, silhouette)
+        ch_score = calinski_harabasz_score(features, labels)
+        db_score = davies_bouldin_score(features, labels)
+    else:
+        silhouette, lower, upper = sampled_silhouette(features, labels,
+                                                      n_sample=n_sample)
+        ci = (lower, upper)
+        stats = ClusterStats()
+        for start in range(0, len(features), chunk_size):
+            stats.update(features[start:start+chunk_size],
+                         labels[start:start+chunk_size])
+        ch_score = stats.calinski_harabasz()
+        db_score = davies_bouldin(features, labels, chunk_size=chunk_size,
+                                  stats=stats)
+
+    if return_ci:
+        return silhouette, ch_score, db_score, ci
+    return silhouette, ch_score, db_score
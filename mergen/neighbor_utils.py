@@ -0,0 +1,700 @@
+# -*- coding: utf-8 -*-
+"""
+neighbor_utils.py
+
+Shared neighbor graphs for the clustering and outlier parameter searches.
+Many (eps, min_samples, ...) combinations need the same neighborhoods, so
+the graph is computed once and every combination is derived from it.
+
+Radius neighbor graphs (DBSCAN)
+* radius_graph
+* restrict_graph
+* precomputed_dbscan
+* dbscan_grid
+
+k-nearest neighbor graphs (LOF, k-distance)
+* knn_graph
+* cached_knn_graph
+* local_outlier_factor
+* mean_knn_distance
+* eps_heuristic
+
+Approximate nearest neighbors
+* RPForest
+* ann_knn_graph
+* knn_recall
+* recall_report
+* knn_affinity_graph
+
+Similarity search
+* SimilarityIndex
+* load_similarity_index
+
+Novelty scoring of new objects
+* NoveltyModel
+* load_novelty_model
+"""
+
+import numpy as np
+import os
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Radius neighbor graphs ::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def radius_graph(features, radius, metric='minkowski', p=2, algorithm='auto',
+                 leaf_size=30, n_jobs=None):
+    '''Sparse distance graph of all pairs of points within radius.
+    Parameters:
+        * features : array with shape=(num light curves, num features)
+        * radius : largest eps that will be queried from the graph
+        * metric, p, algorithm, leaf_size : passed to NearestNeighbors
+    Returns: scipy.sparse CSR matrix, shape=(num light curves, num light
+             curves), with each row sorted by distance. Self-distances (0) are
+             stored explicitly.'''
+    from sklearn.neighbors import NearestNeighbors
+    if p is None:
+        p = 2
+    nn = NearestNeighbors(radius=radius, metric=metric, p=p,
+                          algorithm=algorithm, leaf_size=leaf_size,
+                          n_jobs=n_jobs).fit(features)
+    graph = nn.radius_neighbors_graph(features, mode='distance',
+                                      sort_results=True)
+    return graph
+
+def restrict_graph(graph, eps):
+    '''Keeps only the edges of a radius graph with distance <= eps. Unlike
+    thresholding the sparse matrix directly, explicitly stored zero distances
+    (duplicates and self-distances) are kept.'''
+    from scipy.sparse import csr_matrix
+    n = graph.shape[0]
+    mask = graph.data <= eps
+    rows = np.repeat(np.arange(n), np.diff(graph.indptr))
+    indptr = np.zeros(n+1, dtype=graph.indptr.dtype)
+    np.cumsum(np.bincount(rows[mask], minlength=n), out=indptr[1:])
+    return csr_matrix((graph.data[mask], graph.indices[mask], indptr),
+                      shape=graph.shape)
+
+def precomputed_dbscan(graph, eps, min_samples=5, n_jobs=None):
+    '''Runs DBSCAN on a precomputed radius graph (built with radius >= eps).
+    Returns the fitted DBSCAN object, so labels are in db.labels_.'''
+    from sklearn.cluster import DBSCAN
+    return DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed',
+                  n_jobs=n_jobs).fit(restrict_graph(graph, eps))
+
+def dbscan_grid(features, eps, min_samples=[5], metric=['minkowski'], p=[2],
+                algorithm='auto', leaf_size=30, n_jobs=None):
+    '''Computes DBSCAN labels for every combination of eps, min_samples,
+    metric and p. One radius graph is built at max(eps) for each (metric, p),
+    and all smaller eps and every min_samples are derived from it. DBSCAN's
+    algorithm and leaf_size only change how neighbors are found, not the
+    result, so they are not part of the grid.
+    Returns: dictionary {(eps, min_samples, metric, p): labels}'''
+    labels = {}
+    for met in metric:
+        for p_val in (p if met == 'minkowski' else [None]):
+            graph = radius_graph(features, np.max(eps), metric=met, p=p_val,
+                                 algorithm=algorithm, leaf_size=leaf_size,
+                                 n_jobs=n_jobs)
+            for e in eps:
+                for ms in min_samples:
+                    db = precomputed_dbscan(graph, e, min_samples=ms,
+                                            n_jobs=n_jobs)
+                    labels[(e, ms, met, p_val)] = db.labels_
+    return labels
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: k-nearest neighbor graphs :::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def knn_graph(features, k_max, metric='minkowski', p=2, algorithm='auto',
+              leaf_size=30, n_jobs=None, backend='exact'):
+    '''Distances and indices of the k_max nearest neighbors of every point,
+    excluding the point itself (as in LocalOutlierFactor).
+    Parameters:
+        * backend : 'exact' (sklearn NearestNeighbors), or an approximate
+                    backend for large feature tables: 'rpforest',
+                    'pynndescent' or 'auto' (see ann_knn_graph)
+    Returns: dist, ind with shape=(num light curves, k_max), sorted by
+             distance'''
+    from sklearn.neighbors import NearestNeighbors
+    if p is None:
+        p = 2
+    k_max = min(int(k_max), len(features)-1)
+    if backend != 'exact':
+        return ann_knn_graph(features, k_max, metric=metric, p=p,
+                             backend=backend)
+    nn = NearestNeighbors(n_neighbors=k_max, metric=metric, p=p,
+                          algorithm=algorithm, leaf_size=leaf_size,
+                          n_jobs=n_jobs).fit(features)
+    dist, ind = nn.kneighbors()
+    return dist, ind
+
+def _features_key(features, metric, p, backend='exact'):
+    import hashlib
+    h = hashlib.sha1(np.ascontiguousarray(features, dtype=np.float64))
+    h.update((str(metric)+str(p)).encode())
+    if backend != 'exact':
+        h.update(backend.encode())
+    return h.hexdigest()
+
+def cached_knn_graph(features, k_max, fname=None, metric='minkowski', p=2,
+                     algorithm='auto', n_jobs=None, backend='exact'):
+    '''knn_graph, cached in fname (e.g. knn_graph.npz next to the features).
+    The cache is reused for any k <= the cached k_max, as long as the
+    features, metric and p are unchanged; otherwise it is recomputed.
+    Returns: dist, ind with k_max columns'''
+    key = _features_key(features, metric, p, backend)
+    k_max = min(int(k_max), len(features)-1)
+    if type(fname) != type(None) and os.path.exists(fname):
+        cache = np.load(fname)
+        if str(cache['key']) == key and cache['dist'].shape[1] >= k_max:
+            return cache['dist'][:,:k_max], cache['ind'][:,:k_max]
+
+    dist, ind = knn_graph(features, k_max, metric=metric, p=p,
+                          algorithm=algorithm, n_jobs=n_jobs, backend=backend)
+    if type(fname) != type(None):
+        np.savez(fname, dist=dist, ind=ind, key=key)
+        print('Saved '+fname)
+    return dist, ind
+
+def local_outlier_factor(dist, ind, n_neighbors=20):
+    '''Local outlier factor of every point for any n_neighbors <= the
+    number of columns of the kNN graph. Same as
+    -LocalOutlierFactor(n_neighbors).fit(X).negative_outlier_factor_.'''
+    k = min(int(n_neighbors), dist.shape[1])
+    dist, ind = dist[:,:k], ind[:,:k]
+    k_dist = dist[:,-1]
+    reach_dist = np.maximum(dist, k_dist[ind])
+    lrd = 1. / (np.mean(reach_dist, axis=1) + 1e-10)
+    return np.mean(lrd[ind] / lrd[:,None], axis=1)
+
+def mean_knn_distance(dist, k):
+    '''Mean distance to the k nearest neighbors, counting the point itself
+    (at distance 0) as the first neighbor, as in
+    NearestNeighbors(n_neighbors=k).fit(X).kneighbors(X).'''
+    return np.sum(dist[:,:k-1], axis=1) / k
+
+def eps_heuristic(dist, k):
+    '''DBSCAN eps for min_samples=k from the knee of the sorted k-distance
+    curve (Ester et al 1996): the point furthest below the straight line
+    joining the ends of the curve.'''
+    curve = np.sort(mean_knn_distance(dist, k))
+    x = np.linspace(0, 1, len(curve))
+    span = curve[-1] - curve[0]
+    if span == 0:
+        return curve[0]
+    y = (curve - curve[0]) / span
+    return curve[np.argmax(x - y)]
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Approximate nearest neighbors :::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+class RPForest(object):
+    '''Random projection forest for approximate nearest neighbors (pure
+    NumPy). Each tree splits the points recursively at the median of their
+    projection onto a random direction until leaves hold at most leaf_size
+    points. The candidates for a query are the points in its leaf in every
+    tree; optionally, n_refine rounds of neighbor-of-neighbor search
+    (NN-descent) are run on the graph of the fitted points, which is computed
+    once (on the first query, or by kneighbors()) and kept in graph_.'''
+
+    def __init__(self, n_trees=10, leaf_size=50, metric='minkowski', p=2,
+                 n_refine=1, chunk_size=1000, random_state=0):
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.metric = metric
+        self.p = 2 if p is None else p
+        self.n_refine = n_refine
+        self.chunk_size = chunk_size
+        self.random_state = random_state
+
+    def _build_tree(self, rng):
+        n, d = self.X_.shape
+        normals, offsets, children, leaves = [], [], [], []
+        # >> children[node] = (left, right) for internal nodes, or
+        # >> (-1, leaf number) for leaves
+        stack = [(np.arange(n), -1, 0)]
+        while len(stack) > 0:
+            inds, parent, side = stack.pop()
+            node = len(children)
+            if parent >= 0:
+                children[parent][side] = node
+            if len(inds) <= self.leaf_size:
+                normals.append(np.zeros(d))
+                offsets.append(0.)
+                children.append([-1, len(leaves)])
+                leaves.append(inds)
+                continue
+            a, b = rng.choice(inds, 2, replace=False)
+            normal = self.X_[a] - self.X_[b]
+            if not np.any(normal):
+                normal = rng.normal(size=d)
+            proj = self.X_[inds] @ normal
+            offset = np.median(proj)
+            left = proj < offset
+            if np.all(left) or not np.any(left):
+                left = np.zeros(len(inds), dtype='bool')
+                left[rng.permutation(len(inds))[:len(inds)//2]] = True
+            normals.append(normal)
+            offsets.append(offset)
+            children.append([0, 0])
+            stack.append((inds[~left], node, 1))
+            stack.append((inds[left], node, 0))
+
+        # >> leaves padded with -1 to a (num leaves, leaf_size) array
+        width = max([len(l) for l in leaves])
+        leaf_arr = -np.ones((len(leaves), width), dtype='int')
+        for i, l in enumerate(leaves):
+            leaf_arr[i,:len(l)] = l
+        return np.array(normals), np.array(offsets), np.array(children), \
+            leaf_arr
+
+    def fit(self, X):
+        rng = np.random.default_rng(self.random_state)
+        self.X_ = np.asarray(X, dtype=np.float64)
+        self.trees_ = [self._build_tree(rng) for i in range(self.n_trees)]
+        self.graph_ = None
+        return self
+
+    def _leaf_candidates(self, Xq):
+        cands = []
+        for normals, offsets, children, leaf_arr in self.trees_:
+            node = np.zeros(len(Xq), dtype='int')
+            internal = children[node,0] >= 0
+            while np.any(internal):
+                q = np.nonzero(internal)[0]
+                right = np.sum(Xq[q]*normals[node[q]], axis=1) >= offsets[node[q]]
+                node[q] = children[node[q], right.astype('int')]
+                internal = children[node,0] >= 0
+            cands.append(leaf_arr[children[node,1]])
+        return np.concatenate(cands, axis=1)
+
+    def _distances(self, Xq, cands):
+        diff = self.X_[np.maximum(cands, 0)] - Xq[:,None,:]
+        if self.metric in ['euclidean', 'l2'] or \
+           (self.metric == 'minkowski' and self.p == 2):
+            dist = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+        elif self.metric in ['cityblock', 'manhattan', 'l1']:
+            dist = np.sum(np.abs(diff), axis=2)
+        elif self.metric == 'chebyshev':
+            dist = np.max(np.abs(diff), axis=2)
+        elif self.metric == 'minkowski':
+            dist = np.sum(np.abs(diff)**self.p, axis=2)**(1./self.p)
+        else:
+            raise ValueError('RPForest does not support metric '+self.metric)
+        dist[cands < 0] = np.inf
+        return dist
+
+    def _select(self, Xq, cands, k, exclude=None):
+        '''k nearest of each row of candidate indices (duplicates and the
+        excluded index, if given, are ignored).'''
+        cands = np.sort(cands, axis=1)
+        dup = np.zeros(cands.shape, dtype='bool')
+        dup[:,1:] = cands[:,1:] == cands[:,:-1]
+        cands[dup] = -1
+        if type(exclude) != type(None):
+            cands[cands == exclude[:,None]] = -1
+        dist = self._distances(Xq, cands)
+        k = min(k, cands.shape[1])
+        part = np.argpartition(dist, k-1, axis=1)[:,:k]
+        dist = np.take_along_axis(dist, part, axis=1)
+        ind = np.take_along_axis(cands, part, axis=1)
+        order = np.argsort(dist, axis=1)
+        return np.take_along_axis(dist, order, axis=1), \
+            np.take_along_axis(ind, order, axis=1)
+
+    def kneighbors(self, X=None, n_neighbors=20):
+        '''Approximate kNN of the rows of X, or of the fitted points
+        (excluding each point itself) if X is None.
+        Returns: dist, ind with shape=(len(X), n_neighbors)'''
+        fitted = type(X) == type(None)
+        Xq = self.X_ if fitted else np.asarray(X, dtype=np.float64)
+        dist = np.empty((len(Xq), n_neighbors))
+        ind = np.empty((len(Xq), n_neighbors), dtype='int')
+        for start in range(0, len(Xq), self.chunk_size):
+            stop = min(start+self.chunk_size, len(Xq))
+            exclude = np.arange(start, stop) if fitted else None
+            cands = self._leaf_candidates(Xq[start:stop])
+            dist[start:stop], ind[start:stop] = \
+                self._select(Xq[start:stop], cands, n_neighbors, exclude)
+
+        # >> neighbor-of-neighbor refinement, using the graph of the fitted
+        # >> points
+        if self.n_refine > 0:
+            if fitted:
+                graph = ind
+            else:
+                graph = getattr(self, 'graph_', None)
+                if type(graph) == type(None) or graph.shape[1] < n_neighbors:
+                    graph = self.kneighbors(n_neighbors=n_neighbors)[1]
+                graph = graph[:,:n_neighbors]
+            for r in range(self.n_refine):
+                new_ind = np.empty_like(ind)
+                for start in range(0, len(Xq), self.chunk_size):
+                    stop = min(start+self.chunk_size, len(Xq))
+                    exclude = np.arange(start, stop) if fitted else None
+                    nbrs = ind[start:stop]
+                    cands = np.concatenate([nbrs, graph[nbrs].reshape(len(nbrs),
+                                                                      -1)],
+                                           axis=1)
+                    dist[start:stop], new_ind[start:stop] = \
+                        self._select(Xq[start:stop], cands, n_neighbors,
+                                     exclude)
+                ind = new_ind
+                if fitted:
+                    graph = ind
+        if fitted:
+            self.graph_ = ind
+        return dist, ind
+
+def ann_knn_graph(features, k, metric='minkowski', p=2, backend='auto',
+                  **kwargs):
+    '''Approximate kNN graph of the features, excluding each point itself.
+    Parameters:
+        * backend : 'pynndescent' (if installed), 'rpforest' (pure NumPy
+                    fallback), or 'auto' to use the first one available
+        * kwargs : passed to RPForest or pynndescent.NNDescent
+    Returns: dist, ind with shape=(num light curves, k)'''
+    if p is None:
+        p = 2
+    if backend in ['auto', 'pynndescent']:
+        try:
+            import pynndescent
+        except ImportError:
+            if backend == 'pynndescent':
+                print('pynndescent is not installed, using rpforest')
+            backend = 'rpforest'
+        else:
+            backend = 'pynndescent'
+
+    if backend == 'pynndescent':
+        if metric == 'minkowski':
+            metric_kwds = {'p': p}
+        else:
+            metric_kwds = None
+        index = pynndescent.NNDescent(features, n_neighbors=k+1, metric=metric,
+                                      metric_kwds=metric_kwds, **kwargs)
+        ind, dist = index.neighbor_graph
+        # >> drop each point itself (usually, but not always, the first column)
+        self_mask = ind == np.arange(len(features))[:,None]
+        self_mask[~np.any(self_mask, axis=1), -1] = True
+        keep = ~self_mask
+        return dist[keep].reshape(len(features), k), \
+            ind[keep].reshape(len(features), k)
+    elif backend == 'rpforest':
+        forest = RPForest(metric=metric, p=p, **kwargs).fit(features)
+        return forest.kneighbors(n_neighbors=k)
+    else:
+        raise ValueError('Unknown nearest neighbor backend '+backend)
+
+def knn_recall(features, ind, n_sample=1000, metric='minkowski', p=2,
+               random_state=0):
+    '''Recall of an approximate kNN graph against exact search, for a
+    random sample of the points.
+    Returns: recall (mean fraction of the true k neighbors found), and the
+             sampled rows'''
+    from sklearn.neighbors import NearestNeighbors
+    if p is None:
+        p = 2
+    rng = np.random.default_rng(random_state)
+    k = ind.shape[1]
+    sample = rng.choice(len(features), min(n_sample, len(features)),
+                        replace=False)
+    nn = NearestNeighbors(n_neighbors=k+1, metric=metric, p=p).fit(features)
+    true_dist, true_ind = nn.kneighbors(features[sample])
+    hits = 0
+    for i, row in enumerate(sample):
+        true = true_ind[i][true_ind[i] != row][:k]
+        hits += len(np.intersect1d(true, ind[row]))
+    return hits / (len(sample)*k), sample
+
+def recall_report(features, dist, ind, fname=None, n_sample=1000,
+                  metric='minkowski', p=2, lof_k=None):
+    '''Compares an approximate kNN graph with exact search on a sample:
+    recall, relative error of the k-distance and, if lof_k is given, of the
+    LOF scores of the sampled points. Writes the report to fname.
+    Returns: dictionary of the report entries'''
+    from sklearn.neighbors import NearestNeighbors
+    if p is None:
+        p = 2
+    recall, sample = knn_recall(features, ind, n_sample=n_sample,
+                                metric=metric, p=p)
+    k = ind.shape[1]
+    exact_dist, exact_ind = knn_graph(features, k, metric=metric, p=p) \
+        if type(lof_k) != type(None) else (None, None)
+    if type(exact_dist) == type(None):
+        nn = NearestNeighbors(n_neighbors=k+1, metric=metric, p=p).fit(features)
+        true_dist = nn.kneighbors(features[sample])[0][:,1:]
+    else:
+        true_dist = exact_dist[sample]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        kdist_err = np.abs(dist[sample,-1] - true_dist[:,-1]) / true_dist[:,-1]
+    report = {'num_points': len(features), 'num_sample': len(sample), 'k': k,
+              'recall': recall,
+              'median_kdist_rel_error': np.nanmedian(kdist_err)}
+    if type(lof_k) != type(None):
+        lof = local_outlier_factor(dist, ind, n_neighbors=lof_k)
+        lof_exact = local_outlier_factor(exact_dist, exact_ind,
+                                         n_neighbors=lof_k)
+        report['median_lof_rel_error'] = \
+            np.median(np.abs(lof[sample]-lof_exact[sample]) / lof_exact[sample])
+
+    if type(fname) != type(None):
+        with open(fname, 'w') as f:
+            for key in report:
+                f.write('{} {}\n'.format(key, report[key]))
+        print('Saved '+fname)
+    return report
+
+def knn_affinity_graph(dist, ind, n_points=None):
+    '''Sparse distance matrix of a kNN graph (from knn_graph, so without
+    self-neighbors), in the format accepted by
+    sklearn.manifold.TSNE(metric='precomputed'): each row holds the point
+    itself at distance 0 followed by its neighbors sorted by distance, with
+    zero distances stored explicitly. TSNE needs at least
+    3*perplexity+1 neighbors per point.'''
+    from scipy.sparse import csr_matrix
+    n, k = dist.shape
+    if type(n_points) == type(None):
+        n_points = n
+    dist = np.concatenate([np.zeros((n,1)), dist], axis=1)
+    ind = np.concatenate([np.arange(n)[:,None], ind], axis=1)
+    indptr = np.arange(0, n*(k+1)+1, k+1)
+    return csr_matrix((dist.ravel(), ind.ravel(), indptr),
+                      shape=(n, n_points))
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Similarity search :::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+class SimilarityIndex(object):
+    '''Finds the light curves most similar to a given target (TICID) or
+    feature vector. Features are indexed in a KD-tree; rows added with insert
+    (e.g. the bottlenecks of a new sector) are kept in a buffer that is
+    searched by brute force, and the tree is rebuilt once the buffer exceeds
+    rebuild_frac of the indexed rows.
+    The same TICID may appear in several rows (one per sector).
+
+    Example:
+        index = SimilarityIndex().fit(mg.feats, mg.objid, sector=mg.sector)
+        index.save(mg.featpath+'similarity_index.npz')
+        ticid, dist, sector = index.query(38846515, k=50)'''
+
+    def __init__(self, metric='euclidean', leaf_size=40, rebuild_frac=0.1):
+        self.metric = metric
+        self.leaf_size = leaf_size
+        self.rebuild_frac = rebuild_frac
+
+    def fit(self, feats, ticid, sector=None):
+        feats = np.asarray(feats, dtype=np.float64)
+        if type(sector) == type(None) or np.ndim(sector) == 0:
+            sector = np.full(len(feats), -1 if sector is None else sector)
+        self.feats_ = feats
+        self.ticid_ = np.asarray(ticid).astype('int64')
+        self.sector_ = np.asarray(sector).astype('int64')
+        self._rebuild()
+        return self
+
+    def _rebuild(self):
+        from sklearn.neighbors import KDTree
+        self.tree_ = KDTree(self.feats_, leaf_size=self.leaf_size,
+                            metric=self.metric)
+        self.n_tree_ = len(self.feats_)
+        self._sort_ticid()
+
+    def _sort_ticid(self):
+        self.order_ = np.argsort(self.ticid_, kind='stable')
+
+    def insert(self, feats, ticid, sector=-1):
+        '''Adds rows to the index (e.g. a new sector's bottlenecks).'''
+        feats = np.atleast_2d(np.asarray(feats, dtype=np.float64))
+        if np.ndim(sector) == 0:
+            sector = np.full(len(feats), sector)
+        self.feats_ = np.concatenate([self.feats_, feats])
+        self.ticid_ = np.concatenate([self.ticid_,
+                                      np.atleast_1d(ticid).astype('int64')])
+        self.sector_ = np.concatenate([self.sector_,
+                                       np.asarray(sector).astype('int64')])
+        if len(self.feats_) - self.n_tree_ > self.rebuild_frac*self.n_tree_:
+            self._rebuild()
+        else:
+            self._sort_ticid()
+        return self
+
+    def rows(self, ticid):
+        '''Row numbers of a TICID, in insertion order.'''
+        sorted_ticid = self.ticid_[self.order_]
+        lo, hi = np.searchsorted(sorted_ticid, [ticid, ticid+1])
+        return self.order_[lo:hi]
+
+    def _query_rows(self, x, k):
+        '''k nearest rows to the vector x: (dist, rows)'''
+        from sklearn.metrics import pairwise_distances
+        k_tree = min(k, self.n_tree_)
+        dist, rows = self.tree_.query(x[None,:], k=k_tree)
+        dist, rows = dist[0], rows[0]
+        if len(self.feats_) > self.n_tree_:
+            buf_dist = pairwise_distances(x[None,:], self.feats_[self.n_tree_:],
+                                          metric=self.metric)[0]
+            dist = np.concatenate([dist, buf_dist])
+            rows = np.concatenate([rows, np.arange(self.n_tree_,
+                                                   len(self.feats_))])
+            order = np.argsort(dist, kind='stable')[:k]
+            dist, rows = dist[order], rows[order]
+        return dist, rows
+
+    def query_vector(self, x, k=50, exclude=None):
+        '''k most similar light curves to the feature vector x, excluding
+        the TICID exclude.
+        Returns: ticid, dist, sector of the neighbors, sorted by distance'''
+        x = np.asarray(x, dtype=np.float64)
+        n_skip = 0 if exclude is None else len(self.rows(exclude))
+        dist, rows = self._query_rows(x, k+n_skip)
+        if exclude is not None:
+            keep = self.ticid_[rows] != exclude
+            dist, rows = dist[keep], rows[keep]
+        dist, rows = dist[:k], rows[:k]
+        return self.ticid_[rows], dist, self.sector_[rows]
+
+    def query(self, ticid, k=50, sector=None):
+        '''k most similar light curves to the target ticid (other rows of the
+        same TICID are excluded). If the target is indexed in several sectors,
+        the row of the given sector (or the last inserted row) is used.
+        Returns: ticid, dist, sector of the neighbors, sorted by distance'''
+        rows = self.rows(ticid)
+        if type(sector) != type(None):
+            rows = rows[self.sector_[rows] == sector]
+        if len(rows) == 0:
+            raise ValueError('TIC '+str(ticid)+' is not in the index')
+        return self.query_vector(self.feats_[rows[-1]], k=k, exclude=ticid)
+
+    def save(self, fname):
+        np.savez(fname, feats=self.feats_, ticid=self.ticid_,
+                 sector=self.sector_, metric=self.metric,
+                 leaf_size=self.leaf_size, rebuild_frac=self.rebuild_frac)
+        print('Saved '+fname)
+
+def load_similarity_index(fname):
+    '''Loads a SimilarityIndex saved with SimilarityIndex.save (the KD-tree
+    is rebuilt over all rows).'''
+    data = np.load(fname)
+    index = SimilarityIndex(metric=str(data['metric']),
+                            leaf_size=int(data['leaf_size']),
+                            rebuild_frac=float(data['rebuild_frac']))
+    return index.fit(data['feats'], data['ticid'], sector=data['sector'])
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Novelty scoring of new objects ::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+class NoveltyModel(object):
+    '''Local outlier factor of new objects relative to a fixed reference
+    population, like LocalOutlierFactor(novelty=True): the k-distances and
+    local reachability densities (lrd) of the reference points are stored,
+    so scoring a new batch only needs the kNN query of the batch.
+
+    Objects scored with add=True are kept, and once they exceed refit_frac
+    of the reference population the model is refit on everything (the
+    scheduled full refit); refit can also be called directly.'''
+
+    def __init__(self, n_neighbors=20, metric='minkowski', p=2,
+                 backend='exact', refit_frac=None):
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.p = 2 if p is None else p
+        self.backend = backend
+        self.refit_frac = refit_frac
+
+    def fit(self, feats, ticid=None, graph=None):
+        '''Fits the reference population. graph : kNN graph (dist, ind) of
+        feats with at least n_neighbors columns (e.g. from cached_knn_graph),
+        so that it is not computed again.'''
+        feats = np.asarray(feats, dtype=np.float64)
+        if type(ticid) == type(None):
+            ticid = -np.ones(len(feats), dtype='int64')
+        k = min(self.n_neighbors, len(feats)-1)
+        if type(graph) == type(None) or graph[0].shape[1] < k:
+            graph = knn_graph(feats, self.n_neighbors, metric=self.metric,
+                              p=self.p, backend=self.backend)
+        dist, ind = graph[0][:,:k], graph[1][:,:k]
+        self.feats_ = feats
+        self.ind_ = np.asarray(ind)
+        self.ticid_ = np.asarray(ticid).astype('int64')
+        self.k_dist_ = dist[:,-1]
+        reach_dist = np.maximum(dist, self.k_dist_[ind])
+        self.lrd_ = 1. / (np.mean(reach_dist, axis=1) + 1e-10)
+        self.scores_ = np.mean(self.lrd_[ind] / self.lrd_[:,None], axis=1)
+        self.new_feats_ = np.empty((0, feats.shape[1]))
+        self.new_ticid_ = np.empty(0, dtype='int64')
+        self._build_index()
+        return self
+
+    def _build_index(self):
+        from sklearn.neighbors import NearestNeighbors
+        k = min(self.n_neighbors, len(self.feats_)-1)
+        if self.backend == 'exact':
+            self.index_ = NearestNeighbors(n_neighbors=k, metric=self.metric,
+                                           p=self.p).fit(self.feats_)
+        else:
+            # >> the reference kNN graph seeds the refinement of queries
+            self.index_ = RPForest(metric=self.metric, p=self.p).fit(self.feats_)
+            self.index_.graph_ = self.ind_
+
+    def score_new(self, feats, ticid=None, add=True):
+        '''LOF of new objects relative to the reference population (the
+        reference itself is unchanged).
+        Returns: lof, shape=(len(feats),)'''
+        feats = np.atleast_2d(np.asarray(feats, dtype=np.float64))
+        k = min(self.n_neighbors, len(self.feats_)-1)
+        dist, ind = self.index_.kneighbors(feats, n_neighbors=k)
+        reach_dist = np.maximum(dist, self.k_dist_[ind])
+        lrd = 1. / (np.mean(reach_dist, axis=1) + 1e-10)
+        lof = np.mean(self.lrd_[ind] / lrd[:,None], axis=1)
+
+        if add:
+            if type(ticid) == type(None):
+                ticid = -np.ones(len(feats), dtype='int64')
+            self.new_feats_ = np.concatenate([self.new_feats_, feats])
+            self.new_ticid_ = np.concatenate([self.new_ticid_,
+                                              np.atleast_1d(ticid).astype('int64')])
+            if type(self.refit_frac) != type(None) and \
+               len(self.new_feats_) > self.refit_frac*len(self.feats_):
+                self.refit()
+        return lof
+
+    def refit(self):
+        '''Full refit on the reference and all added objects; scores_ then
+        holds the LOF of every object (reference first).'''
+        print('Refitting novelty model on '+\
+              str(len(self.feats_)+len(self.new_feats_))+' objects')
+        return self.fit(np.concatenate([self.feats_, self.new_feats_]),
+                        np.concatenate([self.ticid_, self.new_ticid_]))
+
+    def save(self, fname):
+        np.savez(fname, feats=self.feats_, ticid=self.ticid_, ind=self.ind_,
+                 k_dist=self.k_dist_, lrd=self.lrd_, scores=self.scores_,
+                 new_feats=self.new_feats_, new_ticid=self.new_ticid_,
+                 n_neighbors=self.n_neighbors, metric=self.metric, p=self.p,
+                 backend=self.backend,
+                 refit_frac=np.nan if self.refit_frac is None \
+                 else self.refit_frac)
+        print('Saved '+fname)
+
+def load_novelty_model(fname):
+    '''Loads a NoveltyModel saved with NoveltyModel.save. The stored lrd
+    values are reused; only the neighbor index is rebuilt.'''
+    data = np.load(fname)
+    refit_frac = float(data['refit_frac'])
+    model = NoveltyModel(n_neighbors=int(data['n_neighbors']),
+                         metric=str(data['metric']), p=float(data['p']),
+                         backend=str(data['backend']),
+                         refit_frac=None if np.isnan(refit_frac) else refit_frac)
+    model.feats_, model.ticid_ = data['feats'], data['ticid']
+    model.k_dist_, model.lrd_ = data['k_dist'], data['lrd']
+    model.scores_ = data['scores']
+    model.new_feats_, model.new_ticid_ = data['new_feats'], data['new_ticid']
+    model.ind_ = data['ind'] if 'ind' in data else None
+    model._build_index()
+    return model
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+otype_utils.py
+
+Object-type (otype) taxonomy compiled to integer codes. The GCVS/SIMBAD
+hierarchy (parent classes, redundant classes, classes removed before
+clustering, SIMBAD-to-GCVS renames; see data_utils.make_parent_dict etc.)
+is turned into lookup arrays over a sorted vocabulary of otype names:
+    * parent : code of the root class of every code (parent closure)
+    * rename : code of the GCVS name of every SIMBAD name
+    * removed : whether a class is removed
+    * redundant : redundant[a, b] is True if class a is dropped from a label
+                  that also contains class b
+Labels like 'EA|RS|UV:' are resolved for a whole sector at once: the unique
+label strings are split into one flat array of atoms, encoded with
+searchsorted and mapped through the lookup arrays, so no per-target Python
+loop or dictionary rebuild is needed. Compiled taxonomies are cached in
+memory and on disk.
+
+Labels
+* split_otypes
+* join_otypes
+* strip_flags
+* strip_atoms
+
+Taxonomy
+* OtypeTaxonomy
+* compile_taxonomy
+* cached_taxonomy
+* load_taxonomy
+"""
+
+import numpy as np
+import os
+import json
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Labels ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def split_otypes(otypes, seps=['|']):
+    '''Splits labels (e.g. 'EA|RS') into atoms.
+    Returns: owner (index of the label of every atom), atoms'''
+    otypes = np.asarray(otypes).astype('str')
+    for sep in seps[1:]:
+        otypes = np.char.replace(otypes, sep, seps[0])
+    if len(otypes) == 0:
+        return np.empty(0, dtype='int'), np.empty(0, dtype='str')
+    counts = np.char.count(otypes, seps[0]) + 1
+    owner = np.repeat(np.arange(len(otypes)), counts)
+    atoms = np.array(seps[0].join(otypes).split(seps[0]))
+    return owner, atoms
+
+def join_otypes(owner, atoms, n, sep='|', fill=''):
+    '''Inverse of split_otypes: joins the atoms of each of the n labels (in
+    the given order; owner must be sorted). Labels without atoms are set to
+    fill.'''
+    out = np.full(n, fill, dtype=object)
+    if len(atoms) > 0:
+        starts = np.concatenate([[0], np.nonzero(np.diff(owner))[0]+1])
+        pieces = np.char.add(sep, np.asarray(atoms).astype('str'))
+        joined = np.add.reduceat(pieces.astype(object), starts)
+        out[owner[starts]] = [s[len(sep):] for s in joined]
+    return out.astype('str')
+
+def strip_flags(atoms, flags=[':', '?', '*']):
+    '''Removes uncertainty flags (trailing ':', '?', '*') and suffixes in
+    parentheses (e.g. RR(B) -> RR) from atoms.'''
+    atoms = np.char.rstrip(np.asarray(atoms).astype('str'), ''.join(flags))
+    return np.char.partition(atoms, '(')[:,0] if len(atoms) > 0 else atoms
+
+def strip_atoms(otypes, remove, sep='|', fill=''):
+    '''Removes the given atoms from every label, keeping the order of the
+    others (e.g. strip_atoms(otypes, ['Pec'], fill='UNCLASSIFIED')). Labels
+    left empty by the removal are set to fill.'''
+    otypes = np.asarray(otypes).astype('str')
+    uniq, inv = np.unique(otypes, return_inverse=True)
+    owner, atoms = split_otypes(uniq, [sep])
+    keep = ~np.isin(atoms, remove) & (atoms != '')
+    labels = join_otypes(owner[keep], atoms[keep], len(uniq), sep=sep,
+                         fill=fill)
+    labels = np.where(uniq == '', '', labels)
+    return labels[inv]
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Taxonomy ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+class OtypeTaxonomy(object):
+    '''Compiled otype taxonomy (see module docstring). Create with
+    compile_taxonomy or cached_taxonomy. Names not in the vocabulary are
+    added on the fly as root classes that are neither removed nor
+    redundant.'''
+
+    def __init__(self, names, parent, rename, removed, redundant, key=''):
+        self.names = np.asarray(names).astype('str')
+        self.parent = np.asarray(parent)
+        self.rename = np.asarray(rename)
+        self.removed = np.asarray(removed).astype('bool')
+        self.redundant = np.asarray(redundant).astype('bool')
+        self.key = key
+
+    def __len__(self):
+        return len(self.names)
+
+    def _extend(self, names):
+        new = np.setdiff1d(np.asarray(names).astype('str'), self.names)
+        if len(new) == 0:
+            return
+        names = np.union1d(self.names, new)
+        m = np.searchsorted(names, self.names) # >> old code -> new code
+        n = len(names)
+        parent, rename = np.arange(n), np.arange(n)
+        parent[m], rename[m] = m[self.parent], m[self.rename]
+        removed = np.zeros(n, dtype='bool')
+        removed[m] = self.removed
+        redundant = np.zeros((n, n), dtype='bool')
+        redundant[np.ix_(m, m)] = self.redundant
+        self.names, self.parent, self.rename = names, parent, rename
+        self.removed, self.redundant = removed, redundant
+
+    def encode(self, names):
+        '''Integer codes of otype names.'''
+        names = np.asarray(names).astype('str')
+        self._extend(names)
+        return np.searchsorted(self.names, names)
+
+    def _rules(self, rules):
+        '''Redundancy matrix of a dictionary {class: [classes]} ('*': any
+        other class).'''
+        self._extend(list(rules.keys()) + \
+                     [v for vals in rules.values() for v in vals if v != '*'])
+        redundant = np.zeros((len(self), len(self)), dtype='bool')
+        for name in rules:
+            a = self.encode([name])[0]
+            if '*' in rules[name]:
+                redundant[a] = True
+                redundant[a, a] = False
+            else:
+                redundant[a, self.encode(rules[name])] = True
+        return redundant
+
+    def resolve(self, otypes, seps=['|'], flags=[':', '?', '*'],
+                strip=True, rename=False, remove=None, parents=True,
+                redundant=True, fill=''):
+        '''Cleans and merges labels (e.g. the otypes of every target of a
+        sector).
+        Parameters:
+            * seps : separators of the atoms of a label
+            * strip : remove uncertainty flags and (..) suffixes
+            * rename : map SIMBAD names to GCVS names
+            * remove : names removed from labels (default: the compiled
+                       remove list), applied before mapping to parents
+            * parents : replace subclasses by their root class
+            * redundant : drop redundant classes (True: compiled rules,
+                          False: none, or a dictionary {class: [classes]},
+                          '*' meaning any other class)
+            * fill : label of targets left without classes
+        Returns: labels with the atoms of each in sorted order, e.g.
+                 'EA|RS', with no repeats'''
+        otypes = np.asarray(otypes).astype('str')
+        uniq, inv = np.unique(otypes, return_inverse=True)
+        owner, atoms = split_otypes(uniq, seps)
+        if strip:
+            atoms = strip_flags(atoms, flags)
+        # >> add unknown names first, so that codes stay valid below
+        self._extend(np.concatenate([atoms, np.asarray(
+            [] if type(remove) == type(None) else remove).astype('str')]))
+        if isinstance(redundant, dict):
+            redundant = self._rules(redundant)
+        codes = self.encode(atoms)
+        if rename:
+            codes = self.rename[codes]
+
+        if type(remove) == type(None):
+            removed = self.removed
+        else:
+            removed = np.zeros(len(self), dtype='bool')
+            removed[self.encode(remove)] = True
+        keep = ~removed[codes] & (self.names[codes] != '')
+        owner, codes = owner[keep], codes[keep]
+        if parents:
+            codes = self.parent[codes]
+
+        # >> remove repeats (and sort atoms by name)
+        n = len(self)
+        flat = np.unique(owner.astype('int64')*n + codes)
+        owner, codes = flat // n, flat % n
+
+        if redundant is not False:
+            rules = self.redundant if redundant is True else redundant
+            present = np.zeros((len(uniq), n), dtype='bool')
+            present[owner, codes] = True
+            drop = np.any(rules[codes] & present[owner], axis=1)
+            owner, codes = owner[~drop], codes[~drop]
+
+        return join_otypes(owner, self.names[codes], len(uniq),
+                           fill=fill)[inv]
+
+    def save(self, fname):
+        np.savez(fname, names=self.names, parent=self.parent,
+                 rename=self.rename, removed=self.removed,
+                 redundant=self.redundant, key=self.key)
+        print('Saved '+fname)
+
+def _taxonomy_key(sources):
+    import hashlib
+    return hashlib.sha1(json.dumps(sources, sort_keys=True).encode())\
+                  .hexdigest()
+
+def compile_taxonomy(parent_dict={}, redundant_dict={}, remove_classes=[],
+                     rename={}):
+    '''Compiles an OtypeTaxonomy.
+    Parameters:
+        * parent_dict : {parent: [subclasses]}
+        * redundant_dict : {class: [classes]}, class is dropped from labels
+                           that contain any of the classes ('*': any other
+                           class)
+        * remove_classes : classes removed from labels
+        * rename : {SIMBAD name: GCVS name}'''
+    names = ['']
+    for d in [parent_dict, redundant_dict, rename]:
+        for k in d:
+            names.append(k)
+            names.extend([v] if isinstance(d[k], str) else d[k])
+    names.extend(remove_classes)
+    names = np.unique([n for n in names if n != '*'])
+    code = {name: i for i, name in enumerate(names)}
+
+    parent = np.arange(len(names))
+    for p in parent_dict:
+        for c in parent_dict[p]:
+            parent[code[c]] = code[p]
+    while True: # >> parent closure: follow parents up to the root
+        root = parent[parent]
+        if np.all(root == parent):
+            break
+        parent = root
+
+    rename_arr = np.arange(len(names))
+    for a in rename:
+        rename_arr[code[a]] = code[rename[a]]
+    removed = np.isin(names, remove_classes)
+
+    tax = OtypeTaxonomy(names, parent, rename_arr, removed,
+                        np.zeros((len(names), len(names)), dtype='bool'))
+    tax.redundant = tax._rules(redundant_dict)
+    tax.key = _taxonomy_key({'parent_dict': parent_dict,
+                             'redundant_dict': redundant_dict,
+                             'remove_classes': list(remove_classes),
+                             'rename': rename})
+    return tax
+
+def load_taxonomy(fname):
+    data = np.load(fname)
+    return OtypeTaxonomy(data['names'], data['parent'], data['rename'],
+                         data['removed'], data['redundant'],
+                         key=str(data['key']))
+
+# >> compiled taxonomies by key, so repeated calls in a session compile once
+_TAXONOMIES = {}
+
+def cached_taxonomy(fname=None, **sources):
+    '''compile_taxonomy(**sources), reused if it was already compiled from
+    the same sources in this session, or loaded from fname (npz) if it was
+    compiled from the same sources, otherwise compiled and saved there (if
+    fname is given).'''
+    key = _taxonomy_key({'parent_dict': sources.get('parent_dict', {}),
+                         'redundant_dict': sources.get('redundant_dict', {}),
+                         'remove_classes': list(sources.get('remove_classes',
+                                                            [])),
+                         'rename': sources.get('rename', {})})
+    if key in _TAXONOMIES:
+        tax = _TAXONOMIES[key]
+        if type(fname) != type(None) and not os.path.exists(fname):
+            tax.save(fname)
+        return tax
+    if type(fname) != type(None) and os.path.exists(fname):
+        tax = load_taxonomy(fname)
+        if tax.key == key:
+            _TAXONOMIES[key] = tax
+            return tax
+    tax = compile_taxonomy(**sources)
+    if type(fname) != type(None):
+        tax.save(fname)
+    _TAXONOMIES[key] = tax
+    return tax
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+pipeline_utils.py
+
+Stage graph for running the Mergen pipeline incrementally. Every stage
+declares the attributes of the Mergen object it reads (inputs), the
+attributes it sets (outputs) and the configuration attributes it depends on
+(params). The producer of an input is the last earlier stage that outputs
+it, so a list of stages in execution order defines the graph.
+
+Each stage has a key, the hash of its params, the keys of the producers of
+its inputs (or, for inputs no stage produces, the hash of their values) and
+its function name. A stage whose key is unchanged since its last run is
+skipped, and its cached outputs are loaded instead. Changing one parameter
+(e.g. numclstr) therefore reruns the stages that depend on it, directly or
+through their inputs, and nothing upstream. Stages whose inputs are ready
+run concurrently (e.g. t-SNE and novelty scoring).
+
+Layout of a pipeline directory:
+    * <stage>.mgb : cached outputs of a stage (product_utils bundle; arrays
+                    as memory-mapped arrays, scalars and dictionaries in the
+                    bundle metadata)
+    * pipeline.json : key, finish time and run time of every stage
+
+Stages
+* Stage
+* digest
+
+Pipeline
+* Pipeline
+"""
+
+import numpy as np
+import os
+import json
+import time
+from datetime import datetime
+
+from . import product_utils as pu
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Stages ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+class Stage(object):
+    '''Step of a Pipeline.
+    Parameters:
+        * name : unique name of the stage, e.g. 'clusters'
+        * func : called as func(obj), reads the inputs from obj and sets the
+                 outputs on obj (e.g. an unbound method, mergen.generate_tsne)
+        * inputs : attributes of obj read by func
+        * outputs : attributes of obj set by func
+        * params : configuration attributes of obj that func depends on
+        * cache : outputs saved after a run and loaded when the stage is
+                  skipped. True: every output. False: none, the stage only
+                  runs when a running stage needs its outputs (e.g. loading
+                  or preprocessing light curves, which are already on disk)'''
+
+    def __init__(self, name, func, inputs=[], outputs=[], params=[],
+                 cache=True):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = list(params)
+        if cache is True:
+            cache = self.outputs
+        elif cache is False:
+            cache = []
+        self.cache = list(cache)
+        self.persistent = len(self.cache) > 0 or len(self.outputs) == 0
+
+    def __repr__(self):
+        return 'Stage('+self.name+')'
+
+def _update(h, value):
+    if isinstance(value, np.ndarray) and value.dtype.kind != 'O':
+        h.update(str((value.dtype.str, value.shape)).encode())
+        h.update(np.ascontiguousarray(value).view('uint8'))
+    elif isinstance(value, (list, tuple)):
+        h.update(b'[')
+        for v in value:
+            _update(h, v)
+            h.update(b',')
+        h.update(b']')
+    elif isinstance(value, dict):
+        for k in sorted(value, key=str):
+            h.update(str(k).encode()+b':')
+            _update(h, value[k])
+    elif isinstance(value, str) and os.path.isfile(value):
+        # >> files (e.g. parampath) are identified by their size and mtime
+        stat = os.stat(value)
+        h.update(json.dumps([value, stat.st_size, stat.st_mtime_ns]).encode())
+    else:
+        h.update(json.dumps(value, default=pu._json_default).encode())
+
+def digest(value):
+    '''Hash of a parameter or input value (arrays, lists, dictionaries,
+    JSON-serializable values; existing files by path, size and
+    modification time).'''
+    import hashlib
+    h = hashlib.sha1()
+    _update(h, value)
+    return h.hexdigest()
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Pipeline ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+class Pipeline(object):
+    '''Graph of Stages with cached outputs in the directory path (see module
+    docstring).
+
+    Example:
+        pipe = Pipeline([Stage('tsne', mergen.generate_tsne, ['feats'],
+                               ['tsne']), ...], mg.featpath+'stages/')
+        pipe.run(mg)'''
+
+    def __init__(self, stages, path, n_jobs=2):
+        self.stages = list(stages)
+        self.path = path
+        self.n_jobs = n_jobs
+        self.timings = {}
+
+        names = [s.name for s in self.stages]
+        if len(set(names)) != len(names):
+            raise ValueError('Stage names are not unique: '+', '.join(names))
+
+        # >> producer of every input: the last earlier stage that outputs it
+        self.producer = {}
+        for i, s in enumerate(self.stages):
+            self.producer[s.name] = {}
+            for attr in s.inputs:
+                prod = [p for p in self.stages[:i] if attr in p.outputs]
+                self.producer[s.name][attr] = prod[-1] if prod else None
+
+    def __getitem__(self, name):
+        for s in self.stages:
+            if s.name == name:
+                return s
+        raise ValueError('No stage '+name)
+
+    def load_state(self):
+        fname = self.path+'pipeline.json'
+        if os.path.exists(fname):
+            with open(fname, 'r') as f:
+                return json.load(f)
+        return {}
+
+    def save_state(self, state):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(self.path+'pipeline.json', 'w') as f:
+            json.dump(state, f, indent=1)
+
+    def keys(self, obj):
+        '''Key of every stage for the current params of obj.'''
+        keys = {}
+        for s in self.stages:
+            inputs = {}
+            for attr in s.inputs:
+                prod = self.producer[s.name][attr]
+                if type(prod) == type(None):
+                    inputs[attr] = digest(getattr(obj, attr, None))
+                else:
+                    inputs[attr] = keys[prod.name]
+            keys[s.name] = digest({'func': getattr(s.func, '__name__', ''),
+                                   'inputs': inputs,
+                                   'params': {p: digest(getattr(obj, p, None))
+                                              for p in s.params}})
+        return keys
+
+    def plan(self, obj, targets=None, force=False):
+        '''Stages to run and stages to load from the cache.
+        Parameters:
+            * targets : names of the stages to bring up to date, with
+                        everything they need (default: every cached stage)
+            * force : True, or names of stages to rerun even if their key is
+                      unchanged
+        Returns: keys, run (stage names, in execution order), load'''
+        keys, state = self.keys(obj), self.load_state()
+        if force is False:
+            force = []
+        if type(targets) == type(None):
+            targets = [s.name for s in self.stages if s.persistent]
+
+        def valid(s):
+            if force is True or s.name in force:
+                return False
+            if state.get(s.name, {}).get('key') != keys[s.name]:
+                return False
+            return len(s.cache) == 0 or os.path.exists(self.path+s.name+'.mgb')
+
+        run = set([name for name in targets if not valid(self[name])])
+        load = set()
+        for s in self.stages[::-1]:
+            if s.name not in run:
+                continue
+            for attr in s.inputs:
+                prod = self.producer[s.name][attr]
+                if type(prod) == type(None) or prod.name in run:
+                    continue
+                if attr in prod.cache and valid(prod):
+                    load.add(prod.name)
+                else:
+                    run.add(prod.name)
+
+        # >> also load every other up-to-date stage, so that obj ends up
+        # >> with all the products
+        for s in self.stages:
+            if s.name not in run and len(s.cache) > 0 and valid(s):
+                load.add(s.name)
+        order = [s.name for s in self.stages]
+        return keys, [n for n in order if n in run], \
+            [n for n in order if n in load]
+
+    def save_outputs(self, s, obj):
+        arrays, values, dicts = {}, {}, {}
+        for attr in s.cache:
+            value = getattr(obj, attr, None)
+            if isinstance(value, dict):
+                dicts[attr] = [[k, value[k]] for k in value]
+            elif isinstance(value, (np.ndarray, list, tuple)) and \
+                 np.asarray(value).dtype.kind != 'O':
+                arrays[attr] = value
+            else:
+                values[attr] = value
+        pu.save_bundle(self.path+s.name+'.mgb', arrays,
+                       meta={'stage': s.name, 'values': values,
+                             'dicts': dicts})
+
+    def load_outputs(self, s, obj):
+        bundle = pu.load_bundle(self.path+s.name+'.mgb')
+        for attr in bundle.keys():
+            setattr(obj, attr, bundle[attr])
+        for attr, value in bundle.meta['values'].items():
+            setattr(obj, attr, value)
+        for attr, items in bundle.meta['dicts'].items():
+            setattr(obj, attr, {k: v for k, v in items})
+
+    def run(self, obj, targets=None, force=False, n_jobs=None):
+        '''Brings the target stages up to date: loads the outputs of
+        up-to-date stages and runs the others, each as soon as the stages
+        producing its inputs have finished (at most n_jobs at once).
+        Returns: timings, dictionary {stage name: seconds} of the stages
+                 that ran (also in self.timings and pipeline.json)'''
+        from concurrent.futures import ThreadPoolExecutor, wait, \
+            FIRST_COMPLETED
+        if type(n_jobs) == type(None):
+            n_jobs = self.n_jobs
+        if type(force) == str:
+            force = [force]
+        keys, run, load = self.plan(obj, targets=targets, force=force)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        for name in load:
+            self.load_outputs(self[name], obj)
+        print('Pipeline: '+str(len(run))+' stage(s) to run'+\
+              (' ('+', '.join(run)+')' if run else '')+', '+\
+              str(len(load))+' loaded from '+self.path)
+
+        deps = {}
+        for name in run:
+            deps[name] = set([p.name for p in
+                              self.producer[name].values() \
+                              if type(p) != type(None) and p.name in run])
+
+        def execute(name):
+            start = time.time()
+            self[name].func(obj)
+            return time.time() - start
+
+        state = self.load_state()
+        self.timings = {}
+        pending, running, done = list(run), {}, set()
+        with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as executor:
+            while pending or running:
+                for name in [n for n in pending if deps[n] <= done]:
+                    if len(running) >= max(1, n_jobs):
+                        break
+                    print('Running stage '+name+'...')
+                    pending.remove(name)
+                    running[executor.submit(execute, name)] = name
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        # >> keep the stages that finished, then stop
+                        wait(list(running))
+                        self.save_state(state)
+                        raise future.exception()
+                    seconds = future.result()
+                    s = self[name]
+                    if len(s.cache) > 0:
+                        self.save_outputs(s, obj)
+                    state[name] = {'key': keys[name], 'seconds': seconds,
+                                   'finished': datetime.now().isoformat()}
+                    self.timings[name] = seconds
+                    done.add(name)
+                    print('Finished stage '+name+' in %.2f s'%seconds)
+        self.save_state(state)
+        self.report()
+        return self.timings
+
+    def report(self):
+        '''Prints the run time of the stages of the last run (and, for the
+        others, of their last run).'''
+        state = self.load_state()
+        print('Stage            Seconds  Status')
+        for s in self.stages:
+            if s.name in self.timings:
+                print('%-16s %7.2f  ran'%(s.name, self.timings[s.name]))
+            elif s.name in state:
+                print('%-16s %7.2f  up to date (last run %s)'%(
+                    s.name, state[s.name]['seconds'],
+                    state[s.name]['finished']))
+            else:
+                print('%-16s %7s  not run'%(s.name, '-'))
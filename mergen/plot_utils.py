@@ -30,6 +30,7 @@ Feature space visualizations
 
 Novelty visualizations
     * generate_novelty_scores !!
+    * score_new_novelty
     * load_novelty_scores !!
     * plot_lof             : plots the n top, bottom, and random light curves
                              ranked on their LOF scores
@@ -144,6 +145,11 @@ from scipy.stats import moment, sigmaclip
 # import seaborn as sn
 # import data_functions as df
 from . import data_utils as dt
+from . import neighbor_utils as nu
+from . import embed_utils as eu
+from . import cluster_utils as cu
+from . import join_utils as ju
+from . import product_utils as pu
 
 
 import random
@@ -346,24 +352,17 @@ def produce_ae_visualizations(x, x_train, x_pred, output_dir, ticid, target_info
 
 def clstr_centr_hist(feats, clstr, totype, output_dir, bins=40, t_std=1, facecolor='w',
                      textcolor='w', histcolor='b', scale=10):
-    unq_clstr = sorted(np.unique(clstr))
-    cen_clstr = []
-    thr_clstr = []
-    label = []
-    for i in unq_clstr:
-        if i % 10 == 0:
-            print('Cluster '+str(i))
-
-        # >> find cluster members
-        inds = np.nonzero(clstr == unq_clstr[i])
-
-        # >> find center
-        centr, dist = lt.clstr_centr(feats[inds])
-        cen_clstr.append(centr)
-
-        # >> threshold distance from center
-        thresh = np.median(dist) + t_std*np.std(dist)
-        thr_clstr.append(thresh)
+    # >> find centers and threshold distance from center, for all clusters
+    groups = cu.GroupBy(clstr)
+    cen_clstr, dist_all = cu.cluster_centr_dist(feats, groups)
+    thr_clstr = cu.cluster_thresholds(dist_all, groups, t_std=t_std)
+    for i in range(len(groups)):
+        if groups.keys[i] % 10 == 0:
+            print('Cluster '+str(groups.keys[i]))
+
+        # >> cluster members
+        inds = groups.rows(i)
+        dist, thresh = dist_all[inds], thr_clstr[i]
 
         # >> create histogram
         fig, ax = plt.subplots(facecolor=facecolor)
@@ -374,16 +373,16 @@ def clstr_centr_hist(feats, clstr, totype, output_dir, bins=40, t_std=1, facecol
         ax.axvline(thresh)
 
         # >> superimpose histograms of classified 
-        ot, cnts = np.unique(totype[inds], return_counts=True)
-        for j in range(len(ot)):
-            if ot[j] != 'UNCLASSIFIED':
-                inds_ot = np.nonzero(totype[inds] == ot[j])
-                ax.hist(dist[inds_ot], bins, alpha=0.5, label=ot[j])
+        ot_groups = cu.GroupBy(totype[inds])
+        for j in range(len(ot_groups)):
+            if ot_groups.keys[j] != 'UNCLASSIFIED':
+                ax.hist(dist[ot_groups.rows(j)], bins, alpha=0.5,
+                        label=ot_groups.keys[j])
 
         ax.legend()
         # ax.set_title(label[-1])
-        fig.savefig(output_dir+'hist_clstr_'+str(unq_clstr[i])+'.png')
-        print('Saved '+output_dir+'hist_clstr_'+str(unq_clstr[i])+'.png')
+        fig.savefig(output_dir+'hist_clstr_'+str(groups.keys[i])+'.png')
+        print('Saved '+output_dir+'hist_clstr_'+str(groups.keys[i])+'.png')
         plt.close()
 
     
@@ -830,10 +829,21 @@ def plot_tsne(bottleneck, labels, X=None, n_components=2, output_dir='./',
               lspmpath=None, zoom_dim=0.47,
               inset_label=None, zoom=False, zoom_ind=None, n_zoom=15,
               zoom_clstr=True,
-              numtot=None, otdict=None, facecolor='w', textcolor='k'):
+              numtot=None, otdict=None, facecolor='w', textcolor='k',
+              method='sklearn', cache=False):
+    '''method : embedding backend used if X is not given (see
+    embed_utils.Embedding)
+    cache : if True, the embedding is cached in output_dir by feature hash
+            (see embed_utils.cached_embedding), so that repeated calls on the
+            same features (e.g. in parameter searches) embed them only once'''
     if type(X) == type(None):
-        from sklearn.manifold import TSNE
-        X = TSNE(n_components=n_components).fit_transform(bottleneck)
+        if cache:
+            X = eu.cached_embedding(bottleneck, cache_dir=output_dir,
+                                    method=method,
+                                    n_components=n_components).embedding_
+        else:
+            X = eu.Embedding(method=method, n_components=n_components)\
+                  .fit(bottleneck).embedding_
     labels = np.array(labels)
     unique_classes = np.unique(labels)
     # unique_classes = np.array(list(otypedict.keys()))
@@ -1102,7 +1112,8 @@ def presentation_feature(features, ind, output_dir = './'):
 
 def generate_novelty_scores(features, object_ids, output_dir, prefix='',
                             n_neighbors=20, p=2, metric='minkowski',
-                            contamination=0.1, algorithm='auto'):
+                            contamination=0.1, algorithm='auto', cache=True,
+                            backend='exact', save_model=True):
     """Calculates LOF based on feature vectors.
     * features : array of shape (n_objects, n_dimensions)
     * object_ids : array of shape (n_objects)
@@ -1110,41 +1121,77 @@ def generate_novelty_scores(features, object_ids, output_dir, prefix='',
     * prefix : string
     * n_neighbors, p, metric, contamination, algorithm : arguments of 
       sklearn.neighbors.LocalOutlierFactor()
+    * cache : if True, the kNN graph is cached in output_dir (prefix +
+      knn_graph.npz) and reused for any n_neighbors up to the cached one
+    * backend : 'exact', or 'rpforest' / 'pynndescent' / 'auto' for
+      approximate neighbors (a recall report against exact search on a
+      sample is saved to prefix + lof_ann_recall.txt)
+    * save_model : if True, saves the fitted novelty model (prefix +
+      lof_model.npz), so that new objects can be scored with
+      score_new_novelty without refitting
     """
     print("Generating novelty scores...")
 
-    clf = LocalOutlierFactor(n_neighbors=n_neighbors, p=p, metric=metric,
-                             contamination=contamination, algorithm=algorithm)
-    fit_predictor = clf.fit_predict(features)
-    negative_factor = clf.negative_outlier_factor_
-    
-    lof = -1 * negative_factor
-    with open(output_dir+'lof.txt', 'w') as f:
-        f.write('OBJECT_ID LOF\n')
-        for i in range(len(object_ids)):
-            f.write('{} {}\n'.format(int(object_ids[i]), lof[i]))
+    fname = output_dir+prefix+'knn_graph.npz' if cache else None
+    dist, ind = nu.cached_knn_graph(features, n_neighbors, fname=fname,
+                                    metric=metric, p=p, algorithm=algorithm,
+                                    backend=backend)
+    if backend != 'exact':
+        nu.recall_report(features, dist, ind, metric=metric, p=p,
+                         fname=output_dir+prefix+'lof_ann_recall.txt')
+    lof = nu.local_outlier_factor(dist, ind, n_neighbors=n_neighbors)
+    # >> binary product (product_utils) replacing lof.txt
+    pu.save_product(pu.product_path(output_dir+'lof.txt'), object_ids,
+                    {'lof': lof}, kind='scores',
+                    meta={'n_neighbors': n_neighbors, 'metric': metric})
+
+    if save_model:
+        model = nu.NoveltyModel(n_neighbors=n_neighbors, metric=metric, p=p,
+                                backend=backend).fit(features, object_ids,
+                                                     graph=(dist, ind))
+        model.save(output_dir+prefix+'lof_model.npz')
+    return lof
+
+def score_new_novelty(features, object_ids, output_dir, prefix='',
+                      refit_frac=None):
+    """Scores new objects (e.g. a new sector) against the reference population
+    of the novelty model saved by generate_novelty_scores, in time
+    proportional to the number of new objects. The scores are added to the
+    novelty score product (lof/), and the new objects are added to the saved
+    model.
+    * refit_frac : if the added objects exceed this fraction of the reference
+      population, the model is refit on all objects and all scores are
+      replaced
+    """
+    print("Scoring new objects...")
+    fname = output_dir+prefix+'lof_model.npz'
+    model = nu.load_novelty_model(fname)
+    if type(refit_frac) != type(None):
+        model.refit_frac = refit_frac
+    n_ref = len(model.feats_)
+    lof = model.score_new(features, object_ids)
+
+    path = pu.product_path(output_dir+'lof.txt')
+    if len(model.feats_) > n_ref: # >> scheduled full refit
+        ticid_all, lof_all = model.ticid_, model.scores_
+        lof = model.scores_[-len(lof):]
+    else:
+        ticid_old, lof_old = pu.read_product(output_dir+'lof.txt', 'lof',
+                                             legacy=pu.parse_legacy_scores)
+        ticid_all = np.concatenate([ticid_old, np.asarray(object_ids)])
+        lof_all = np.concatenate([lof_old, lof])
+    pu.save_product(path, ticid_all, {'lof': lof_all}, kind='scores',
+                    meta={'n_neighbors': model.n_neighbors,
+                          'metric': model.metric})
+    model.save(fname)
     return lof
 
 def load_novelty_scores(output_dir, ticid):
     print('Loading novelty scores...')
-    fname = output_dir+'lof.txt'
-    filo = np.loadtxt(fname, skiprows=1)
-    ticid_filo, lof = [filo[:,0], filo[:,1]]
-
-    # sorted_inds = np.argsort(ticid)
-    # >> intersect1d returns sorted arrays, so
-    # >> ticid == ticid[sorted_inds][np.argsort(sorted_inds)]
-    # new_inds = np.argsort(sorted_inds)
-    # _, comm1, comm2 = np.intersect1d(ticid, ticid_filo, return_indices=True)
-    # learned_feature_vector = lof[comm2][new_inds]
-
-    match = []
-    for i in range(len(ticid)):
-        match.append(ticid_filo[i] == ticid[i])
-    if len(ticid) != np.count_nonzero(np.array(match)):
-        print('!!! Missing '+str(len(ticid)-np.count_nonzero(np.array(match)))+\
-             ' TICIDs')
-
+    # >> reorder to match ticid (missing TICIDs get nan); falls back to the
+    # >> legacy lof.txt if there is no binary product
+    lof = pu.read_column(output_dir+'lof.txt', 'lof', ticid,
+                         legacy=pu.parse_legacy_scores, name='novelty scores')
 
     return lof
 
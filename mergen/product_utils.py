@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+product_utils.py
+
+Binary format for Mergen products (cluster labels, novelty scores,
+embeddings, predicted object types). A product is a directory next to the
+legacy text file it replaces (e.g. lof.txt -> lof/):
+    * ticid.npy : int64 TICIDs, sorted (the TICID index: rows of any TICID
+                  are found with searchsorted, without parsing or sorting)
+    * <column>.npy : one typed array per column, rows in TICID order
+                     (string columns are stored as int32 codes)
+    * meta.json : kind, format version, columns with their dtypes (and
+                  categories of string columns), and any extra metadata
+Every file is a plain .npy, so columns are opened memory-mapped. Readers
+fall back to the legacy text files when no product exists, or when the
+legacy file is newer than the product.
+
+Products
+* product_path
+* save_product
+* save_labels
+* has_product
+* Product
+* load_product
+
+Readers
+* read_product
+* read_column
+* parse_legacy_labels
+* parse_legacy_scores
+* parse_legacy_otypes
+
+Bundles
+* save_bundle
+* Bundle
+* load_bundle
+
+A bundle is a single file holding every product of a run (and its
+configuration), opened memory-mapped in constant time:
+    * 8 bytes : magic b'MERGENB\\0'
+    * 8 bytes : length of the JSON header (little-endian uint64)
+    * JSON header : format version, metadata, and the dtype, shape and
+                    offset of every array (plus categories of string arrays)
+    * arrays : raw C-ordered data, each aligned to 64 bytes
+"""
+
+import numpy as np
+import os
+import json
+
+from . import join_utils as ju
+
+PRODUCT_VERSION = 1
+BUNDLE_VERSION = 1
+BUNDLE_MAGIC = b'MERGENB\0'
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Products ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def product_path(fname):
+    '''Directory of the product replacing the legacy file fname (e.g.
+    featpath+'lof.txt' -> featpath+'lof/').'''
+    return os.path.splitext(fname)[0]+'/'
+
+def save_product(path, ticid, columns, kind='', meta={}):
+    '''Saves a product.
+    Parameters:
+        * path : product directory (see product_path)
+        * ticid : TICIDs of the rows
+        * columns : dictionary {name: values}, values with shape=(len(ticid),
+                    ...); string values are stored as categorical codes
+        * kind : e.g. 'labels', 'scores', 'embedding', 'predictions'
+        * meta : extra metadata (JSON-serializable), e.g. numclstr'''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    ticid = np.asarray(ticid).astype('int64')
+    order = np.argsort(ticid, kind='stable')
+    np.save(path+'ticid.npy', ticid[order])
+
+    cols = {}
+    for name in columns:
+        values = np.asarray(columns[name])[order]
+        if values.dtype.kind in 'USO':
+            categories, codes = np.unique(values.astype('str'),
+                                          return_inverse=True)
+            np.save(path+name+'.npy', codes.astype('int32'))
+            cols[name] = {'dtype': 'category',
+                          'categories': categories.tolist()}
+        else:
+            np.save(path+name+'.npy', values)
+            cols[name] = {'dtype': values.dtype.str}
+
+    info = {'kind': kind, 'version': PRODUCT_VERSION, 'n': len(ticid),
+            'columns': cols}
+    info.update(meta)
+    with open(path+'meta.json', 'w') as f:
+        json.dump(info, f, indent=1)
+    print('Saved '+path)
+
+def save_labels(fname, ticid, labels, meta={}):
+    '''Saves cluster labels as the product of the legacy file fname (e.g.
+    output_dir+'gmm_labels_100.txt'), in the column 'clstr'.'''
+    save_product(product_path(fname), ticid, {'clstr': labels}, kind='labels',
+                 meta=meta)
+
+def has_product(fname):
+    '''Whether the product of the legacy file fname, or the legacy file
+    itself, exists.'''
+    return os.path.exists(product_path(fname)+'meta.json') or \
+        os.path.exists(fname)
+
+class Product(object):
+    '''Product opened with memory-mapped columns (see module docstring).'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path+'meta.json', 'r') as f:
+            self.meta = json.load(f)
+        self.ticid = np.load(path+'ticid.npy', mmap_mode='r')
+        self._cols = {}
+
+    def __len__(self):
+        return len(self.ticid)
+
+    @property
+    def columns(self):
+        return list(self.meta['columns'].keys())
+
+    def categories(self, name):
+        return np.array(self.meta['columns'][name].get('categories', []))
+
+    def codes(self, name):
+        '''Stored (memory-mapped) values of a column; int32 codes for string
+        columns.'''
+        if name not in self._cols:
+            if name not in self.meta['columns']:
+                raise ValueError('No column '+name+' in '+self.path)
+            self._cols[name] = np.load(self.path+name+'.npy', mmap_mode='r')
+        return self._cols[name]
+
+    def column(self, name):
+        '''Values of a column, in TICID order (strings decoded).'''
+        values = self.codes(name)
+        if self.meta['columns'][name]['dtype'] == 'category':
+            return self.categories(name)[values]
+        return values
+
+    def rows(self, ticid):
+        '''Row of each TICID (-1 if it is not in the product).'''
+        ticid = np.atleast_1d(np.asarray(ticid).astype('int64'))
+        if len(self.ticid) == 0:
+            return -np.ones(len(ticid), dtype='int')
+        pos = np.minimum(np.searchsorted(self.ticid, ticid), len(self.ticid)-1)
+        return np.where(np.asarray(self.ticid[pos]) == ticid, pos, -1)
+
+    def align(self, name, ticid, fill=np.nan, verbose=True):
+        '''Values of a column reordered to ticid; missing TICIDs get fill
+        and are reported.'''
+        rows = self.rows(ticid)
+        found = rows >= 0
+        values = self.codes(name)
+        is_cat = self.meta['columns'][name]['dtype'] == 'category'
+        if is_cat:
+            values = self.categories(name)[values[rows[found]]]
+        else:
+            values = values[rows[found]]
+        if np.all(found):
+            return values
+        dtype = np.result_type(values.dtype, np.asarray(fill).dtype)
+        out = np.full((len(rows),)+values.shape[1:], fill, dtype=dtype)
+        out[found] = values
+        if verbose:
+            ju.report_missing(np.asarray(ticid)[~found],
+                              name=os.path.basename(self.path[:-1]),
+                              total=len(rows))
+        return out
+
+def load_product(path):
+    return Product(path)
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Readers :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def parse_legacy_labels(fname):
+    '''TICIDs and cluster numbers from a gmm_labels*.txt file (two rows).'''
+    txt = np.loadtxt(fname)
+    return txt[0].astype('int64'), txt[1].astype('int')
+
+def parse_legacy_scores(fname):
+    '''TICIDs and scores from a lof.txt file ('OBJECT_ID LOF' header).'''
+    txt = np.loadtxt(fname, skiprows=1, dtype='str', ndmin=2)
+    return txt[:,0].astype('float').astype('int64'), txt[:,1].astype('float')
+
+def parse_legacy_otypes(fname):
+    '''TICIDs and object types from a ticid_to_label.txt file
+    ('TICID,OTYPE' header).'''
+    txt = np.loadtxt(fname, delimiter=',', dtype='str', skiprows=1, ndmin=2)
+    return txt[:,0].astype('float').astype('int64'), txt[:,1]
+
+def _use_product(fname, legacy=None):
+    '''Whether to read the product of fname rather than the legacy file: the
+    product exists and, if the legacy file can be parsed, it is not older
+    than the legacy file (which may have been written by older code).'''
+    meta = product_path(fname)+'meta.json'
+    if not os.path.exists(meta):
+        return False
+    if type(legacy) == type(None) or not os.path.exists(fname):
+        return True
+    return os.path.getmtime(meta) >= os.path.getmtime(fname)
+
+def read_product(fname, column, legacy=None):
+    '''TICIDs and values of one column of the product of the legacy file
+    fname, or, if there is no product or the legacy file is newer, of the
+    legacy file itself (parsed with legacy(fname), which returns TICIDs and
+    values).'''
+    path = product_path(fname)
+    if _use_product(fname, legacy):
+        prod = load_product(path)
+        return np.asarray(prod.ticid), np.asarray(prod.column(column))
+    if type(legacy) == type(None) or not os.path.exists(fname):
+        raise FileNotFoundError('No product '+path+' or '+fname)
+    print('Reading legacy text file '+fname)
+    return legacy(fname)
+
+def read_column(fname, column, ticid, fill=np.nan, legacy=None, name=None):
+    '''Values of one column of the product of the legacy file fname,
+    reordered to ticid (missing TICIDs get fill and are reported). Falls
+    back to the legacy file (see read_product).'''
+    path = product_path(fname)
+    if _use_product(fname, legacy):
+        return load_product(path).align(column, ticid, fill=fill)
+    ticid_filo, values = read_product(fname, column, legacy=legacy)
+    return ju.align_to_ticid(ticid, ticid_filo, values, fill=fill,
+                             name=name if name else os.path.basename(fname))
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Bundles :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def _align(n, a=64):
+    return (n + a - 1) // a * a
+
+def _json_default(obj):
+    if hasattr(obj, 'tolist'): # >> numpy scalars and arrays
+        return obj.tolist()
+    return str(obj)
+
+def save_bundle(fname, arrays, meta={}):
+    '''Saves arrays (dictionary {name: array}) and metadata (e.g. the
+    configuration of a run) to a single bundle file (see module docstring).
+    String arrays are stored as int32 codes and their categories. The file
+    is written to a temporary name and then renamed, so a bundle is never
+    left half-written.'''
+    import struct
+    entries, data = {}, []
+    offset = 0
+    for name in arrays:
+        values = np.asarray(arrays[name])
+        entry = {}
+        if values.dtype.kind in 'USO':
+            categories, codes = np.unique(values.astype('str'),
+                                          return_inverse=True)
+            values = codes.reshape(values.shape).astype('int32')
+            entry['categories'] = categories.tolist()
+        values = np.ascontiguousarray(values)
+        entry.update({'dtype': values.dtype.str, 'shape': list(values.shape),
+                      'offset': offset})
+        entries[name] = entry
+        data.append(values)
+        offset = _align(offset + values.nbytes)
+
+    header = json.dumps({'version': BUNDLE_VERSION, 'meta': meta,
+                         'arrays': entries}, default=_json_default).encode()
+    start = _align(16 + len(header))
+    tmp = fname+'.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, values in zip(entries, data):
+            f.seek(start + entries[name]['offset'])
+            f.write(values.tobytes())
+        f.truncate(start + offset)
+    os.replace(tmp, fname)
+    print('Saved '+fname)
+
+class Bundle(object):
+    '''Bundle opened with memory-mapped arrays. bundle[name] returns an
+    array (strings decoded), bundle.meta the metadata.'''
+
+    def __init__(self, fname):
+        import struct
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            if f.read(8) != BUNDLE_MAGIC:
+                raise ValueError(fname+' is not a Mergen bundle')
+            n = struct.unpack('<Q', f.read(8))[0]
+            header = json.loads(f.read(n).decode())
+        if header['version'] > BUNDLE_VERSION:
+            raise ValueError(fname+' has bundle version '+\
+                             str(header['version'])+', this Mergen reads up '+\
+                             'to version '+str(BUNDLE_VERSION))
+        self.version = header['version']
+        self.meta = header['meta']
+        self.entries = header['arrays']
+        self._start = _align(16 + n)
+
+    def keys(self):
+        return list(self.entries.keys())
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def codes(self, name):
+        '''Stored (memory-mapped) array; int32 codes for string arrays.'''
+        entry = self.entries[name]
+        shape = tuple(entry['shape'])
+        if int(np.prod(shape)) == 0:
+            return np.empty(shape, dtype=entry['dtype'])
+        return np.memmap(self.fname, dtype=entry['dtype'], mode='r',
+                         offset=self._start+entry['offset'], shape=shape)
+
+    def categories(self, name):
+        return np.array(self.entries[name].get('categories', []))
+
+    def __getitem__(self, name):
+        values = self.codes(name)
+        if 'categories' in self.entries[name]:
+            return self.categories(name)[values]
+        return values
+
+def load_bundle(fname):
+    return Bundle(fname)
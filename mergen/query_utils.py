@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+query_utils.py
+
+Concurrent client for the SIMBAD and MAST web services. Requests run on an
+asyncio event loop with
+    * a bounded pool of in-flight requests (concurrency)
+    * token-bucket rate limiting (rate requests per second, bursts of up to
+      burst requests)
+    * exponential backoff with jitter on transient failures (connection
+      errors, timeouts, HTTP 429 and 5xx), honouring Retry-After
+    * an on-disk response cache keyed by the query (URL and payload), so
+      re-running a sector never repeats a successful request
+Identifiers are resolved in batches: one SIMBAD TAP query classifies up to
+batch_size objects, and one MAST request returns the TIC rows of up to
+batch_size targets. Service URLs are parameters, so everything can be run
+against a local stub server.
+
+Example:
+    client = AsyncQueryClient(concurrency=8, rate=5., cache_dir='./cache/')
+    ticid, otypes, main_id = run_async(classify_ticids(client, ticid_list))
+
+Client
+* TokenBucket
+* ResponseCache
+* AsyncQueryClient
+* run_async
+
+SIMBAD / MAST queries
+* simbad_tap_query
+* query_simbad_ids
+* query_mast_tic
+* classify_ticids
+"""
+
+import numpy as np
+import os
+import json
+import time
+
+SIMBAD_TAP_URL = 'https://simbad.cds.unistra.fr/simbad/sim-tap/sync'
+MAST_API_URL = 'https://mast.stsci.edu/api/v0/invoke'
+
+# >> TIC columns tried, in order, to find an object in SIMBAD when 'TIC <id>'
+# >> is not known there, with the prefix of the SIMBAD identifier
+ID_PREFIXES = [('TYC', 'TYC '), ('HIP', 'HIP '), ('TWOMASS', '2MASS J'),
+               ('SDSS', 'SDSS '), ('ALLWISE', 'WISEA '), ('GAIA', 'Gaia DR2 '),
+               ('APASS', 'APASS '), ('KIC', 'KIC ')]
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Client ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+class TokenBucket(object):
+    '''Token-bucket rate limiter: acquire() waits until a token is available.
+    Tokens refill at rate per second, up to capacity.'''
+
+    def __init__(self, rate=5., capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity else max(1., rate))
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+
+    async def acquire(self):
+        import asyncio
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now-self.last)*self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1-self.tokens)/self.rate)
+
+class ResponseCache(object):
+    '''Response bodies on disk, one file per query under path (keyed by the
+    sha1 of the URL and payload).'''
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @staticmethod
+    def key(url, data=None):
+        import hashlib
+        payload = json.dumps(data, sort_keys=True) if data else ''
+        return hashlib.sha1((url+'\n'+payload).encode()).hexdigest()
+
+    def _fname(self, key):
+        return os.path.join(self.path, key[:2], key+'.txt')
+
+    def get(self, key):
+        fname = self._fname(key)
+        if os.path.exists(fname):
+            with open(fname, 'r') as f:
+                return f.read()
+        return None
+
+    def put(self, key, text):
+        fname = self._fname(key)
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmp = fname+'.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, fname) # >> never leave a partial response
+
+class QueryError(Exception):
+    '''A request failed permanently (non-retryable HTTP status, or
+    max_retries exhausted).'''
+    pass
+
+class AsyncQueryClient(object):
+    '''HTTP POST client for asyncio (see module docstring).
+    Parameters:
+        * concurrency : maximum number of requests in flight
+        * rate : maximum requests per second (token bucket), burst : bucket
+                 capacity (default: rate)
+        * max_retries : retries of a transient failure before giving up
+        * backoff : first retry delay in seconds, doubled every retry (with
+                    up to 100% random jitter), capped at max_backoff
+        * timeout : per-request timeout in seconds
+        * cache_dir : directory of the response cache (None: no cache)
+    The counters hits, requests, retries and failures are kept for
+    reporting.'''
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, concurrency=8, rate=5., burst=None, max_retries=6,
+                 backoff=1., max_backoff=60., timeout=60., cache_dir=None):
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+        self.hits = self.requests = self.retries = self.failures = 0
+        self._sem = None
+        self._executor = None
+
+    def _request(self, url, data):
+        '''Blocking POST (run in the thread pool).'''
+        import urllib.request, urllib.parse
+        body = urllib.parse.urlencode(data).encode() if data else None
+        req = urllib.request.Request(url, data=body)
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            return resp.read().decode('utf-8')
+
+    def _delay(self, attempt, err):
+        import random
+        retry_after = getattr(getattr(err, 'headers', None), 'get',
+                              lambda k: None)('Retry-After')
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        delay = self.backoff * 2**attempt
+        return min(delay * (1 + random.random()), self.max_backoff)
+
+    async def post(self, url, data=None):
+        '''Response body of a POST request (from the cache if available).'''
+        import asyncio, urllib.error, socket
+        from concurrent.futures import ThreadPoolExecutor
+        if self.cache:
+            key = self.cache.key(url, data)
+            text = self.cache.get(key)
+            if type(text) != type(None):
+                self.hits += 1
+                return text
+        if type(self._sem) == type(None):
+            self._sem = asyncio.Semaphore(self.concurrency)
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries+1):
+            async with self._sem:
+                await self.bucket.acquire()
+                self.requests += 1
+                try:
+                    text = await loop.run_in_executor(self._executor,
+                                                      self._request, url, data)
+                    break
+                except urllib.error.HTTPError as e:
+                    if e.code not in self.RETRY_STATUS:
+                        self.failures += 1
+                        raise QueryError('HTTP '+str(e.code)+' from '+url)
+                    err = e
+                except (urllib.error.URLError, socket.timeout,
+                        ConnectionError) as e:
+                    err = e
+            if attempt == self.max_retries:
+                self.failures += 1
+                raise QueryError('Giving up on '+url+' after '+\
+                                 str(attempt+1)+' attempts: '+str(err))
+            self.retries += 1
+            await asyncio.sleep(self._delay(attempt, err))
+
+        if self.cache:
+            self.cache.put(key, text)
+        return text
+
+    def close(self):
+        if type(self._executor) != type(None):
+            self._executor.shutdown(wait=False)
+        self._sem = self._executor = None
+
+    def report(self):
+        print('Requests: {}, cache hits: {}, retries: {}, failures: {}'\
+              .format(self.requests, self.hits, self.retries, self.failures))
+
+def run_async(coro):
+    '''Runs a coroutine to completion, also from inside a running event loop
+    (e.g. Jupyter), where it is run on a separate thread.'''
+    import asyncio
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        return ex.submit(asyncio.run, coro).result()
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: SIMBAD / MAST queries :::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+def _batches(items, batch_size):
+    return [items[i:i+batch_size] for i in range(0, len(items), batch_size)]
+
+async def simbad_tap_query(client, adql, url=SIMBAD_TAP_URL):
+    '''Rows of a synchronous SIMBAD TAP (ADQL) query, as a list of dicts.'''
+    text = await client.post(url, {'REQUEST': 'doQuery', 'LANG': 'ADQL',
+                                   'FORMAT': 'json', 'QUERY': adql})
+    res = json.loads(text)
+    names = [col['name'] for col in res['metadata']]
+    return [dict(zip(names, row)) for row in res['data']]
+
+async def query_simbad_ids(client, ids, batch_size=200, url=SIMBAD_TAP_URL):
+    '''Classifications of SIMBAD identifiers (e.g. 'TIC 453370125').
+    Returns: dictionary {identifier: (otypes, main_id)} for the identifiers
+             known to SIMBAD, where otypes are '|'-separated (like the
+             'otypes' field of astroquery). Identifiers in failed batches are
+             listed in the second return value.'''
+    import asyncio
+
+    async def run_batch(batch):
+        quoted = ','.join(["'"+str(i).replace("'", "''")+"'" for i in batch])
+        adql = 'SELECT i.id, b.main_id, o.otype FROM ident AS i '+\
+               'JOIN basic AS b ON i.oidref = b.oid '+\
+               'LEFT JOIN otypes AS o ON o.oidref = b.oid '+\
+               'WHERE i.id IN ('+quoted+')'
+        return await simbad_tap_query(client, adql, url=url)
+
+    batches = _batches(list(ids), batch_size)
+    results = await asyncio.gather(*[run_batch(b) for b in batches],
+                                   return_exceptions=True)
+    found, failed = {}, []
+    for batch, rows in zip(batches, results):
+        if isinstance(rows, Exception):
+            print('!!! SIMBAD batch failed: '+str(rows))
+            failed.extend(batch)
+            continue
+        otypes = {}
+        for row in rows:
+            otypes.setdefault(row['id'], [row['main_id'], []])
+            otype = row['otype']
+            if otype and otype not in otypes[row['id']][1]:
+                otypes[row['id']][1].append(otype)
+        for i in otypes:
+            found[i] = ('|'.join(otypes[i][1]), otypes[i][0])
+    return found, failed
+
+async def query_mast_tic(client, ticid, batch_size=500, url=MAST_API_URL):
+    '''TIC rows of the given TICIDs from the MAST API (Mast.Catalogs.Filtered
+    .Tic), batch_size TICIDs per request.
+    Returns: dictionary {TICID: row dict} of the TICIDs found, and the
+             TICIDs of failed batches'''
+    import asyncio
+
+    async def run_batch(batch):
+        request = {'service': 'Mast.Catalogs.Filtered.Tic', 'format': 'json',
+                   'pagesize': len(batch), 'page': 1,
+                   'params': {'columns': '*', 'filters': [
+                       {'paramName': 'ID', 'values': [int(t) for t in batch]}]}}
+        text = await client.post(url, {'request': json.dumps(request)})
+        return json.loads(text)['data']
+
+    batches = _batches([int(t) for t in ticid], batch_size)
+    results = await asyncio.gather(*[run_batch(b) for b in batches],
+                                   return_exceptions=True)
+    rows, failed = {}, []
+    for batch, rows_batch in zip(batches, results):
+        if isinstance(rows_batch, Exception):
+            print('!!! MAST batch failed: '+str(rows_batch))
+            failed.extend(batch)
+            continue
+        for row in rows_batch:
+            rows[int(row['ID'])] = row
+    return rows, failed
+
+def _identifier(row, col, prefix):
+    '''SIMBAD identifier from a TIC row (a dict, astropy Row or TICStore row),
+    or None if the column is empty.'''
+    try:
+        value = row[col]
+    except (KeyError, IndexError):
+        return None
+    if type(value) == type(None) or value is np.ma.masked:
+        return None
+    value = str(value).strip()
+    if value in ['', 'nan', '--', 'None']:
+        return None
+    if col == 'GAIA' or col == 'KIC' or col == 'HIP' or col == 'SDSS':
+        try:
+            value = str(int(float(value)))
+        except ValueError:
+            pass
+    return prefix+value
+
+async def classify_ticids(client, ticid_list, tic_store=None, batch_size=200,
+                          out_fname=None, simbad_url=SIMBAD_TAP_URL,
+                          mast_url=MAST_API_URL):
+    '''SIMBAD classifications of TESS targets. Every target is first looked
+    up as 'TIC <id>'; for the rest, the cross-match identifiers of the TIC
+    (ID_PREFIXES, from tic_store if given, else from MAST) are tried in
+    order, each stage one batched query per batch_size targets.
+    Parameters:
+        * out_fname : if given, every resolved target is appended to it as
+                      'ticid,otypes,main_id' (empty otypes and main_id if
+                      SIMBAD does not know it). Targets whose queries failed
+                      are not written, so they are retried on the next run.
+    Returns: ticid, otypes, main_id of the classified targets ('none' for
+             targets unknown to SIMBAD)'''
+    ticid_list = [int(t) for t in ticid_list]
+    result, errors = {}, set()
+
+    # >> stage 0: TIC identifiers
+    found, failed = await query_simbad_ids(client, ['TIC '+str(t) \
+                                                    for t in ticid_list],
+                                           batch_size=batch_size,
+                                           url=simbad_url)
+    for tic in ticid_list:
+        if 'TIC '+str(tic) in found:
+            result[tic] = found['TIC '+str(tic)]
+    errors.update([int(i.split()[1]) for i in failed])
+    todo = [t for t in ticid_list if t not in result and t not in errors]
+    print('Resolved by TICID: '+str(len(result))+', remaining: '+str(len(todo)))
+
+    # >> cross-match identifiers of the remaining targets
+    rows = {}
+    if len(todo) > 0 and type(tic_store) != type(None):
+        for tic in todo:
+            row = tic_store.row(tic)
+            if type(row) != type(None):
+                rows[tic] = row
+    missing = [t for t in todo if t not in rows]
+    if len(missing) > 0:
+        found, failed = await query_mast_tic(client, missing, url=mast_url)
+        rows.update(found)
+        errors.update(failed)
+
+    for col, prefix in ID_PREFIXES:
+        ids = {}
+        for tic in todo:
+            if tic in result or tic in errors or tic not in rows:
+                continue
+            ident = _identifier(rows[tic], col, prefix)
+            if type(ident) != type(None):
+                ids[ident] = tic
+        if len(ids) == 0:
+            continue
+        found, failed = await query_simbad_ids(client, list(ids),
+                                               batch_size=batch_size,
+                                               url=simbad_url)
+        for ident in found:
+            result[ids[ident]] = found[ident]
+        errors.update([ids[i] for i in failed])
+        print(col+': resolved '+str(len(found))+' of '+str(len(ids)))
+
+    ticid_simbad, otypes_simbad, main_id_simbad = [], [], []
+    lines = []
+    for tic in ticid_list:
+        if tic in errors:
+            continue
+        if tic in result:
+            otypes, main_id = result[tic]
+            lines.append('{},{},{}\n'.format(tic, otypes, main_id))
+        else:
+            otypes, main_id = 'none', 'none'
+            lines.append('{},{},{}\n'.format(tic, '', ''))
+        ticid_simbad.append(tic)
+        otypes_simbad.append(otypes)
+        main_id_simbad.append(main_id)
+    if type(out_fname) != type(None):
+        with open(out_fname, 'a') as f:
+            f.writelines(lines)
+    if len(errors) > 0:
+        print('!!! '+str(len(errors))+' targets failed, rerun to retry them')
+    return ticid_simbad, otypes_simbad, main_id_simbad
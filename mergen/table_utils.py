@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+table_utils.py
+
+Persisted feature table with TICID as the primary key. Features from every
+source (engineered features ENF, autoencoder bottlenecks CAE/DAE, TLS
+features, TIC catalog columns, ...) are stored as column families of one
+memory-mapped matrix, so the combined clustering input is a column slice of
+the matrix instead of re-reading and re-joining the source files.
+
+Layout of a table directory:
+    * ticid.npy : sorted TICIDs (int64), one per row
+    * data.npy : float64 matrix, shape=(num rows, num columns), with the
+                 columns of each family stored contiguously
+    * present.npy : bool matrix, shape=(num rows, num families), whether a
+                    row has values for a family (missing values are nan)
+    * meta.json : families, their column ranges and column names
+
+Feature table
+* FeatureTable
+* build_feature_table
+* load_feature_table
+"""
+
+import numpy as np
+import os
+import json
+
+from . import join_utils as ju
+
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# :: Feature table :::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+# ::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::::
+
+class FeatureTable(object):
+    '''Memory-mapped feature table (see module docstring). Open an existing
+    table with load_feature_table, or create one with build_feature_table.
+
+    Example:
+        table = load_feature_table(output_dir+'feature_table/')
+        ticid, features = table.select(['CAE', 'ENF'])'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path+'meta.json', 'r') as f:
+            self.meta = json.load(f)
+        self.ticid = np.load(path+'ticid.npy', mmap_mode='r')
+        self.data = np.load(path+'data.npy', mmap_mode='r')
+        self.present = np.load(path+'present.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self.ticid)
+
+    @property
+    def families(self):
+        return [fam['name'] for fam in self.meta['families']]
+
+    def _family(self, name):
+        for i, fam in enumerate(self.meta['families']):
+            if fam['name'] == name:
+                return i, fam
+        raise ValueError('No feature family '+name+' in '+self.path)
+
+    def columns(self, families=None):
+        '''Column names of the given families (default: all).'''
+        if type(families) == type(None):
+            families = self.families
+        names = []
+        for name in families:
+            names.extend(self._family(name)[1]['columns'])
+        return names
+
+    def rows(self, ticid):
+        '''Row of each TICID (-1 if it is not in the table).'''
+        return ju.match_ticid(ticid, self.ticid)
+
+    def select(self, families=None, ticid=None, complete=True):
+        '''Features of the given families, side by side.
+        Parameters:
+            * families : list of family names, in the order of the output
+                         columns (default: all)
+            * ticid : if given, rows are returned in this order (missing
+                      TICIDs are reported and set to nan)
+            * complete : if True (and ticid is None), only rows with values
+                         for every selected family are kept
+        Returns: ticid, features. If the families are adjacent in storage
+                 order and no rows are dropped, features is a view of the
+                 memory-mapped matrix (no copy).'''
+        if type(families) == type(None):
+            families = self.families
+        inds = [self._family(name) for name in families]
+        cols = [(fam['start'], fam['stop']) for i, fam in inds]
+        contiguous = all([cols[j][1] == cols[j+1][0] \
+                          for j in range(len(cols)-1)])
+        if contiguous:
+            features = self.data[:, cols[0][0]:cols[-1][1]]
+        else:
+            features = np.concatenate([self.data[:, a:b] for a, b in cols],
+                                      axis=1)
+
+        if type(ticid) != type(None):
+            return np.asarray(ticid), \
+                ju.align_to_ticid(ticid, self.ticid, features,
+                                  name='feature table')
+        if complete:
+            keep = np.all(self.present[:, [i for i, fam in inds]], axis=1)
+            if not np.all(keep):
+                return np.asarray(self.ticid[keep]), features[keep]
+        return np.asarray(self.ticid), features
+
+    def add_family(self, name, ticid, values, columns=None, source=''):
+        '''Adds (or replaces) a feature family. Rows are matched by TICID;
+        TICIDs not yet in the table are not added (build the table with
+        every TICID of interest). The data file is rewritten.'''
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 1:
+            values = values.reshape(-1, 1)
+        if type(columns) == type(None):
+            columns = [name+str(j) for j in range(values.shape[1])]
+
+        families = [fam for fam in self.meta['families'] if fam['name'] != name]
+        old_cols = [(fam['start'], fam['stop']) for fam in families]
+        old_present = [self._family(fam['name'])[0] for fam in families]
+        width = sum([b-a for a, b in old_cols]) + values.shape[1]
+
+        # >> rewrite data.npy with the new family appended
+        tmp = self.path+'data_tmp.npy'
+        data = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float64,
+                                         shape=(len(self.ticid), width))
+        start = 0
+        for fam, (a, b) in zip(families, old_cols):
+            data[:, start:start+b-a] = self.data[:, a:b]
+            fam['start'], fam['stop'] = start, start+b-a
+            start += b-a
+        data[:, start:] = ju.align_to_ticid(self.ticid, ticid, values,
+                                            name=name, verbose=False)
+        found = self.rows(ticid)
+        present = np.zeros((len(self.ticid), len(families)+1), dtype='bool')
+        present[:, :-1] = self.present[:, old_present]
+        present[found[found >= 0], -1] = True
+        data.flush()
+        del data
+        families.append({'name': name, 'start': start,
+                         'stop': start+values.shape[1],
+                         'columns': list(columns), 'source': source})
+
+        self.data = self.present = None
+        os.replace(tmp, self.path+'data.npy')
+        np.save(self.path+'present.npy', present)
+        self.meta['families'] = families
+        with open(self.path+'meta.json', 'w') as f:
+            json.dump(self.meta, f, indent=1)
+        self.data = np.load(self.path+'data.npy', mmap_mode='r')
+        self.present = np.load(self.path+'present.npy', mmap_mode='r')
+        print('Added feature family '+name+' ('+str(np.count_nonzero(
+            present[:, -1]))+' of '+str(len(self.ticid))+' rows)')
+        return self
+
+def build_feature_table(path, ticid, families={}):
+    '''Creates a feature table in the directory path.
+    Parameters:
+        * ticid : TICIDs of the rows (e.g. every light curve of a sector)
+        * families : dictionary {name: (ticid, values)} or
+                     {name: (ticid, values, columns)}, e.g.
+                     {'ENF': (ticid_enf, enf), 'CAE': (ticid_cae, bottleneck)}
+    Returns: FeatureTable'''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    ticid = np.unique(np.asarray(ticid).astype('int64'))
+    np.save(path+'ticid.npy', ticid)
+    np.save(path+'data.npy', np.empty((len(ticid), 0)))
+    np.save(path+'present.npy', np.empty((len(ticid), 0), dtype='bool'))
+    with open(path+'meta.json', 'w') as f:
+        json.dump({'families': []}, f)
+
+    table = FeatureTable(path)
+    for name in families:
+        family = families[name]
+        columns = family[2] if len(family) > 2 else None
+        table.add_family(name, family[0], family[1], columns=columns)
+    print('Saved '+path)
+    return table
+
+def load_feature_table(path):
+    return FeatureTable(path)